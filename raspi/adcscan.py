@@ -0,0 +1,195 @@
+#
+#  adcscan.py: Batched sensor acquisition for the MCP3008 ADCs
+#
+#  Adafruit_MCP3008.read_adc() does one Python-level SPI transaction per
+#  channel. The MCP3008 needs chip select to go high between conversions,
+#  so channels can't simply be clocked out in one long transfer; instead
+#  SpiDev.burst() hands the kernel one SPI_IOC_MESSAGE with a 3-byte
+#  transfer per channel (chip select toggled in between), so all channels
+#  of a chip are read with a single ioctl. ADCScanner reads both chips back
+#  to back and decodes every channel at once into a numpy frame: each
+#  transfer sits in the last 3 bytes of a 4-byte slot, so the replies read
+#  as big-endian words and decoding is one shift and one mask.
+#
+#  FakeSpiDev simulates an MCP3008 so all of this runs without hardware.
+
+import os
+import fcntl
+import ctypes
+import numpy
+from latency import clock
+
+# linux/spi/spidev.h
+def _IOW(nr, size):
+    return (1 << 30) | (size << 16) | (ord('k') << 8) | nr
+
+class spi_ioc_transfer(ctypes.Structure):
+    _fields_ = [
+        ('tx_buf', ctypes.c_uint64),
+        ('rx_buf', ctypes.c_uint64),
+        ('len', ctypes.c_uint32),
+        ('speed_hz', ctypes.c_uint32),
+        ('delay_usecs', ctypes.c_uint16),
+        ('bits_per_word', ctypes.c_uint8),
+        ('cs_change', ctypes.c_uint8),
+        ('tx_nbits', ctypes.c_uint8),
+        ('rx_nbits', ctypes.c_uint8),
+        ('word_delay_usecs', ctypes.c_uint8),
+        ('pad', ctypes.c_uint8),
+    ]
+
+SPI_IOC_WR_MODE = _IOW(1, 1)
+SPI_IOC_WR_BITS_PER_WORD = _IOW(3, 1)
+SPI_IOC_WR_MAX_SPEED_HZ = _IOW(4, 4)
+
+def SPI_IOC_MESSAGE(n):
+    return _IOW(0, n * ctypes.sizeof(spi_ioc_transfer))
+
+
+# Single-ended conversion command for channel ch (same as read_adc)
+def command(ch):
+    return 0b11 << 6 | (ch & 0x07) << 3
+
+# 10-bit result from the 3 bytes clocked back (same as read_adc)
+def decode(resp):
+    return (resp[0] & 0x01) << 9 | resp[1] << 1 | (resp[2] & 0x80) >> 7
+
+
+class SpiDev:
+    # /dev/spidev<bus>.<device> opened for multi-transfer messages
+
+    def __init__(self, bus, device, max_speed_hz=500000, mode=0):
+        self.fd = os.open("/dev/spidev%d.%d" % (bus, device), os.O_RDWR)
+        self.max_speed_hz = max_speed_hz
+        fcntl.ioctl(self.fd, SPI_IOC_WR_MODE, ctypes.c_uint8(mode))
+        fcntl.ioctl(self.fd, SPI_IOC_WR_BITS_PER_WORD, ctypes.c_uint8(8))
+        fcntl.ioctl(self.fd, SPI_IOC_WR_MAX_SPEED_HZ, ctypes.c_uint32(max_speed_hz))
+        self._messages = {}
+
+    # Clocks out tx (ctypes byte buffer) into rx as len(tx) // segment
+    # transfers of the bytes of each segment from offset on, releasing
+    # chip select between them, in one ioctl
+    def burst(self, tx, rx, segment, offset=0):
+        key = (ctypes.addressof(tx), ctypes.addressof(rx), len(tx), segment, offset)
+        message = self._messages.get(key)
+        if message is None:
+            n = len(tx) // segment
+            message = (spi_ioc_transfer * n)()
+            for i in range(n):
+                message[i].tx_buf = ctypes.addressof(tx) + i * segment + offset
+                message[i].rx_buf = ctypes.addressof(rx) + i * segment + offset
+                message[i].len = segment - offset
+                message[i].speed_hz = self.max_speed_hz
+                message[i].bits_per_word = 8
+                message[i].cs_change = 1 if i < n - 1 else 0
+            self._messages[key] = message
+        fcntl.ioctl(self.fd, SPI_IOC_MESSAGE(len(message)), ctypes.addressof(message))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FakeSpiDev:
+    # Stand-in for an MCP3008 on an SPI bus. values holds the 8 channel
+    # readings (0-1023) it answers with; change it to simulate breath.
+    # latency (seconds per transaction) and max_speed_hz (bus clock) make
+    # every transaction take roughly as long as it would on the Pi.
+
+    def __init__(self, values=None, latency=0.0, max_speed_hz=None):
+        self.values = numpy.full(8, 512, numpy.int32) if values is None else numpy.asarray(values)
+        self.latency = latency
+        self.max_speed_hz = max_speed_hz
+        self.transfers = 0
+
+    def _wait(self, nbytes):
+        duration = self.latency
+        if self.max_speed_hz:
+            duration += 8.0 * nbytes / self.max_speed_hz
+        if duration:
+            end = clock() + duration
+            while clock() < end:
+                pass
+
+    def _answer(self, cmd):
+        value = int(self.values[(cmd >> 3) & 0x07])
+        return [(value >> 9) & 0x01, (value >> 1) & 0xFF, (value & 0x01) << 7]
+
+    # Adafruit_GPIO.SPI.SpiDev interface (what read_adc uses)
+    def transfer(self, data):
+        self.transfers += 1
+        self._wait(len(data))
+        return self._answer(data[0])
+
+    def burst(self, tx, rx, segment, offset=0):
+        self.transfers += 1
+        self._wait(len(tx) // segment * (segment - offset))
+        cmd = numpy.frombuffer(tx, numpy.uint8)[offset::segment]
+        value = self.values[(cmd >> 3) & 0x07]
+        resp = numpy.frombuffer(rx, numpy.uint8).reshape(-1, segment)
+        resp[:, offset] = (value >> 9) & 0x01
+        resp[:, offset + 1] = (value >> 1) & 0xFF
+        resp[:, offset + 2] = (value & 0x01) << 7
+
+    def close(self):
+        pass
+
+
+class ADCScanner:
+    # Reads channels[i] of devices[i] for every device and returns them as
+    # one frame. A device can be an SpiDev/FakeSpiDev (burst read) or an
+    # Adafruit_MCP3008.MCP3008 (one read_adc per channel).
+
+    def __init__(self, devices, channels):
+        self.devices = devices
+        self.channels = [list(c) for c in channels]
+        self.size = sum(len(c) for c in self.channels)
+        self.frame = numpy.zeros(self.size, numpy.int32)
+        # One tx and one rx buffer for all chips, a 4-byte slot per channel
+        # (a pad byte, then the 3 bytes of its transfer); each chip gets a slice
+        self._tx = (ctypes.c_uint8 * (4 * self.size))()
+        self._rx = (ctypes.c_uint8 * (4 * self.size))()
+        self._bursts = []
+        self._reads = []
+        burstchannels = []
+        start = 0
+        for dev, chans in zip(self.devices, self.channels):
+            n = len(chans)
+            if hasattr(dev, 'burst'):
+                tx = (ctypes.c_uint8 * (4 * n)).from_buffer(self._tx, 4 * start)
+                rx = (ctypes.c_uint8 * (4 * n)).from_buffer(self._rx, 4 * start)
+                for i, ch in enumerate(chans):
+                    tx[4 * i + 1] = command(ch)
+                self._bursts.append((dev.burst, tx, rx))
+                burstchannels += range(start, start + n)
+            else:
+                self._reads += [(dev.read_adc, ch, start + i) for i, ch in enumerate(chans)]
+            start += n
+        # The replies as big-endian words: the 10-bit value is bits 7-16
+        self._words = numpy.frombuffer(self._rx, numpy.dtype('>u4'))
+        self._value = numpy.zeros(self.size, numpy.uint32)
+        # Burst channels are written in place when they are the first ones
+        # of the frame (all of them, unless a chip is read with read_adc)
+        self._burstchannels = numpy.array(burstchannels, numpy.intp)
+        self._contiguous = burstchannels == list(range(len(burstchannels)))
+        self._head = self.frame[:len(burstchannels)]
+        self._headvalue = self._value[:len(burstchannels)]
+
+    # Returns (frame, timestamp). frame is reused by the next scan unless
+    # out is given; timestamp is taken right after the last chip is read.
+    def scan(self, out=None):
+        frame = self.frame if out is None else out
+        for burst, tx, rx in self._bursts:
+            burst(tx, rx, 4, 1)
+        for read_adc, ch, i in self._reads:
+            frame[i] = read_adc(ch)
+        timestamp = clock()
+        if self._bursts:
+            value = self._value
+            numpy.right_shift(self._words, 7, value)
+            if self._contiguous:
+                head = self._head if out is None else frame[:len(self._head)]
+                numpy.bitwise_and(self._headvalue, 0x3FF, head, casting='unsafe')
+            else:
+                numpy.bitwise_and(value, 0x3FF, value)
+                frame[self._burstchannels] = value[self._burstchannels]
+        return frame, timestamp
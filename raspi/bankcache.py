@@ -0,0 +1,81 @@
+#
+#  bankcache.py: Resident instrument bank cache
+#
+#  Keeps the samples dict of several instruments in memory so switching
+#  back to a recently played instrument is a dictionary swap instead of
+#  reloading its directory. Banks are kept within a memory budget (bytes)
+#  and the least recently used ones are evicted first.
+
+from __future__ import division
+import threading
+from collections import OrderedDict
+
+
+# Bytes held by a samples dict (transposed notes share their source data)
+def banksize(samples):
+    seen = set()
+    nbytes = 0
+    for sound in samples.values():
+        if id(sound.data) not in seen:
+            seen.add(id(sound.data))
+            nbytes += sound.data.nbytes
+    return nbytes
+
+
+class BankCache:
+
+    def __init__(self, maxbytes=64*1024*1024):
+        self.maxbytes = maxbytes
+        self.banks = OrderedDict() # key -> samples, in LRU order
+        self.sizes = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    # Returns the cached samples dict for key, or None
+    def get(self, key):
+        with self.lock:
+            samples = self.banks.get(key)
+            if samples is None:
+                self.misses += 1
+                return None
+            self.banks.pop(key)
+            self.banks[key] = samples # most recently used
+            self.hits += 1
+            return samples
+
+    def put(self, key, samples):
+        size = banksize(samples)
+        with self.lock:
+            if key in self.banks:
+                self.banks.pop(key)
+                self.nbytes -= self.sizes.pop(key)
+            if size > self.maxbytes:
+                return
+            while self.nbytes + size > self.maxbytes:
+                oldkey, old = self.banks.popitem(last=False)
+                self.nbytes -= self.sizes.pop(oldkey)
+                self.evictions += 1
+            self.banks[key] = samples
+            self.sizes[key] = size
+            self.nbytes += size
+
+    def clear(self):
+        with self.lock:
+            self.banks.clear()
+            self.sizes.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitrate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'banks': dict(self.sizes),
+                'bytes': self.nbytes,
+            }
@@ -0,0 +1,155 @@
+#
+#  bankpack.py: Precompiled instrument banks
+#
+#  Compiles an instrument directory into a single pack file holding
+#  everything ActuallyLoad would otherwise work out at startup: which
+#  sample (and transpose) plays each midinote, loop points, sample format,
+#  and the 16-bit PCM data of every sample, each starting on a page
+#  boundary so it can be memory-mapped directly.
+#
+#  Layout:  "DHPBANK1" | header length (uint32) | JSON header | PCM blobs
+#
+#  The header records a signature of the wav files it was built from
+#  (names, sizes and mtimes). A pack whose signature no longer matches its
+#  directory is stale and ignored, so the loader falls back to the wav files.
+#
+#  usage: python bankpack.py [samplesdir]
+#         compiles every instrument directory found in samplesdir
+#
+
+import os
+import sys
+import json
+import struct
+import hashlib
+import numpy
+import numpy_mixer
+import samplestore
+from waveread import waveread
+from instrument import Instrument, noteFiles
+
+MAGIC = b'DHPBANK1'
+VERSION = 1
+PACKNAME = "bank.dhpbank"
+
+
+def packpath(dirname):
+    return os.path.join(dirname, PACKNAME)
+
+
+# Hash of the wav files (name, size, mtime) of an instrument directory
+def signature(dirname):
+    sha = hashlib.sha1()
+    for fname in sorted(os.listdir(dirname)):
+        if fname.lower().endswith(".wav"):
+            st = os.stat(os.path.join(dirname, fname))
+            sha.update(("%s %d %d\n" % (fname, st.st_size, int(st.st_mtime))).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def _pagealign(n):
+    return (n + samplestore.PAGESIZE - 1) // samplestore.PAGESIZE * samplestore.PAGESIZE
+
+
+# Reads one wav file the way Sound does: returns (header entry, int16 data)
+def _readsample(dirname, fname, midinote):
+    wf = waveread(os.path.join(dirname, fname))
+    if wf.getloops():
+        loop = wf.getloops()[0][0]
+        nframes = wf.getloops()[0][1] + 2
+    else:
+        loop = -1
+        nframes = wf.getnframes()
+    raw = wf.readframes(nframes)
+    if wf.getsampwidth() == 3:
+        data = numpy_mixer.binary24_to_int16(raw, len(raw) // 3)
+    else:
+        data = numpy.frombuffer(raw, numpy.int16)
+    entry = {'file': fname, 'midinote': midinote, 'nchannels': wf.getnchannels(),
+             'samplerate': wf.getframerate(), 'sampwidth': wf.getsampwidth(),
+             'loop': loop, 'nframes': nframes, 'count': len(data)}
+    wf.close()
+    return entry, data
+
+
+# Compiles dirname into its pack file. Returns the pack path.
+def compilebank(dirname):
+    sig = signature(dirname)
+    files = noteFiles(dirname)
+    entries = []
+    datas = []
+    notes = {}
+    for midinote in sorted(files):
+        entry, data = _readsample(dirname, files[midinote], midinote)
+        notes[midinote] = [len(entries), 0]
+        entries.append(entry)
+        datas.append(data)
+
+    # Notes without a wav file, as Instrument transposes them
+    instrument = Instrument(dirname)
+    for index, sample in enumerate(instrument.sample_file_array):
+        midinote = index + 24
+        if sample == None or midinote in notes or midinote - sample.transpose not in notes:
+            continue
+        notes[midinote] = [notes[midinote - sample.transpose][0], sample.transpose]
+
+    offset = 0
+    for entry, data in zip(entries, datas):
+        entry['offset'] = offset # relative to the first page after the header
+        offset = _pagealign(offset + data.nbytes)
+    header = json.dumps({'version': VERSION, 'signature': sig, 'samples': entries,
+                         'notes': dict((str(n), v) for n, v in notes.items())}).encode('utf-8')
+    datastart = _pagealign(len(MAGIC) + 4 + len(header))
+
+    path = packpath(dirname)
+    tmp = path + ".tmp"
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC + struct.pack('<I', len(header)) + header)
+        for entry, data in zip(entries, datas):
+            f.seek(datastart + entry['offset'])
+            f.write(data.astype('<i2').tobytes())
+        f.truncate(datastart + offset)
+    os.rename(tmp, path)
+    return path
+
+
+# Returns the pack of dirname as a dict, or None if there is no pack,
+# it is stale or it can't be read.
+#   samples:   header entries, with 'data' mapped as int16 arrays
+#   notes:     {midinote: (sample index, transpose)}
+def openbank(dirname):
+    path = packpath(dirname)
+    try:
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                return None
+            length = struct.unpack('<I', f.read(4))[0]
+            header = json.loads(f.read(length).decode('utf-8'))
+    except (IOError, OSError, ValueError, struct.error):
+        return None
+    if header.get('version') != VERSION or header.get('signature') != signature(dirname):
+        return None
+    # One mapping for the whole pack, every sample is a view into it
+    datastart = _pagealign(len(MAGIC) + 4 + length)
+    whole = samplestore.mapdata(path, 0, os.path.getsize(path) // 2)
+    for entry in header['samples']:
+        start = (datastart + entry['offset']) // 2
+        entry['data'] = whole[start:start + entry['count']]
+    notes = dict((int(n), tuple(v)) for n, v in header['notes'].items())
+    return {'path': path, 'samples': header['samples'], 'notes': notes}
+
+
+# Instrument directories of a samples directory ("0 Saw", "1 organ", ...)
+def instrumentdirs(samplesdir):
+    return [os.path.join(samplesdir, d) for d in sorted(os.listdir(samplesdir))
+            if os.path.isdir(os.path.join(samplesdir, d))]
+
+
+if __name__ == "__main__":
+    samplesdir = sys.argv[1] if len(sys.argv) > 1 else "samples"
+    for dirname in instrumentdirs(samplesdir):
+        if openbank(dirname) is not None:
+            print('Up to date: %s' % dirname)
+            continue
+        path = compilebank(dirname)
+        print('Compiled: %s (%d bytes)' % (path, os.path.getsize(path)))
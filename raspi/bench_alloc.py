@@ -0,0 +1,165 @@
+#
+#  bench_alloc.py: Allocations of the audio callback
+#
+#  Garbage collection pauses land in whichever thread happens to allocate,
+#  so the audio callback should not allocate at all once it is running.
+#  This drives a voice pool the way dhp.py's AudioCallback does (apply the
+#  pool's commands, callback profiler, mixvoices into a reused buffer,
+#  output stage into the int16 block) through a few steady states, and
+#  counts what the callbacks allocate after a warm-up:
+#
+#    sustain     every hole of the harmonica looping, transposed from one
+#                sample, breath pressure changing every block
+#    oneshot     one-shot notes running out (and freed) during the count
+#    fadeout     released notes fading out and freed
+#    sinc        sustain with the sinc interpolation tier
+#    threads     sustain mixed by 2 mixer threads (Cython only)
+#
+#  Two counts per case, beyond what the same count of an empty callback
+#  gives: objects tracked by the garbage collector that are still alive
+#  after the blocks (any interpreter), and with tracemalloc (Python 3) the
+#  peak of the memory allocated while the blocks ran, which also sees
+#  temporaries, numpy arrays included. The NumPy backend needs temporaries
+#  to mix and is only reported; any allocation by the Cython backend makes
+#  the script exit with status 1.
+#
+#  usage: python bench_alloc.py [blocksize]
+#
+
+from __future__ import division
+import gc
+import sys
+import itertools
+import numpy
+import voicepool
+import interpolation
+import callbackprofiler
+import latency
+from bench_mixer import FADEOUT, FADEOUTLENGTH, SPEED, SAMPLERATE, HARMONICA_NOTES, HARMONICA_SAMPLE_NOTE, \
+    SyntheticSound, backends
+
+try:
+    import tracemalloc
+except ImportError: # Python 2
+    tracemalloc = None
+
+GLOBAL_VOLUME = 10 ** (-10 / 20)
+LIMITER_KNEE = 0.5
+WARMUP = 300  # blocks before counting (past 256: Python caches smaller ints)
+NBLOCKS = 200 # blocks counted
+
+
+# What AudioCallback does in one block, with its buffers allocated once
+class Callback:
+
+    def __init__(self, module, pool, blocksize, workers=1):
+        self.module = module
+        self.pool = pool
+        self.blocksize = blocksize
+        self.workers = workers
+        self.profiler = callbackprofiler.CallbackProfiler(pool, blocksize, SAMPLERATE)
+        self.mixbuffer = numpy.zeros(2 * blocksize, numpy.float32)
+        self.outdata = numpy.zeros((blocksize, 2), numpy.int16)
+        self.dither = numpy.zeros(1, numpy.uint32)
+        self.notes = numpy.array(HARMONICA_NOTES)
+        self.gains = numpy.linspace(0.2, 1.0, len(HARMONICA_NOTES)).astype(numpy.float32)
+
+    def __call__(self):
+        start = latency.clock()
+        self.pool.apply(self.blocksize)
+        self.profiler.begin()
+        b = self.module.mixvoices(self.pool, self.blocksize, FADEOUT, FADEOUTLENGTH, self.workers, self.mixbuffer)
+        self.module.outputstage(b, self.outdata, GLOBAL_VOLUME, LIMITER_KNEE, self.dither)
+        self.profiler.end(start)
+
+
+# Pool playing every hole of the harmonica from one sound
+def harmonica(sound):
+    pool = voicepool.VoicePool(len(HARMONICA_NOTES), FADEOUT)
+    for note in HARMONICA_NOTES:
+        pool.noteon(sound, note, SPEED[note - HARMONICA_SAMPLE_NOTE], 100)
+    return pool
+
+
+# [(name, pool, workers)] of the steady states (voice pools with their
+# note-ons queued) for a backend
+def cases(name, blocksize):
+    looped = SyntheticSound(HARMONICA_SAMPLE_NOTE, loop=1000)
+    pool = harmonica(looped)
+    pool.express(HARMONICA_NOTES, numpy.linspace(0.2, 1.0, len(HARMONICA_NOTES)))
+    yield 'sustain', pool, 1
+    # Runs out halfway through the counted blocks
+    short = SyntheticSound(HARMONICA_SAMPLE_NOTE, nframes=(WARMUP + NBLOCKS // 2) * blocksize)
+    yield 'oneshot', harmonica(short), 1
+    pool = harmonica(looped)
+    for serial in range(1, len(HARMONICA_NOTES) + 1):
+        pool.release(serial)
+    yield 'fadeout', pool, 1
+    sinc = SyntheticSound(HARMONICA_SAMPLE_NOTE, loop=1000)
+    sinc.interpolation = interpolation.SINC
+    yield 'sinc', harmonica(sinc), 1
+    if name == 'cython':
+        yield 'threads', harmonica(looped), 2
+
+
+# A callback that does nothing: what counting itself costs
+class Idle:
+
+    def __call__(self):
+        pass
+
+
+# Calls callback once per item of blocks (the same loop warms up and
+# counts, so the interpreter has nothing left to set up when counting)
+def play(callback, blocks):
+    for _ in blocks:
+        callback()
+
+
+# (gc objects, traced bytes) allocated by nblocks callbacks after a
+# warm-up; traced bytes is None without tracemalloc. The counts include
+# a few bytes of tracemalloc's own, see Idle.
+def allocations(callback, warmup=WARMUP, nblocks=NBLOCKS):
+    play(callback, itertools.repeat(None, warmup))
+    blocks = itertools.repeat(None, nblocks)
+    traced = None
+    gc.collect()
+    gc.disable()
+    try:
+        play(callback, itertools.repeat(None, 1)) # refills the free lists collect() emptied
+        if tracemalloc is not None:
+            tracemalloc.start()
+            play(callback, itertools.repeat(None, 1)) # tracemalloc's own first-call bookkeeping
+            before = tracemalloc.get_traced_memory()[0]
+        objects = gc.get_count()[0]
+        if tracemalloc is not None:
+            tracemalloc.reset_peak()
+        play(callback, blocks)
+        if tracemalloc is not None:
+            traced = tracemalloc.get_traced_memory()[1] - before
+            tracemalloc.stop()
+        objects = gc.get_count()[0] - objects
+    finally:
+        gc.enable()
+    return objects, traced
+
+
+if __name__ == "__main__":
+    blocksize = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    print('blocksize %d, %d blocks counted after %d, tracemalloc %s' % (
+        blocksize, NBLOCKS, WARMUP, 'on' if tracemalloc is not None else 'unavailable (gc objects only)'))
+    print('%-8s %-8s %10s %13s' % ("backend", "case", "gc objects", "traced bytes"))
+    failed = False
+    idleobjects, idletraced = allocations(Idle())
+    for name, module in backends():
+        for case, pool, workers in cases(name, blocksize):
+            objects, traced = allocations(Callback(module, pool, blocksize, workers))
+            objects = max(0, objects - idleobjects)
+            if traced is not None:
+                traced = max(0, traced - idletraced)
+            print('%-8s %-8s %10d %13s' % (name, case, objects, '-' if traced is None else traced))
+            if name == 'cython' and (objects or traced):
+                failed = True
+    if failed:
+        print('the Cython callback allocates')
+    sys.exit(1 if failed else 0)
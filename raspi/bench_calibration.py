@@ -0,0 +1,74 @@
+#
+#  bench_calibration.py: Resting value tracking under sensor drift
+#
+#  Plays bench_conditioning's synthetic noisy breath input with every
+#  channel's resting value drifting linearly by up to DRIFT tolerances
+#  (half the channels up, towards blow, half down) over the session,
+#  through a SensorConditioner calibrated at the start, with and without a
+#  calibration.RestTracker. For each:
+#
+#    spurious    note-ons outside any gesture (drifted into a threshold)
+#    missed      gestures with no note-on of the right direction
+#    error       largest difference of a final resting value from the true
+#                one, in ADC counts
+#    us/scan     time of one update() of the tracker (0 without)
+#
+#  usage: python bench_calibration.py
+#
+
+from __future__ import division
+import time
+import numpy
+import sensorfilter
+import calibration
+import bench_conditioning as bc
+
+bc.SECONDS = 120
+DRIFT = 1.5 # tolerances, over the session
+
+
+# (scans, gestures, true resting values per scan)
+def drifting():
+    scans, gestures = bc.synthetic()
+    n = len(scans)
+    direction = numpy.where(numpy.arange(bc.CHANNELS) % 2, -bc.DRAW_TOLERANCE, bc.BLOW_TOLERANCE)
+    drift = numpy.linspace(0, DRIFT, n)[:, None] * direction[None, :]
+    return numpy.round(scans + drift).astype(numpy.int32), gestures, bc.REST + drift
+
+
+def run(scans, track):
+    conditioner = sensorfilter.SensorConditioner([bc.REST] * bc.CHANNELS, bc.BLOW_TOLERANCE, bc.DRAW_TOLERANCE,
+                                                 'median', 3, hysteresis=0.3, hold=5)
+    tracker = calibration.RestTracker(conditioner, every=bc.SCAN_RATE // 10) if track else None
+    changes = []
+    spent = 0.0
+    for i in range(len(scans)):
+        changed = conditioner.update(scans[i])
+        if tracker:
+            start = time.time()
+            tracker.update(scans[i], i / bc.SCAN_RATE)
+            spent += time.time() - start
+        for ch in numpy.flatnonzero(changed):
+            changes.append((i, ch, conditioner.state[ch]))
+    return conditioner, tracker, changes, spent / len(scans)
+
+
+def spurious(changes, gestures):
+    inside = set()
+    for ch, first, last, direction in gestures:
+        inside.update((ch, i) for i in range(first, last + 1))
+    return sum(1 for i, ch, state in changes if state != sensorfilter.OFF and (ch, i) not in inside)
+
+
+if __name__ == "__main__":
+    scans, gestures, truth = drifting()
+    print('%d s at %d scans/s, %d gestures, drift up to %.1f tolerances' % (
+        bc.SECONDS, bc.SCAN_RATE, len(gestures), DRIFT))
+    print('%-10s %9s %7s %7s %8s' % ("setting", "spurious", "missed", "error", "us/scan"))
+    for name, track in (('fixed', False), ('tracked', True)):
+        conditioner, tracker, changes, seconds = run(scans, track)
+        missed, onset = bc.gesturestats(scans, [bc.REST] * bc.CHANNELS, gestures, changes)
+        error = numpy.abs(conditioner.resting - truth[-1]).max()
+        print('%-10s %9d %7d %7.1f %8.1f' % (name, spurious(changes, gestures), missed, error, 1e6 * seconds))
+        if tracker:
+            print(tracker.report())
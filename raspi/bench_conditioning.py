@@ -0,0 +1,138 @@
+#
+#  bench_conditioning.py: Sensor conditioning benchmark
+#
+#  Plays noisy sensor input through sensorfilter.SensorConditioner with
+#  each filter and through raw thresholding (filter 'none', no hysteresis,
+#  no hold: what dhp.py did before), and counts what comes out. The input
+#  is either a performance script's adc frames (python bench_conditioning.py
+#  perf.txt) or SECONDS of synthetic scans at SCAN_RATE: every hole rests
+#  with Gaussian ADC noise, takes an occasional one-scan spike, and now and
+#  then a slow breath gesture (blow or draw, rising to a peak, held, falling
+#  back) that is meant to be one note.
+#
+#  For each setting:
+#
+#    events      note on / off changes made
+#    suppressed  changes raw thresholding would have made on top of those
+#    missed      synthetic gestures with no note-on of the right direction
+#    onset       mean delay of the gestures' note-ons after raw crossed,
+#                in scans
+#    us/scan     time of one update() of all channels
+#
+#  usage: python bench_conditioning.py [script]
+#
+
+from __future__ import division
+import sys
+import time
+import numpy
+import sensorfilter
+import offlinerender
+
+SCAN_RATE = 500
+SECONDS = 20
+CHANNELS = 10
+REST = 512
+BLOW_TOLERANCE = 22  # as in dhp.py
+DRAW_TOLERANCE = 20
+NOISE = 6            # ADC noise, standard deviation
+SPIKE_RATE = 0.002   # one-scan spikes per scan and channel
+SPIKE = 40
+GESTURES = 8         # breath gestures per channel
+SETTINGS = [
+    ('raw', 'none', 1, 0.0, 0),
+    ('median 3', 'median', 3, 0.3, 5),
+    ('median 5', 'median', 5, 0.3, 5),
+    ('onepole', 'onepole', 1, 0.3, 5),
+]
+
+
+# (scans, gestures): SECONDS of noisy scans, and the gestures in them as
+# (channel, first scan, last scan, direction)
+def synthetic(seed=0):
+    rng = numpy.random.RandomState(seed)
+    n = SECONDS * SCAN_RATE
+    scans = REST + rng.normal(0, NOISE, (n, CHANNELS))
+    spikes = rng.random_sample((n, CHANNELS)) < SPIKE_RATE
+    scans[spikes] += rng.choice([-SPIKE, SPIKE], spikes.sum())
+    gestures = []
+    slot = n // GESTURES
+    for ch in range(CHANNELS):
+        for g in range(GESTURES):
+            length = rng.randint(slot // 4, slot // 2)
+            first = g * slot + rng.randint(0, slot - length)
+            direction = rng.choice([sensorfilter.BLOW, sensorfilter.DRAW])
+            peak = rng.uniform(2, 6) * (BLOW_TOLERANCE if direction == sensorfilter.BLOW else -DRAW_TOLERANCE)
+            # 50 ms up, held, 50 ms down
+            ramp = min(SCAN_RATE // 20, length // 2)
+            shape = numpy.ones(length)
+            shape[:ramp] = numpy.linspace(0, 1, ramp)
+            shape[length - ramp:] = numpy.linspace(1, 0, ramp)
+            scans[first:first + length, ch] += peak * shape
+            gestures.append((ch, first, first + length - 1, direction))
+    return numpy.round(scans).astype(numpy.int32), gestures
+
+
+# The adc frames of a performance script (no gestures known)
+def recorded(filename):
+    events = offlinerender.readscript(filename)
+    scans = numpy.array([values for seconds, kind, values in events if kind == 'adc'], numpy.int32)
+    rest = offlinerender.restframe(events)
+    return scans, [], rest
+
+
+# (conditioner, [(scan, channel, state)] of its changes, seconds per update)
+def run(scans, rest, filter, window, hysteresis, hold):
+    conditioner = sensorfilter.SensorConditioner(rest, BLOW_TOLERANCE, DRAW_TOLERANCE, filter, window,
+                                                 hysteresis=hysteresis, hold=hold)
+    changes = []
+    start = time.time()
+    for i in range(len(scans)):
+        changed = conditioner.update(scans[i])
+        if changed.any():
+            for ch in numpy.flatnonzero(changed):
+                changes.append((i, ch, conditioner.state[ch]))
+    return conditioner, changes, (time.time() - start) / max(1, len(scans))
+
+
+# (missed gestures, mean onset delay in scans): a gesture is caught by a
+# note-on of its direction on its channel while it lasts
+def gesturestats(scans, rest, gestures, changes):
+    ons = {}
+    for i, ch, state in changes:
+        if state != sensorfilter.OFF:
+            ons.setdefault((ch, state), []).append(i)
+    missed = 0
+    delays = []
+    for ch, first, last, direction in gestures:
+        hits = [i for i in ons.get((ch, direction), []) if first <= i <= last]
+        if not hits:
+            missed += 1
+            continue
+        if direction == sensorfilter.BLOW:
+            crossed = numpy.flatnonzero(scans[first:last + 1, ch] > rest[ch] + BLOW_TOLERANCE)
+        else:
+            crossed = numpy.flatnonzero(scans[first:last + 1, ch] < rest[ch] - DRAW_TOLERANCE)
+        if len(crossed):
+            delays.append(hits[0] - (first + crossed[0]))
+    return missed, numpy.mean(delays) if delays else float('nan')
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        scans, gestures, rest = recorded(sys.argv[1])
+        rest = rest or [REST] * scans.shape[1]
+        print('%s: %d scans of %d channels' % (sys.argv[1], len(scans), scans.shape[1]))
+    else:
+        scans, gestures = synthetic()
+        rest = [REST] * CHANNELS
+        print('synthetic: %d s at %d scans/s, %d channels, %d gestures, noise %d, spikes %.1f%%' % (
+            SECONDS, SCAN_RATE, CHANNELS, len(gestures), NOISE, 100 * SPIKE_RATE))
+    print('%-10s %6s %5s %8s %10s %7s %6s %8s' % (
+        "setting", "hyst", "hold", "events", "suppressed", "missed", "onset", "us/scan"))
+    for name, filter, window, hysteresis, hold in SETTINGS:
+        conditioner, changes, seconds = run(scans, rest, filter, window, hysteresis, hold)
+        missed, onset = gesturestats(scans, rest, gestures, changes)
+        print('%-10s %6.1f %5d %8d %10d %7s %6.1f %8.1f' % (
+            name, hysteresis, hold, conditioner.events, conditioner.suppressed(),
+            missed if gestures else '-', onset, 1e6 * seconds))
@@ -0,0 +1,150 @@
+#
+#  bench_jitter.py: Audio callback jitter under instrument loading
+#
+#  Stress test for the GIL-free mix. A thread stands in for sounddevice:
+#  every block period it wakes up and does what dhp.py's AudioCallback
+#  does (apply the pool's commands, mixvoices, output stage into an
+#  int16 block) with every hole of the harmonica playing. Meanwhile the
+#  main thread either sleeps (idle) or loads 24-bit synthetic instruments
+#  in a loop the way ActuallyLoad does with TRANSPOSE_CACHE_AT_LOAD
+#  (Instrument, wav parsing, 24-bit decode, pre-rendered transposes).
+#
+#  For each mixer backend and load it prints how late the callback
+#  started (waiting for the GIL shows up here), how long it took, and the
+#  blocks that finished after the next one was due (would-be underruns).
+#
+#  usage: python bench_jitter.py [seconds] [blocksize]
+#
+
+from __future__ import division
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import numpy
+import voicepool
+import transposecache
+from latency import clock
+from waveread import waveread
+from instrument import Instrument, noteFiles
+from bench_mixer import FADEOUT, FADEOUTLENGTH, SPEED, SAMPLERATE, HARMONICA_NOTES, HARMONICA_SAMPLE_NOTE, \
+    SyntheticSound, backends
+from bench_loading import makeinstruments
+
+GLOBAL_VOLUME = 10 ** (-10 / 20)
+LIMITER_KNEE = 0.5
+TRANSPOSES = [1, 2] # semitones rendered above every sample while loading
+
+
+# Calls the mix every block period until stopped, recording how late
+# each call started and how long it took
+class CallbackThread(threading.Thread):
+
+    def __init__(self, module, blocksize):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.module = module
+        self.blocksize = blocksize
+        self.period = blocksize / SAMPLERATE
+        self.pool = voicepool.VoicePool(len(HARMONICA_NOTES), FADEOUT)
+        sound = SyntheticSound(HARMONICA_SAMPLE_NOTE, loop=1000)
+        for note in HARMONICA_NOTES:
+            self.pool.noteon(sound, note, SPEED[note - HARMONICA_SAMPLE_NOTE], 100)
+        self.mixbuffer = numpy.zeros(2 * blocksize, numpy.float32)
+        self.outdata = numpy.zeros((blocksize, 2), numpy.int16)
+        self.dither = numpy.zeros(1, numpy.uint32)
+        self.late = []
+        self.duration = []
+        self.stopped = False
+
+    def callback(self):
+        self.pool.apply(self.blocksize)
+        b = self.module.mixvoices(self.pool, self.blocksize, FADEOUT, FADEOUTLENGTH, 1, self.mixbuffer)
+        self.module.outputstage(b, self.outdata, GLOBAL_VOLUME, LIMITER_KNEE, self.dither)
+
+    def run(self):
+        due = clock() + self.period
+        while not self.stopped:
+            delay = due - clock()
+            if delay > 0:
+                time.sleep(delay)
+            start = clock()
+            self.callback()
+            self.late.append(start - due)
+            self.duration.append(clock() - start)
+            due += self.period
+            if clock() > due + self.period: # fell a whole block behind: resynchronise
+                due = clock() + self.period
+
+    def stats(self):
+        late = numpy.array(self.late)
+        duration = numpy.array(self.duration)
+        return {
+            'blocks': len(late),
+            'late p50': numpy.percentile(late, 50),
+            'late p99': numpy.percentile(late, 99),
+            'late max': late.max(),
+            'mix p99': numpy.percentile(duration, 99),
+            'misses': int(numpy.count_nonzero(late + duration > self.period)),
+        }
+
+
+# Loads every note of dirname like ActuallyLoad, rendering TRANSPOSES
+# of each one like the transposition cache does at load time
+def load(dirname, module):
+    Instrument(dirname)
+    files = noteFiles(dirname)
+    for midinote in sorted(files):
+        wf = waveread(os.path.join(dirname, files[midinote]))
+        raw = wf.readframes(wf.getnframes())
+        if wf.getsampwidth() == 3:
+            data = module.binary24_to_int16(raw, len(raw) // 3)
+        else:
+            data = numpy.frombuffer(raw, numpy.int16)
+        for semitones in TRANSPOSES:
+            transposecache.render(data, wf.getnchannels(), len(data) // wf.getnchannels(), -1,
+                                  2 ** (semitones / 12))
+        wf.close()
+
+
+# Runs the callback thread for seconds while the main thread idles or
+# loads the instruments in dirs round and round
+def measure(module, blocksize, seconds, dirs=None):
+    thread = CallbackThread(module, blocksize)
+    thread.start()
+    end = clock() + seconds
+    loads = 0
+    while clock() < end:
+        if dirs:
+            load(dirs[loads % len(dirs)], module)
+            loads += 1
+        else:
+            time.sleep(0.05)
+    thread.stopped = True
+    thread.join()
+    result = thread.stats()
+    result['loads'] = loads
+    return result
+
+
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5.0
+    blocksize = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    samplesdir = tempfile.mkdtemp()
+    try:
+        makeinstruments(samplesdir, 3, 10, sampwidth=3)
+        dirs = [os.path.join(samplesdir, d) for d in sorted(os.listdir(samplesdir))]
+        print('blocksize %d (%.2f ms), %d holes playing, %.0f s per run' % (
+            blocksize, 1000 * blocksize / SAMPLERATE, len(HARMONICA_NOTES), seconds))
+        print('%-8s %-8s %7s %6s %12s %12s %12s %12s %7s' % (
+            "backend", "load", "blocks", "loads", "late p50 ms", "late p99 ms", "late max ms", "mix p99 ms", "misses"))
+        for name, module in backends():
+            for label, loading in (("idle", None), ("loading", dirs)):
+                s = measure(module, blocksize, seconds, loading)
+                print('%-8s %-8s %7d %6d %12.3f %12.3f %12.3f %12.3f %7d' % (
+                    name, label, s['blocks'], s['loads'], 1000 * s['late p50'], 1000 * s['late p99'],
+                    1000 * s['late max'], 1000 * s['mix p99'], s['misses']))
+    finally:
+        shutil.rmtree(samplesdir)
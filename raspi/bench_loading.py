@@ -0,0 +1,169 @@
+#
+#  bench_loading.py: Instrument loading benchmark
+#
+#  Builds a samples directory of synthetic instruments and times loading
+#  every instrument from its raw wav directory and from its compiled bank
+#  (bankpack.py), warm (files in the page cache) and cold (page cache
+#  dropped, needs root; skipped otherwise). Then times the startup scan of
+#  the instrument directories: an Instrument and a noteFiles() listing per
+#  directory, against instrumentindex.InstrumentIndex cold (no index file)
+#  and warm, and checks that loading an instrument through a warm index
+#  lists no directory.
+#
+#  usage: python bench_loading.py [instruments] [notes per instrument]
+#
+
+from __future__ import division
+import os
+import sys
+import time
+import wave
+import shutil
+import tempfile
+import numpy
+import bankpack
+import samplestore
+import instrumentindex
+from waveread import waveread
+from instrument import Instrument, noteFiles
+
+SAMPLERATE = 44100
+
+
+# sampwidth 2 (16-bit) or 3 (24-bit) mono wav files, every 3rd note
+def makeinstruments(samplesdir, ninstruments, nnotes, seconds=2.0, sampwidth=2):
+    rng = numpy.random.RandomState(0)
+    for i in range(ninstruments):
+        dirname = os.path.join(samplesdir, "%d Synthetic" % i)
+        os.mkdir(dirname)
+        for midinote in range(36, 36 + 3 * nnotes, 3):
+            data = rng.randint(-8000, 8000, int(seconds * SAMPLERATE))
+            if sampwidth == 3:
+                frames = (data * 256).astype('<i4').view(numpy.uint8).reshape(-1, 4)[:, :3].tobytes()
+            else:
+                frames = data.astype(numpy.int16).tobytes()
+            wf = wave.open(os.path.join(dirname, "%d.wav" % midinote), 'wb')
+            wf.setnchannels(1)
+            wf.setsampwidth(sampwidth)
+            wf.setframerate(SAMPLERATE)
+            wf.writeframes(frames)
+            wf.close()
+
+
+# Loads every note of dirname the way Instrument and Sound do,
+# touching all the data
+def loadraw(dirname):
+    Instrument(dirname)
+    files = noteFiles(dirname)
+    datas = []
+    for midinote in sorted(files):
+        wf = waveread(os.path.join(dirname, files[midinote]))
+        datas.append(samplestore.mapdata(os.path.join(dirname, files[midinote]),
+                                         wf.getdataoffset(), wf.getnframes() * wf.getnchannels()))
+        wf.close()
+    samplestore.prefault(datas)
+    return len(datas)
+
+
+def loadpack(dirname):
+    pack = bankpack.openbank(dirname)
+    datas = [entry['data'] for entry in pack['samples']]
+    samplestore.prefault(datas)
+    return len(datas)
+
+
+def dropcaches():
+    try:
+        os.system("sync")
+        with open("/proc/sys/vm/drop_caches", "w") as f:
+            f.write("3\n")
+        return True
+    except (IOError, OSError):
+        return False
+
+
+# Every instrument's note mapping and listing, the way dhp.py got them
+# before the index
+def scanglob(samplesdir, names):
+    for name in names:
+        Instrument(os.path.join(samplesdir, name))
+        noteFiles(os.path.join(samplesdir, name))
+
+
+# The same through an instrument index (cold: its file removed first)
+def scanindex(samplesdir, names, cold):
+    if cold and os.path.exists(os.path.join(samplesdir, instrumentindex.INDEXNAME)):
+        os.remove(os.path.join(samplesdir, instrumentindex.INDEXNAME))
+    index = instrumentindex.InstrumentIndex(samplesdir)
+    index.refresh(names)
+    for name in names:
+        index.instrument(name)
+        index.notes(name)
+    return index
+
+
+# Directories listed while f runs
+def countlistings(f):
+    calls = []
+    listdir = os.listdir
+    def counting(path):
+        calls.append(path)
+        return listdir(path)
+    os.listdir = counting
+    try:
+        f()
+    finally:
+        os.listdir = listdir
+    return len(calls)
+
+
+def timeload(load, dirs, cold):
+    if cold and not dropcaches():
+        return None
+    start = time.time()
+    for dirname in dirs:
+        load(dirname)
+    return time.time() - start
+
+
+if __name__ == "__main__":
+    ninstruments = int(sys.argv[1]) if len(sys.argv) > 1 else 15
+    nnotes = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    samplesdir = tempfile.mkdtemp()
+    try:
+        makeinstruments(samplesdir, ninstruments, nnotes)
+        dirs = bankpack.instrumentdirs(samplesdir)
+        start = time.time()
+        for dirname in dirs:
+            bankpack.compilebank(dirname)
+        print('%d instruments x %d notes, compiled in %.2f s' % (ninstruments, nnotes, time.time() - start))
+        print('%-8s %12s %12s' % ("source", "warm ms", "cold ms"))
+        for name, load in (("raw", loadraw), ("pack", loadpack)):
+            timeload(load, dirs, False) # fill the page cache
+            warm = timeload(load, dirs, False)
+            cold = timeload(load, dirs, True)
+            print('%-8s %12.1f %12s' % (name, warm * 1000, "%.1f" % (cold * 1000) if cold is not None else "n/a (root)"))
+
+        # Old enough for the index to trust their mtimes
+        for dirname in dirs:
+            os.utime(dirname, (time.time() - 60, time.time() - 60))
+        names = [os.path.basename(dirname) for dirname in dirs]
+        print('%-12s %10s' % ("scan", "ms"))
+        for name, scan in (("glob", lambda: scanglob(samplesdir, names)),
+                           ("index cold", lambda: scanindex(samplesdir, names, True)),
+                           ("index warm", lambda: scanindex(samplesdir, names, False))):
+            start = time.time()
+            scan()
+            print('%-12s %10.2f' % (name, (time.time() - start) * 1000))
+        index = scanindex(samplesdir, names, False)
+        print(index.report())
+
+        # What ActuallyLoad does for every instrument: a warm index gives
+        # the same notes as a listing, without listing anything
+        listings = countlistings(lambda: [index.notes(name) for name in names])
+        print('index notes: %d directory listings' % listings)
+        assert listings == 0
+        for name in names:
+            assert index.notes(name) == noteFiles(os.path.join(samplesdir, name))
+    finally:
+        shutil.rmtree(samplesdir)
@@ -0,0 +1,279 @@
+#
+#  bench_mixer.py: Mixer benchmark
+#
+#  Mixes synthetic sounds with every available mixer backend and prints
+#  how many frames per second each one can mix at 1, 5, 25 and 64 voices.
+#  Also checks that the backends produce identical output, and measures
+#  the mixing time saved by the transposition cache, the callback time
+#  added by breath expression, and the cost per voice of each
+#  interpolation tier on a 10-note layout, the fused output stage against
+#  the old volume-then-cast passes, and finally the largest polyphony
+#  that fits the callback budget with 1 to 4 mixer threads.
+#
+#  usage: python bench_mixer.py [blocksize]
+#
+
+from __future__ import division
+import sys
+import time
+import numpy
+import numpy_mixer
+import transposecache
+import voicepool
+import interpolation
+
+FADEOUTLENGTH = 40000
+FADEOUT = numpy.linspace(1., 0., FADEOUTLENGTH)
+FADEOUT = numpy.power(FADEOUT, 6)
+FADEOUT = numpy.append(FADEOUT, numpy.zeros(FADEOUTLENGTH, numpy.float32)).astype(numpy.float32)
+SPEED = numpy.power(2, numpy.append(numpy.arange(0.0, 84.0), numpy.arange(-84.0, 0.0))/12).astype(numpy.float32)
+
+VOICE_COUNTS = [1, 5, 25, 64]
+SAMPLERATE = 44100
+# Richter blow notes of the 10 holes, all transposed from one sample
+HARMONICA_NOTES = [36, 40, 43, 48, 52, 55, 60, 64, 67, 72]
+HARMONICA_SAMPLE_NOTE = 48
+
+
+# Stand-in for Sound: 2 seconds of stereo noise, optionally looped
+class SyntheticSound:
+
+    def __init__(self, midinote, nframes=2*SAMPLERATE, loop=-1, seed=0):
+        rng = numpy.random.RandomState(seed)
+        self.fname = "synthetic"
+        self.midinote = midinote
+        self.loop = loop
+        self.nframes = nframes
+        self.data = rng.randint(-8000, 8000, 2 * nframes).astype(numpy.int16)
+
+
+# Stand-in for PlayingSound
+class SyntheticVoice:
+
+    def __init__(self, sound, note, velocity):
+        self.sound = sound
+        self.pos = 0
+        self.fadeoutpos = 0
+        self.isfadeout = False
+        self.note = note
+        self.velocity = velocity
+
+
+def backends():
+    found = [("numpy", numpy_mixer)]
+    try:
+        import samplerbox_audio
+        found.insert(0, ("cython", samplerbox_audio))
+    except ImportError:
+        print('samplerbox_audio not compiled, benchmarking numpy only')
+    return found
+
+
+def makevoices(n):
+    sound = SyntheticSound(60, loop=1000)
+    return [SyntheticVoice(sound, 60 + (v % 12), 100) for v in range(n)]
+
+
+# Returns mixed frames per second (wall clock)
+def framespersecond(module, voices, blocksize, seconds=0.5):
+    frames = 0
+    start = time.time()
+    while time.time() - start < seconds:
+        rmlist = []
+        module.mixaudiobuffers(voices, rmlist, blocksize, FADEOUT, FADEOUTLENGTH, SPEED)
+        frames += blocksize
+    return frames / (time.time() - start)
+
+
+# Mixes the same voices with every backend and compares the buffers
+# (None when there is only one backend to compare)
+def checkidentical(found, blocksize, nvoices=8, nblocks=50):
+    if len(found) < 2:
+        return None
+    sets = [makevoices(nvoices) for _ in found]
+    for blk in range(nblocks):
+        if blk == nblocks // 2:
+            for voices in sets:
+                for v in voices[::2]:
+                    v.isfadeout = True
+        out = [m.mixaudiobuffers(voices, [], blocksize, FADEOUT, FADEOUTLENGTH, SPEED)
+               for (name, m), voices in zip(found, sets)]
+        if any(not numpy.array_equal(out[0], o) for o in out[1:]):
+            return False
+    return True
+
+
+# Returns mean seconds per callback for the given voices
+def callbacktime(module, voices, blocksize, nblocks=200):
+    start = time.time()
+    for blk in range(nblocks):
+        module.mixaudiobuffers(voices, [], blocksize, FADEOUT, FADEOUTLENGTH, SPEED)
+    return (time.time() - start) / nblocks
+
+
+# Plays every hole of the harmonica with and without the transposition cache
+def benchtranspose(module, blocksize, notesplayed=200):
+    sound = SyntheticSound(HARMONICA_SAMPLE_NOTE, loop=1000)
+    sound.fname = "synthetic.wav"
+    cache = transposecache.TransposeCache(background=False)
+    for i in range(notesplayed):
+        cache.lookup(sound, HARMONICA_NOTES[i % len(HARMONICA_NOTES)])
+    plain = [SyntheticVoice(sound, note, 100) for note in HARMONICA_NOTES]
+    cached = [SyntheticVoice(cache.lookup(sound, note), note, 100) for note in HARMONICA_NOTES]
+    return callbacktime(module, plain, blocksize), callbacktime(module, cached, blocksize), cache.stats()
+
+
+# Plays every hole of the harmonica from a voice pool. With expression,
+# every block follows a new breath pressure for each hole (as after one or
+# more sensor scans). Returns mean seconds per callback (apply + mix) and
+# mean seconds per scan update (express)
+def benchexpression(module, blocksize, expression, nblocks=200):
+    sound = SyntheticSound(HARMONICA_SAMPLE_NOTE, loop=1000)
+    pool = voicepool.VoicePool(len(HARMONICA_NOTES), FADEOUT)
+    for note in HARMONICA_NOTES:
+        pool.noteon(sound, note, SPEED[note - HARMONICA_SAMPLE_NOTE], 100)
+    notes = numpy.array(HARMONICA_NOTES)
+    gains = numpy.linspace(0.2, 1.0, nblocks).astype(numpy.float32)
+    callback = 0.0
+    scan = 0.0
+    for blk in range(nblocks):
+        if expression:
+            start = time.time()
+            pool.express(notes, numpy.roll(gains, blk)[:len(notes)])
+            scan += time.time() - start
+        start = time.time()
+        pool.apply(blocksize)
+        module.mixvoices(pool, blocksize, FADEOUT, FADEOUTLENGTH)
+        callback += time.time() - start
+    return callback / nblocks, scan / nblocks
+
+
+# Plays every hole of the harmonica, all transposed from one sample (0.5x
+# to 2x speed), with the given interpolation tier. Returns mean seconds
+# per callback
+def benchinterpolation(module, blocksize, tier, nblocks=200):
+    sound = SyntheticSound(HARMONICA_SAMPLE_NOTE, loop=1000)
+    sound.interpolation = tier
+    pool = voicepool.VoicePool(len(HARMONICA_NOTES), FADEOUT)
+    for note in HARMONICA_NOTES:
+        pool.noteon(sound, note, SPEED[note - HARMONICA_SAMPLE_NOTE], 100)
+    pool.apply(blocksize)
+    start = time.time()
+    for blk in range(nblocks):
+        module.mixvoices(pool, blocksize, FADEOUT, FADEOUTLENGTH)
+    return (time.time() - start) / nblocks
+
+
+# Mean seconds to turn a mixed block into int16 output: the two passes
+# AudioCallback used to make (b *= volume, then a casting copy), or
+# outputstage (volume, soft limiter, optional dither and int16 in one)
+def benchoutput(module, blocksize, fused, dither, nblocks=2000):
+    rng = numpy.random.RandomState(0)
+    mixed = (rng.randn(2 * blocksize) * 20000).astype(numpy.float32)
+    b = numpy.empty_like(mixed)
+    outdata = numpy.zeros((blocksize, 2), numpy.int16)
+    state = numpy.zeros(1, numpy.uint32) if dither else None
+    volume = 10 ** (-12 / 20)
+    start = time.time()
+    for blk in range(nblocks):
+        b[:] = mixed # both paths scale the block in place
+        if fused:
+            module.outputstage(b, outdata, volume, 0.5, state)
+        else:
+            b *= volume
+            outdata[:] = b.reshape(outdata.shape)
+    return (time.time() - start) / nblocks
+
+
+# Largest number of transposed looping voices whose 95th percentile
+# callback time stays within budget (a fraction of the block deadline)
+# when mixed by the given number of threads (at most limit)
+def maxpolyphony(module, blocksize, workers, budget=0.7, nblocks=50, limit=4096):
+    sound = SyntheticSound(60, loop=1000)
+    deadline = blocksize / SAMPLERATE * budget
+    module.startworkers(workers)
+
+    def fits(n):
+        pool = voicepool.VoicePool(n, FADEOUT)
+        for v in range(n):
+            note = 61 + v % 11
+            pool.noteon(sound, note, SPEED[note - 60], 100)
+        pool.apply(blocksize)
+        times = []
+        for blk in range(nblocks):
+            start = time.time()
+            module.mixvoices(pool, blocksize, FADEOUT, FADEOUTLENGTH, workers)
+            times.append(time.time() - start)
+        return numpy.percentile(times, 95) <= deadline
+
+    if not fits(1):
+        return 0
+    low, high = 1, 2
+    while high <= limit and fits(high):
+        low, high = high, high * 2
+    high = min(high, limit + 1)
+    while high - low > 1:
+        middle = (low + high) // 2
+        if fits(middle):
+            low = middle
+        else:
+            high = middle
+    return low
+
+
+if __name__ == "__main__":
+    blocksize = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    found = backends()
+    print('blocksize %d, realtime = %d frames/s' % (blocksize, SAMPLERATE))
+    print('%-8s %8s %14s %10s' % ("backend", "voices", "frames/s", "x realtime"))
+    for name, module in found:
+        for n in VOICE_COUNTS:
+            fps = framespersecond(module, makevoices(n), blocksize)
+            print('%-8s %8d %14.0f %10.1f' % (name, n, fps, fps / SAMPLERATE))
+    identical = checkidentical(found, blocksize)
+    print('backends identical: %s' % ("skipped (samplerbox_audio not compiled)" if identical is None else identical))
+
+    print('')
+    print('transposition cache, %d holes playing' % len(HARMONICA_NOTES))
+    print('%-8s %14s %14s %14s' % ("backend", "uncached us", "cached us", "saved us"))
+    for name, module in found:
+        plain, cached, stats = benchtranspose(module, blocksize)
+        print('%-8s %14.1f %14.1f %14.1f' % (name, plain * 1e6, cached * 1e6, (plain - cached) * 1e6))
+    print('hit rate %.1f%%, %d renders (%.1f ms), %d bytes' % (
+        100 * stats['hitrate'], stats['renders'], 1000 * stats['rendertime'], stats['bytes']))
+
+    print('')
+    print('breath expression, %d holes playing' % len(HARMONICA_NOTES))
+    print('%-8s %14s %14s %14s %14s' % ("backend", "static us", "expressive us", "added us", "per scan us"))
+    for name, module in found:
+        static, _ = benchexpression(module, blocksize, False)
+        expressive, scan = benchexpression(module, blocksize, True)
+        print('%-8s %14.1f %14.1f %14.1f %14.1f' % (name, static * 1e6, expressive * 1e6, (expressive - static) * 1e6, scan * 1e6))
+
+    print('')
+    print('interpolation, %d holes playing, transposed from one sample' % len(HARMONICA_NOTES))
+    print('%-8s %-8s %14s %14s %12s' % ("backend", "tier", "callback us", "per voice us", "x linear"))
+    for name, module in found:
+        linear = benchinterpolation(module, blocksize, interpolation.LINEAR)
+        for tier in sorted(interpolation.TIERS, key=interpolation.TIERS.get):
+            t = benchinterpolation(module, blocksize, interpolation.TIERS[tier])
+            print('%-8s %-8s %14.1f %14.1f %12.1f' % (name, tier, t * 1e6, t * 1e6 / len(HARMONICA_NOTES), t / linear))
+
+    print('')
+    print('output stage (gain, limiter, dither, int16)')
+    print('%-8s %14s %14s %14s' % ("backend", "two-pass us", "fused us", "+dither us"))
+    for name, module in found:
+        print('%-8s %14.1f %14.1f %14.1f' % (name, 1e6 * benchoutput(module, blocksize, False, False),
+                                            1e6 * benchoutput(module, blocksize, True, False),
+                                            1e6 * benchoutput(module, blocksize, True, True)))
+
+    print('')
+    print('polyphony within 70%% of the %.1f ms callback deadline' % (1000 * blocksize / SAMPLERATE))
+    print('%-8s %8s %12s %10s' % ("backend", "threads", "max voices", "x 1 thread"))
+    for name, module in found:
+        if name != "cython":
+            continue # the numpy mixer has no threads
+        single = maxpolyphony(module, blocksize, 1)
+        for workers in range(1, 5):
+            n = single if workers == 1 else maxpolyphony(module, blocksize, workers)
+            print('%-8s %8d %12d %10.2f' % (name, workers, n, n / max(single, 1)))
@@ -0,0 +1,91 @@
+#
+#  bench_sensors.py: Sensor acquisition benchmark
+#
+#  Compares the achievable scan rate (frames of 10 sensors per second) of
+#  the per-channel read_adc loop in dhp.py with adcscan.ADCScanner.
+#  Uses FakeSpiDev unless --hardware is given, in which case both ADCs on
+#  SPI bus 0 are read for real. The fake is run twice: with no transaction
+#  cost and with SPI_LATENCY per transaction on a SPI_HZ bus, a rough model
+#  of spidev on a Raspberry Pi. The free fake simulates the chip in Python,
+#  which costs the burst more than the scan itself, so a no-op bus (every
+#  transaction does nothing) shows the overhead of each scan alone.
+#
+#  usage: python bench_sensors.py [--hardware]
+#
+
+from __future__ import division
+import sys
+import time
+import adcscan
+
+CHANNELS = [range(5), range(5)]
+SPI_LATENCY = 25e-6 # seconds per ioctl round trip
+SPI_HZ = 500000     # Adafruit_GPIO.SPI.SpiDev default clock
+
+
+# Adafruit_MCP3008.MCP3008 when it is installed, otherwise the same
+# per-channel transaction
+try:
+    from Adafruit_MCP3008 import MCP3008
+except ImportError:
+    class MCP3008:
+        def __init__(self, spi):
+            self._spi = spi
+
+        def read_adc(self, ch):
+            return adcscan.decode(self._spi.transfer([adcscan.command(ch), 0x0, 0x0]))
+
+
+# SPI bus whose transactions take no time and read zeros
+class NullSpiDev:
+    def transfer(self, data):
+        return [0, 0, 0]
+
+    def burst(self, tx, rx, segment, offset=0):
+        pass
+
+
+def perchannelscan(mcps):
+    values = [0] * 10
+    for ch in CHANNELS[0]:
+        values[ch] = mcps[0].read_adc(ch)
+    for ch in CHANNELS[1]:
+        values[ch + 5] = mcps[1].read_adc(ch)
+    return values
+
+
+# Returns scans per second
+def scanrate(scan, seconds=1.0):
+    n = 0
+    start = time.time()
+    while time.time() - start < seconds:
+        scan()
+        n += 1
+    return n / (time.time() - start)
+
+
+def compare(mcps, scanner):
+    return scanrate(lambda: perchannelscan(mcps)), scanrate(scanner.scan)
+
+
+if __name__ == "__main__":
+    results = []
+    if "--hardware" in sys.argv:
+        import Adafruit_GPIO.SPI as SPI
+        mcps = [MCP3008(spi=SPI.SpiDev(0, 1)), MCP3008(spi=SPI.SpiDev(0, 0))]
+        scanner = adcscan.ADCScanner([adcscan.SpiDev(0, 1), adcscan.SpiDev(0, 0)], CHANNELS)
+        results.append(("hardware", compare(mcps, scanner)))
+    else:
+        for name, latency, hz in (("fake, free", 0.0, None), ("fake, Pi-like", SPI_LATENCY, SPI_HZ)):
+            fakes = [adcscan.FakeSpiDev(range(500, 508), latency, hz),
+                     adcscan.FakeSpiDev(range(600, 608), latency, hz)]
+            mcps = [MCP3008(spi=fakes[0]), MCP3008(spi=fakes[1])]
+            scanner = adcscan.ADCScanner(fakes, CHANNELS)
+            assert list(scanner.scan()[0]) == perchannelscan(mcps)
+            results.append((name, compare(mcps, scanner)))
+        nulls = [NullSpiDev(), NullSpiDev()]
+        results.append(("no-op bus", compare([MCP3008(spi=nulls[0]), MCP3008(spi=nulls[1])],
+                                             adcscan.ADCScanner(nulls, CHANNELS))))
+    print('%-14s %14s %14s %8s' % ("devices", "per-channel/s", "burst/s", "speedup"))
+    for name, (perchannel, burst) in results:
+        print('%-14s %14.0f %14.0f %8.2f' % (name, perchannel, burst, burst / perchannel))
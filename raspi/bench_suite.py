@@ -0,0 +1,314 @@
+#
+#  bench_suite.py: Mixer regression benchmark
+#
+#  Times one block of mixing over a sweep of
+#
+#    voices      1, 5, 25, 64
+#    blocksize   64 to 2048 frames
+#    pitch       unity, transposed up a fifth, transposed down a fourth
+#                (SPEED table entries, i.e. interpolated or straight copy)
+#    sample      looping or one-shot
+#    state       sustained or in the release fadeout
+#
+#  for every mixer backend, through these paths:
+#
+#    list      samplerbox_audio.mixaudiobuffers (samplerbox.py)
+#    pool      samplerbox_audio.mixvoices (dhp.py)
+#    callback  what dhp.py's AudioCallback does around mixvoices (into a
+#              reused buffer): apply the queued commands and gain ramps,
+#              then the output stage (volume, limiter, dither, int16)
+#              (unity looping sustained voices only, the rest is the pool
+#              path's business)
+#    cubic     mixvoices with the cubic and sinc interpolation tiers
+#    sinc      (transposed looping sustained voices only)
+#
+#  Every case mixes the same voices from the same state block after block
+#  (the state is restored between blocks, outside the timing) and takes the
+#  median time per block. The whole sweep is run ROUNDS times, interleaved,
+#  and each case keeps its fastest median (in microseconds): a burst of
+#  background activity then only spoils one round.
+#
+#  Results are written as JSON (--output) and compared with a baseline
+#  saved by an earlier run on the same machine (--save-baseline). A case
+#  slower than the baseline by more than --tolerance is a regression and
+#  the run exits with status 1, so a mixer change that slows the Pi down
+#  fails the run. Baselines are only comparable on the machine (and
+#  backend build) that recorded them: record one on the Pi. Without a
+#  baseline the run stops at once with status 2 rather than passing
+#  unchecked; bench_baseline.json is machine-local and not committed.
+#
+#  usage: python bench_suite.py [--quick] [--backend cython|numpy]
+#                               [--output results.json]
+#                               [--baseline bench_baseline.json]
+#                               [--save-baseline] [--rounds 3]
+#                               [--tolerance 0.15]
+#
+
+from __future__ import division
+import sys
+import os
+import json
+import time
+import platform
+import argparse
+import numpy
+import numpy_mixer
+import voicepool
+import interpolation
+from latency import clock
+from bench_mixer import FADEOUT, FADEOUTLENGTH, SPEED, SAMPLERATE, SyntheticSound, SyntheticVoice
+
+VOICE_COUNTS = [1, 5, 25, 64]
+BLOCKSIZES = [64, 128, 256, 512, 1024, 2048]
+PITCHES = [('unity', 0), ('up', 7), ('down', -5)] # semitones from the sample
+SAMPLES = ['loop', 'oneshot']
+STATES = ['sustain', 'fadeout']
+QUICK_VOICE_COUNTS = [1, 25]
+QUICK_BLOCKSIZES = [64, 256, 2048]
+
+SAMPLE_NOTE = 60
+GLOBAL_VOLUME = 10 ** (-10 / 20)
+LIMITER_KNEE = 0.5
+MIN_BLOCKS = 15
+MIN_SECONDS = 0.02
+MAX_BLOCKS = 200
+ROUNDS = 3
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+
+
+def key(backend, path, voices, blocksize, pitch, sample, state):
+    return '%s/%s/v%d/b%d/%s/%s/%s' % (backend, path, voices, blocksize, pitch, sample, state)
+
+
+# Voices spread over the first half of the sound, so they do not all read
+# the same frames; fadeout voices are already 1000 frames into the release
+def startpositions(n, sound):
+    return [(v * 7919) % (sound.nframes // 2) for v in range(n)]
+
+
+# Returns the median seconds of step(), calling reset() before each one
+def timeblocks(step, reset):
+    times = []
+    started = clock()
+    while len(times) < MAX_BLOCKS and (len(times) < MIN_BLOCKS or clock() - started < MIN_SECONDS):
+        reset()
+        start = clock()
+        step()
+        times.append(clock() - start)
+    return float(numpy.median(times))
+
+
+def listcase(module, n, blocksize, semitones, sound, fadeout):
+    voices = [SyntheticVoice(sound, SAMPLE_NOTE + semitones, 100) for v in range(n)]
+    positions = startpositions(n, sound)
+
+    def reset():
+        for v, pos in zip(voices, positions):
+            v.pos = pos
+            v.isfadeout = fadeout
+            v.fadeoutpos = 1000 if fadeout else 0
+
+    def step():
+        module.mixaudiobuffers(voices, [], blocksize, FADEOUT, FADEOUTLENGTH, SPEED)
+    return step, reset
+
+
+def makepool(n, semitones, sound, fadeout):
+    pool = voicepool.VoicePool(n, FADEOUT)
+    for v in range(n):
+        pool.noteon(sound, SAMPLE_NOTE + semitones, SPEED[semitones], 100)
+    pool.apply(1)
+    live = numpy.flatnonzero(pool.active)
+    pool.pos[live] = startpositions(n, sound)
+    if fadeout:
+        pool.fading[live] = 1
+        pool.fadepos[live] = 1000
+    saved = dict((name, getattr(pool, name).copy()) for name in
+                 ('active', 'fading', 'pos', 'gain', 'target', 'ramp', 'fadepos'))
+
+    def reset():
+        for name, value in saved.items():
+            getattr(pool, name)[:] = value
+    return pool, reset
+
+
+def poolcase(module, n, blocksize, semitones, sound, fadeout):
+    pool, reset = makepool(n, semitones, sound, fadeout)
+
+    def step():
+        module.mixvoices(pool, blocksize, FADEOUT, FADEOUTLENGTH)
+    return step, reset
+
+
+def callbackcase(module, n, blocksize, semitones, sound, fadeout):
+    pool, reset = makepool(n, semitones, sound, fadeout)
+    mixbuffer = numpy.zeros(2 * blocksize, numpy.float32)
+    outdata = numpy.zeros((blocksize, 2), numpy.int16)
+    dither = numpy.zeros(1, numpy.uint32)
+
+    def step():
+        pool.apply(blocksize)
+        b = module.mixvoices(pool, blocksize, FADEOUT, FADEOUTLENGTH, 1, mixbuffer)
+        module.outputstage(b, outdata, GLOBAL_VOLUME, LIMITER_KNEE, dither)
+    return step, reset
+
+
+# Returns the cases of the sweep as [(key, case function, arguments)]
+def sweep(found, voicecounts, blocksizes):
+    sounds = {'loop': SyntheticSound(SAMPLE_NOTE, loop=1000), 'oneshot': SyntheticSound(SAMPLE_NOTE)}
+    tiered = {}
+    for tier in ('cubic', 'sinc'):
+        tiered[tier] = SyntheticSound(SAMPLE_NOTE, loop=1000)
+        tiered[tier].interpolation = interpolation.tier(tier)
+    cases = []
+    for backend, module in found:
+        for n in voicecounts:
+            for blocksize in blocksizes:
+                cases.append((key(backend, 'callback', n, blocksize, 'unity', 'loop', 'sustain'), callbackcase,
+                              (module, n, blocksize, 0, sounds['loop'], False)))
+                for pitch, semitones in PITCHES:
+                    for sample in SAMPLES:
+                        for state in STATES:
+                            arguments = (module, n, blocksize, semitones, sounds[sample], state == 'fadeout')
+                            cases.append((key(backend, 'list', n, blocksize, pitch, sample, state), listcase, arguments))
+                            cases.append((key(backend, 'pool', n, blocksize, pitch, sample, state), poolcase, arguments))
+                for tier, sound in sorted(tiered.items()):
+                    for pitch, semitones in PITCHES[1:]:
+                        cases.append((key(backend, tier, n, blocksize, pitch, 'loop', 'sustain'), poolcase,
+                                      (module, n, blocksize, semitones, sound, False)))
+    return cases
+
+
+# Times the cases; returns {key: microseconds per block}
+def run(cases, rounds=ROUNDS, progress=None):
+    results = {}
+    for r in range(rounds):
+        for i, (k, case, arguments) in enumerate(cases):
+            step, reset = case(*arguments)
+            results[k] = min(results.get(k, float('inf')), timeblocks(step, reset) * 1e6)
+            if progress:
+                progress(r * len(cases) + i + 1, rounds * len(cases))
+    return results
+
+
+# Returns [(key, baseline us, current us, ratio)] of the cases in both,
+# and the keys only in one of them
+def compare(results, baseline):
+    common = sorted(set(results) & set(baseline))
+    rows = [(k, baseline[k], results[k], results[k] / baseline[k] if baseline[k] > 0 else 1.0) for k in common]
+    missing = sorted(set(baseline) - set(results))
+    new = sorted(set(results) - set(baseline))
+    return rows, missing, new
+
+
+def environment():
+    return {'python': platform.python_version(), 'numpy': numpy.__version__, 'machine': platform.machine(),
+            'node': platform.node(), 'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'samplerate': SAMPLERATE}
+
+
+def summary(results):
+    lines = ['%-8s %-9s %6s %10s %10s %10s' % ("backend", "path", "voices", "blocksize", "worst us", "worst load")]
+    groups = {}
+    for k, us in results.items():
+        backend, path, voices, blocksize = k.split('/')[:4]
+        group = (backend, path, int(voices[1:]), int(blocksize[1:]))
+        groups[group] = max(groups.get(group, 0.0), us)
+    for (backend, path, voices, blocksize), us in sorted(groups.items()):
+        deadline = blocksize / SAMPLERATE * 1e6
+        lines.append('%-8s %-9s %6d %10d %10.1f %9.0f%%' % (backend, path, voices, blocksize, us, 100 * us / deadline))
+    return '\n'.join(lines)
+
+
+def save(document, filename):
+    text = json.dumps(document, indent=1, sort_keys=True)
+    if filename == '-':
+        print(text)
+    else:
+        with open(filename, 'w') as f:
+            f.write(text + '\n')
+
+
+# Compares results with the baseline file, timing the slower cases again
+# first. Returns the regressions
+def check(results, cases, baselinefile, tolerance, rounds, say, progress):
+    with open(baselinefile) as f:
+        baseline = json.load(f)
+    rows, missing, new = compare(results, baseline['results'])
+    regressions = [row for row in rows if row[3] > 1 + tolerance]
+    if regressions:
+        # One slow round is noise: only fail on cases that stay slow
+        suspects = set(row[0] for row in regressions)
+        sys.stderr.write('timing %d slower cases again\n' % len(suspects))
+        again = run([case for case in cases if case[0] in suspects], rounds, progress)
+        for k, us in again.items():
+            results[k] = min(results[k], us)
+        rows, missing, new = compare(results, baseline['results'])
+        regressions = [row for row in rows if row[3] > 1 + tolerance]
+
+    environment = baseline['environment']
+    say('')
+    say('baseline %s (%s, python %s, numpy %s)' % (baselinefile, environment['time'], environment['python'], environment['numpy']))
+    if environment['machine'] != platform.machine():
+        say('warning: baseline recorded on %s, this is %s' % (environment['machine'], platform.machine()))
+    if rows:
+        ratios = numpy.array([row[3] for row in rows])
+        say('%d cases compared: median ratio %.2f, best %.2f, worst %.2f' % (len(rows), numpy.median(ratios), ratios.min(), ratios.max()))
+    if missing or new:
+        say('%d baseline cases not run, %d cases not in the baseline' % (len(missing), len(new)))
+    if regressions:
+        say('%d cases slower than the baseline by more than %.0f%%:' % (len(regressions), 100 * tolerance))
+        for k, before, after, ratio in sorted(regressions, key=lambda row: -row[3]):
+            say('  %-50s %10.1f us -> %10.1f us  (x%.2f)' % (k, before, after, ratio))
+    else:
+        say('no regressions (tolerance %.0f%%)' % (100 * tolerance))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Mixer regression benchmark')
+    parser.add_argument('--quick', action='store_true', help='voices %s, blocksizes %s only' % (QUICK_VOICE_COUNTS, QUICK_BLOCKSIZES))
+    parser.add_argument('--backend', choices=['cython', 'numpy'], help='benchmark one backend only')
+    parser.add_argument('--output', help='write the results (JSON) to this file, - for stdout')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline file (default %(default)s)')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the baseline')
+    parser.add_argument('--rounds', type=int, default=ROUNDS, help='passes over the sweep (default %(default)s)')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='allowed slowdown ratio (default %(default)s)')
+    args = parser.parse_args()
+
+    # With the JSON on stdout, the tables go to stderr
+    def say(line):
+        (sys.stderr if args.output == '-' else sys.stdout).write(line + '\n')
+
+    def progress(done, total):
+        sys.stderr.write('\r%d/%d cases' % (done, total))
+        if done == total:
+            sys.stderr.write('\n')
+
+    found = [("numpy", numpy_mixer)]
+    try:
+        import samplerbox_audio
+        found.insert(0, ("cython", samplerbox_audio))
+    except ImportError:
+        say('samplerbox_audio not compiled')
+    found = [(name, module) for name, module in found if args.backend in (None, name)]
+    if not found:
+        sys.exit('backend %s not available' % args.backend)
+    if not args.save_baseline and not os.path.exists(args.baseline):
+        say('no baseline at %s (record one on this machine with --save-baseline)' % args.baseline)
+        sys.exit(2)
+    voicecounts = QUICK_VOICE_COUNTS if args.quick else VOICE_COUNTS
+    blocksizes = QUICK_BLOCKSIZES if args.quick else BLOCKSIZES
+    cases = sweep(found, voicecounts, blocksizes)
+    results = run(cases, args.rounds, progress)
+    say(summary(results))
+
+    regressions = []
+    if args.save_baseline:
+        save({'environment': environment(), 'results': results}, args.baseline)
+        say('baseline saved to %s' % args.baseline)
+    else:
+        regressions = check(results, cases, args.baseline, args.tolerance, args.rounds, say, progress)
+    if args.output:
+        save({'environment': environment(), 'results': results,
+              'regressions': [row[0] for row in regressions]}, args.output)
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,75 @@
+#
+#  bench_tuning.py: Key and layout switching
+#
+#  Builds a synthetic bank with one sample every SPACING semitones (the
+#  other notes transposed from the nearest lower sample, like a sparse
+#  instrument) and steps through every key of every layout of
+#  tuning.TuningTable, playing the 20 notes of each. For each switch:
+#
+#    swap        time of TuningTable.select()
+#    warm-up     time to render the new tuning's transposed notes first
+#                (TransposeCache.prepare; dhp.py's SwitchTuning queues the
+#                same renders on the cache's worker)
+#    first hits  share of the new tuning's first notes that found their
+#                transposed buffer ready, with and without the warm-up
+#
+#  usage: python bench_tuning.py
+#
+
+from __future__ import division
+import time
+import numpy
+import tuning
+import transposecache
+from bench_mixer import SyntheticSound, SPEED
+
+SPACING = 3
+SECONDS = 1.0
+SAMPLERATE = 44100
+
+
+def bank():
+    sounds = {}
+    for midinote in range(24, 96, SPACING):
+        sound = SyntheticSound(midinote, int(SECONDS * SAMPLERATE), seed=midinote)
+        sound.fname = "synthetic%d" % midinote
+        sounds[midinote] = sound
+    samples = {}
+    for midinote in range(24, 96):
+        samples[midinote] = sounds[midinote - (midinote - 24) % SPACING]
+    return samples
+
+
+# Plays every key of every layout; returns (swap, warm-up, hit rate) per switch
+def run(samples, warm):
+    table = tuning.TuningTable()
+    table.resolve(samples, SPEED)
+    cache = transposecache.TransposeCache(background=False)
+    swaps, warmups, hits = [], [], []
+    for layout in range(len(table.names)):
+        for key in range(len(tuning.KEYS)):
+            notes = [int(n) for n in table.lookup(layout, key).flat if int(n) in samples]
+            start = time.time()
+            if warm:
+                for midinote in notes:
+                    cache.prepare(samples[midinote], midinote)
+            warmups.append(time.time() - start)
+            start = time.time()
+            table.select(layout, key)
+            swaps.append(time.time() - start)
+            before = cache.hits
+            for midinote in notes:
+                cache.lookup(samples[midinote], midinote)
+            transposed = sum(1 for n in notes if samples[n].midinote != n)
+            hits.append((cache.hits - before) / transposed if transposed else 1.0)
+    return numpy.array(swaps), numpy.array(warmups), numpy.array(hits)
+
+
+if __name__ == "__main__":
+    samples = bank()
+    table = tuning.TuningTable()
+    print('%d layouts x %d keys, one sample every %d semitones' % (len(table.names), len(tuning.KEYS), SPACING))
+    print('%-10s %10s %12s %11s' % ("setting", "swap (us)", "warm-up (ms)", "first hits"))
+    for name, warm in (('cold', False), ('warmed up', True)):
+        swaps, warmups, hits = run(samples, warm)
+        print('%-10s %10.1f %12.1f %10.0f%%' % (name, 1e6 * swaps.mean(), 1000 * warmups.mean(), 100 * hits.mean()))
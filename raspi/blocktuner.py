@@ -0,0 +1,123 @@
+#
+#  blocktuner.py: Audio block size tuning
+#
+#  The block size trades latency against safety: each callback has
+#  blocksize / samplerate seconds to mix a block, and the part of that
+#  period the mix takes grows as the blocks get smaller (the fixed cost per
+#  callback is paid more often). Which block size is safe depends on the
+#  Pi, the mixer threads, the interpolation tier and the polyphony.
+#
+#  At startup measure() times the callback's work (apply, mixvoices,
+#  output stage) for MAX_NUM_VOICES transposed voices at every candidate
+#  block size, and choose() takes the smallest one whose 99th percentile
+#  stays within margin of its period, never above the user's upper bound.
+#
+#  While playing, BlockTuner counts the underflows the audio callback
+#  reports. When they come in a burst (underruns within window seconds) it
+#  asks for twice the block size, up to the upper bound, and dhp.py
+#  reopens the stream with it. It never shrinks the block again: a
+#  restart measures afresh.
+#
+
+from __future__ import division
+import numpy
+import voicepool
+import interpolation
+from latency import clock
+from collections import deque
+
+BLOCKSIZES = (64, 128, 256, 512, 1024, 2048, 4096) # candidates, smallest first
+
+
+# Stand-in for a Sound while measuring: 2 seconds of stereo noise, looped
+class NoiseSound:
+
+    def __init__(self, samplerate, tier=interpolation.LINEAR):
+        rng = numpy.random.RandomState(0)
+        self.nframes = 2 * samplerate
+        self.loop = 1000
+        self.nchannels = 2
+        self.interpolation = tier
+        self.data = rng.randint(-8000, 8000, 2 * self.nframes).astype(numpy.int16)
+
+
+# 99th percentile of the seconds the callback takes to mix nblocks blocks
+# of blocksize frames with nvoices voices transposed up to half an octave
+# either way (the interpolating path)
+def callbackcost(mixer, nvoices, blocksize, FADEOUT, FADEOUTLENGTH, samplerate, tier=interpolation.LINEAR,
+                 workers=1, nblocks=100):
+    pool = voicepool.VoicePool(nvoices, FADEOUT)
+    sound = NoiseSound(samplerate, tier)
+    for v in range(nvoices):
+        pool.noteon(sound, 60 + v, 2 ** ((v % 12 - 5) / 12), 100)
+    mixbuffer = numpy.zeros(2 * blocksize, numpy.float32)
+    outdata = numpy.zeros((blocksize, 2), numpy.int16)
+    durations = numpy.zeros(nblocks)
+    for blk in range(nblocks):
+        start = clock()
+        pool.apply(blocksize)
+        b = mixer.mixvoices(pool, blocksize, FADEOUT, FADEOUTLENGTH, workers, mixbuffer)
+        mixer.outputstage(b, outdata, 0.25, 0.5, None)
+        durations[blk] = clock() - start
+    return numpy.percentile(durations, 99)
+
+
+# {blocksize: callback cost in seconds} of the candidates up to maxblocksize
+def measure(mixer, nvoices, FADEOUT, FADEOUTLENGTH, samplerate, tier=interpolation.LINEAR, workers=1,
+            maxblocksize=BLOCKSIZES[-1]):
+    costs = {}
+    for blocksize in BLOCKSIZES:
+        if blocksize > maxblocksize:
+            break
+        costs[blocksize] = callbackcost(mixer, nvoices, blocksize, FADEOUT, FADEOUTLENGTH, samplerate, tier, workers)
+    return costs
+
+
+# The smallest measured block size whose cost is at most margin of its
+# period; maxblocksize if none is (it is the user's bound on latency)
+def choose(costs, samplerate, margin, maxblocksize):
+    for blocksize in sorted(costs):
+        if blocksize <= maxblocksize and costs[blocksize] <= margin * blocksize / samplerate:
+            return blocksize
+    return maxblocksize
+
+
+# One line: the chosen block size and the cost of each candidate as a
+# part of its period
+def report(costs, blocksize, samplerate, margin=None):
+    line = 'Block size %d frames (%.1f ms), callback cost: ' % (blocksize, 1000 * blocksize / samplerate)
+    line += ', '.join('%d: %.0f%%' % (b, 100 * costs[b] * samplerate / b) for b in sorted(costs))
+    if margin is not None and blocksize in costs and costs[blocksize] > margin * blocksize / samplerate:
+        line += ' (over the %.0f%% margin even so)' % (100 * margin)
+    return line
+
+
+# Grows the block size when the stream keeps underrunning. The audio
+# callback adds to underflows; check() runs in a slower thread.
+class BlockTuner:
+
+    def __init__(self, blocksize, maxblocksize, underruns=3, window=10.0):
+        self.blocksize = blocksize
+        self.maxblocksize = maxblocksize
+        self.underruns = underruns
+        self.window = window
+        self.underflows = 0 # reported by the audio callback
+        self.grown = 0      # times the block size was doubled
+        self._seen = 0
+        self._times = deque() # when recent underflows were noticed
+
+    # Returns the block size to reopen the stream with, or None to keep it
+    def check(self, now=None):
+        now = clock() if now is None else now
+        underflows = self.underflows
+        for u in range(underflows - self._seen):
+            self._times.append(now)
+        self._seen = underflows
+        while self._times and now - self._times[0] > self.window:
+            self._times.popleft()
+        if len(self._times) < self.underruns or self.blocksize >= self.maxblocksize:
+            return None
+        self.blocksize = min(2 * self.blocksize, self.maxblocksize)
+        self.grown += 1
+        self._times.clear()
+        return self.blocksize
@@ -0,0 +1,123 @@
+#
+#  calibration.py: Resting sensor values, persisted and tracked
+#
+#  The thresholds of every hole sit a tolerance away from its resting
+#  reading, but the MPXV7002 sensors drift with temperature and with the
+#  humidity of the player's breath, so a calibration taken at startup goes
+#  stale during a session (a hole that drifted towards its blow threshold
+#  starts sounding on its own, one that drifted away needs harder breath).
+#
+#  save() / load() keep the last resting values in a small JSON file, so a
+#  warm start only checks them against a few quick scans (agrees()) instead
+#  of the blocking calibration.
+#
+#  RestTracker follows the resting values while playing. A channel counts
+#  as idle when the conditioner has had it OFF for `settle` scans and its
+#  filtered level is within a band around rest; the estimate of an idle
+#  channel follows its readings with an exponentially weighted moving
+#  average (alpha per scan). Every `every` scans the estimates become the conditioner's
+#  resting values, which recomputes its thresholds in place: the scan loop
+#  never stops. The drift from the first resting values is sampled every
+#  `period` seconds for report().
+#
+
+from __future__ import division
+import os
+import json
+import time
+import numpy
+import sensorfilter
+from latency import clock
+from collections import deque
+
+VERSION = 1
+
+
+# Writes the resting values to path (atomically: a crash leaves the old file)
+def save(path, resting):
+    tmp = path + ".tmp"
+    with open(tmp, 'w') as f:
+        json.dump({'version': VERSION, 'time': time.time(), 'resting': [float(v) for v in resting]}, f)
+    os.rename(tmp, path)
+
+
+# The resting values saved in path, or None if there are none, they are
+# for another number of channels, older than maxage seconds or unreadable
+def load(path, nchannels, maxage=None):
+    try:
+        with open(path) as f:
+            saved = json.load(f)
+        resting = [float(v) for v in saved['resting']]
+        if saved.get('version') != VERSION or len(resting) != nchannels:
+            return None
+        if maxage is not None and time.time() - float(saved['time']) > maxage:
+            return None
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        return None
+    return resting
+
+
+# True when the median of scans (a few quick readings at rest) is within
+# tolerance of every saved resting value
+def agrees(resting, scans, tolerance):
+    now = numpy.median(numpy.asarray(scans, float), axis=0)
+    return bool(numpy.all(numpy.abs(now - numpy.asarray(resting)) <= tolerance))
+
+
+class RestTracker:
+
+    def __init__(self, conditioner, alpha=0.002, band=0.5, settle=50, every=50, period=60.0, history=60):
+        self.conditioner = conditioner
+        self.alpha = alpha
+        self.every = every
+        self.settle = settle
+        self.period = period
+        n = len(conditioner.resting)
+        self.start = conditioner.resting.copy() # resting values the session began with
+        self.estimate = conditioner.resting.copy()
+        # Idle readings are closer to rest than band of the smaller tolerance
+        self.band = band * min(conditioner.blowtolerance, conditioner.drawtolerance)
+        self.history = deque(maxlen=history) # (seconds, drift) every period
+        self.scans = 0
+        self._distance = numpy.zeros(n)
+        self._idle = numpy.zeros(n, bool)
+        self._tracking = numpy.zeros(n, bool)
+        self._step = numpy.zeros(n)
+        self._sampled = None
+
+    # Takes one scan, after the conditioner's update()
+    def update(self, values, now=None):
+        conditioner = self.conditioner
+        numpy.subtract(conditioner.level, self.estimate, self._distance)
+        numpy.abs(self._distance, self._distance)
+        numpy.less_equal(self._distance, self.band, self._idle)
+        numpy.greater_equal(conditioner.age, self.settle, self._tracking)
+        self._tracking &= self._idle
+        self._tracking &= conditioner.state == sensorfilter.OFF
+        numpy.subtract(values, self.estimate, self._step)
+        self._step *= self.alpha
+        self.estimate[self._tracking] += self._step[self._tracking]
+        self.scans += 1
+        if self.scans % self.every == 0:
+            self.conditioner.setresting(self.estimate)
+            now = clock() if now is None else now
+            if self._sampled is None or now - self._sampled >= self.period:
+                self._sampled = now
+                self.history.append((now, self.drift()))
+
+    # How far each channel's resting value moved since the session began
+    def drift(self):
+        return self.conditioner.resting - self.start
+
+    # Drift of every channel since the start and over the history kept
+    def report(self):
+        drift = self.drift()
+        line = 'Sensor drift: ' + ' '.join('%+.1f' % d for d in drift)
+        if len(self.history) > 1:
+            (first, old), (last, new) = self.history[0], self.history[-1]
+            minutes = (last - first) / 60
+            line += ', last %.0f min: %s' % (minutes, ' '.join('%+.1f' % d for d in new - old))
+        tolerance = min(self.conditioner.blowtolerance, self.conditioner.drawtolerance)
+        worst = int(numpy.argmax(numpy.abs(drift)))
+        line += ' (largest ch %d, %.0f%% of the tolerance)' % (worst, 100 * abs(drift[worst]) / tolerance)
+        return line
@@ -0,0 +1,201 @@
+#
+#  callbackprofiler.py: Audio callback deadline profiler
+#
+#  The callback has blocksize / samplerate seconds (5.8 ms at 256 frames,
+#  44.1 kHz) to mix a block. For every callback this records, into ring
+#  buffers allocated up front, how long it took, and how many voices it
+#  mixed on each path of the mixer: sustained looping, sustained one-shot
+#  and fadeout. It also counts the underflows and overflows sounddevice
+#  reports in the callback's status.
+#
+#  stats() estimates the cost of one voice on each path with a least
+#  squares fit of duration against the voice counts. The worst callbacks
+#  are kept with a copy of the voice pool as it was before mixing, for
+#  dumpworst().
+#
+#  begin() and end() only write into preallocated arrays: nothing is
+#  allocated in the callback (python bench_alloc.py checks).
+
+from __future__ import division
+import numpy
+from latency import clock
+
+# Voice pool arrays kept with the worst callbacks
+FIELDS = ('active', 'note', 'pos', 'speed', 'gain', 'fading', 'fadepos', 'loop', 'length', 'stolen')
+
+
+class CallbackProfiler:
+
+    def __init__(self, pool, blocksize, samplerate, window=4096, worst=8):
+        self.pool = pool
+        self.deadline = blocksize / samplerate
+        self.duration = numpy.zeros(window)
+        self.looping = numpy.zeros(window, numpy.int32)
+        self.oneshot = numpy.zeros(window, numpy.int32)
+        self.fading = numpy.zeros(window, numpy.int32)
+        # Ring position after each one: the ints come from this list, so
+        # counting callbacks does not create one per callback
+        self._next = list(range(1, window)) + [0]
+        # Scratch for counting voices without temporaries: 0/1 per slot
+        self._active = numpy.zeros(pool.size, numpy.intp)
+        self._fading = numpy.zeros(pool.size, numpy.intp)
+        self._looped = numpy.zeros(pool.size, numpy.intp)
+        self._both = numpy.zeros(pool.size, numpy.intp)
+        self._sums = numpy.zeros(pool.size, numpy.intp)
+        self._loops = numpy.zeros(pool.size, bool)
+        self._oneshot = numpy.full(pool.size, -1, numpy.int32)
+        self._state = numpy.zeros((len(FIELDS), pool.size))
+        self._rows = list(self._state) # one view per field, made once
+        # Worst callbacks: duration, voice counts and pool state
+        self.worstduration = numpy.zeros(worst)
+        self.worstwhen = numpy.zeros(worst)
+        self.worstcounts = numpy.zeros((worst, 3), numpy.int32)
+        self.worststate = numpy.zeros((worst, len(FIELDS), pool.size))
+        self._worstrows = list(self.worststate)
+        self._worstslot = numpy.zeros((), numpy.intp) # worst callback to replace next
+        self.reset()
+
+    # When the stream is reopened with another block size
+    def setblocksize(self, blocksize, samplerate):
+        self.deadline = blocksize / samplerate
+        self.reset()
+
+    def reset(self):
+        self.position = 0 # in the ring buffers
+        self.laps = 0     # of the ring buffers
+        self.overruns = 0
+        self.underflows = 0
+        self.overflows = 0
+        self.worstduration[:] = 0
+        self._worstslot[()] = 0
+        self._floor = 0.0 # duration of the worst callback to replace
+        self.started = clock()
+
+    # Callbacks profiled since the last reset
+    def callbacks(self):
+        return self.laps * len(self.duration) + self.position
+
+    # Call after the pool's apply(), before mixing
+    def begin(self):
+        pool = self.pool
+        i = self.position
+        # Same-typed operands only: a reduction or a scalar would allocate
+        numpy.copyto(self._active, pool.active)
+        numpy.copyto(self._fading, pool.fading)
+        numpy.not_equal(pool.loop, self._oneshot, self._loops)
+        numpy.copyto(self._looped, self._loops)
+        numpy.multiply(self._active, self._fading, self._both)
+        fading = self._count(self._both)
+        numpy.multiply(self._active, self._looped, self._looped)
+        numpy.multiply(self._looped, self._fading, self._both)
+        looping = self._count(self._looped) - self._count(self._both)
+        self.fading[i] = fading
+        self.looping[i] = looping
+        self.oneshot[i] = self._count(self._active) - fading - looping
+        f = 0
+        while f < len(FIELDS): # a for loop would allocate its iterator
+            numpy.copyto(self._rows[f], getattr(pool, FIELDS[f]))
+            f += 1
+
+    # Number of ones in a 0/1 scratch array (count_nonzero returns a numpy
+    # scalar on recent numpy, an accumulate into scratch allocates nothing)
+    def _count(self, x):
+        numpy.add.accumulate(x, 0, None, self._sums)
+        return self._sums.item(-1)
+
+    # Call at the end of the callback with its start time and status
+    def end(self, start, status=None):
+        duration = clock() - start
+        i = self.position
+        self.duration[i] = duration
+        self.position = self._next[i]
+        if self.position == 0:
+            self.laps += 1
+        if duration > self.deadline:
+            self.overruns += 1
+        if status:
+            if status.output_underflow:
+                self.underflows += 1
+            if status.output_overflow:
+                self.overflows += 1
+        if duration > self._floor:
+            w = self._worstslot.item()
+            self.worstduration[w] = duration
+            self.worstwhen[w] = start
+            self.worstcounts[w, 0] = self.looping.item(i)
+            self.worstcounts[w, 1] = self.oneshot.item(i)
+            self.worstcounts[w, 2] = self.fading.item(i)
+            numpy.copyto(self._worstrows[w], self._state)
+            self.worstduration.argmin(None, self._worstslot)
+            self._floor = self.worstduration.item(self._worstslot.item())
+
+    # Per-voice cost (seconds) of each path, fitted over the window:
+    # duration = base + looping * a + oneshot * b + fading * c
+    def costs(self):
+        n = min(self.callbacks(), len(self.duration))
+        X = numpy.column_stack([numpy.ones(n), self.looping[:n], self.oneshot[:n], self.fading[:n]])
+        fit = numpy.linalg.lstsq(X, self.duration[:n], rcond=None)[0]
+        return dict(zip(('base', 'looping', 'oneshot', 'fading'), fit))
+
+    def stats(self):
+        n = min(self.callbacks(), len(self.duration))
+        result = {'callbacks': self.callbacks(), 'deadline': self.deadline, 'overruns': self.overruns,
+                  'underflows': self.underflows, 'overflows': self.overflows}
+        if n == 0:
+            return result
+        duration = self.duration[:n]
+        result.update({
+            'mean': duration.mean(),
+            'p50': numpy.percentile(duration, 50),
+            'p99': numpy.percentile(duration, 99),
+            'max': duration.max(),
+            'load': numpy.percentile(duration, 99) / self.deadline,
+            'voices': (self.looping[:n] + self.oneshot[:n] + self.fading[:n]).mean(),
+        })
+        if n > 4:
+            result['costs'] = self.costs()
+        return result
+
+    def report(self):
+        s = self.stats()
+        if 'mean' not in s:
+            return 'Callback: no callbacks yet'
+        line = 'Callback p50 %.2f ms, p99 %.2f ms, max %.2f ms of %.2f ms (p99 load %.0f%%), %.1f voices, ' \
+               '%d overruns, %d underflows, %d overflows' % (
+                   s['p50'] * 1000, s['p99'] * 1000, s['max'] * 1000, s['deadline'] * 1000, 100 * s['load'],
+                   s['voices'], s['overruns'], s['underflows'], s['overflows'])
+        if 'costs' in s:
+            c = s['costs']
+            line += '\n  per voice: looping %.1f us, one-shot %.1f us, fadeout %.1f us (base %.1f us)' % (
+                c['looping'] * 1e6, c['oneshot'] * 1e6, c['fading'] * 1e6, c['base'] * 1e6)
+        return line
+
+    # The worst callbacks, slowest first, with the active voices' state
+    def worst(self):
+        result = []
+        for w in numpy.argsort(-self.worstduration):
+            if self.worstduration[w] == 0:
+                break
+            state = self.worststate[w]
+            active = numpy.flatnonzero(state[FIELDS.index('active')])
+            result.append({
+                'duration': self.worstduration[w],
+                'at': self.worstwhen[w] - self.started,
+                'looping': int(self.worstcounts[w, 0]),
+                'oneshot': int(self.worstcounts[w, 1]),
+                'fading': int(self.worstcounts[w, 2]),
+                'voices': [dict((name, state[f, v]) for f, name in enumerate(FIELDS)) for v in active],
+            })
+        return result
+
+    def dumpworst(self):
+        lines = []
+        for c in self.worst():
+            lines.append('%.2f ms at %.1f s: %d looping, %d one-shot, %d fadeout' % (
+                c['duration'] * 1000, c['at'], c['looping'], c['oneshot'], c['fading']))
+            for v in c['voices']:
+                lines.append('    note %3d  pos %9.1f  speed %.3f  gain %.2f  %s%s' % (
+                    v['note'], v['pos'], v['speed'], v['gain'],
+                    'fadeout %d' % v['fadepos'] if v['fading'] else ('looping' if v['loop'] != -1 else 'one-shot'),
+                    ' stolen' if v['stolen'] else ''))
+        return '\n'.join(lines)
@@ -3,26 +3,45 @@ from __future__ import division
 # Changes were made to make the code specialized for the DHP project
 
 from operator import add
-import wave
+import sys
 import time
+import startup
+boot = startup.Startup() # the boot timeline starts here (see startup.py)
 import numpy
 import os
-import glob
 import re
-import sounddevice
 import threading
-from chunk import Chunk
-import struct
-import rtmidi_python as rtmidi
-import samplerbox_audio
-from subprocess import call # for extra volume control
 
-# Adafruit_MCP3008 is the 10-bit 8-channel DAC we are using to access 
-# the air pressure sensors. These imports are needed to allow us to use 
-# the DAC in a programmatic way
-# Import SPI library (for hardware SPI) and MCP3008 library.
-import Adafruit_GPIO.SPI as SPI
-import Adafruit_MCP3008
+# python dhp.py --render <script> <out.wav> renders a scripted performance
+# to a wav file, without any audio, MIDI or SPI hardware (see offlinerender.py)
+OFFLINE_RENDER = sys.argv[1:2] == ['--render']
+boot.concurrent = not OFFLINE_RENDER # renders run the phases one after the other
+
+# sounddevice, rtmidi, serial, RPi.GPIO and the Adafruit SPI modules are imported by
+# the startup phases that use them, not before the first note
+from subprocess import call # for extra volume control
+import transposecache
+import samplestore
+import bankcache
+import bankpack
+import adcscan
+import voicepool
+import interpolation
+import latency
+import callbackprofiler
+import blocktuner
+import signal
+import scanloop
+import offlinerender
+import sensorfilter
+import calibration
+import instrumentindex
+import tuning
+import midiwatch
+from waveread import waveread
+from instrument import NOTES, Sample, Instrument, properNote, noteFiles
+
+boot.mark("imports")
 
 # Note-worthy Design Decisions:
 #
@@ -45,10 +64,48 @@ import Adafruit_MCP3008
 #
 
 AUDIO_DEVICE_ID = 2
+AUDIO_BLOCKSIZE = 256 # Frames per audio callback (AUTO_BLOCKSIZE picks it instead)
+AUTO_BLOCKSIZE = True # Smallest block size the mix fits in at MAX_NUM_VOICES, grown on underruns (see blocktuner.py)
+MAX_AUDIO_BLOCKSIZE = 1024 # Upper bound on the block size (and so on the latency) the tuner may pick
+BLOCKSIZE_MARGIN = 0.5 # Part of a block's period the callback may take at MAX_NUM_VOICES
+UNDERRUNS_TO_GROW = 3 # Underruns within 10 s that reopen the stream with twice the block size
+SAMPLERATE = 44100
 SAMPLES_DIR = "samples" # Where the instrument folders live
 USE_BUTTONS = True
 USE_SERIALPORT_MIDI = False
-MAX_NUM_VOICES = 5
+MAX_NUM_VOICES = 5 # More fit in a callback with MIXER_THREADS > 1 (python bench_mixer.py)
+MIXER_THREADS = 1 # Cores mixing voices in parallel (Cython mixer built with OpenMP, up to 4 on a Pi)
+VOICE_STEAL_FADE = 256 # Frames a stolen voice takes to fade out (see voicepool.py)
+BREATH_EXPRESSION = True # Sounding holes follow breath pressure, not just note-on velocity
+LATENCY_MONITOR = True # Breath-to-sound latency histograms (see latency.py)
+PROFILE_CALLBACK = True # Audio callback duration and xrun accounting (see callbackprofiler.py)
+LIMITER_KNEE = 0.5 # Output level (fraction of full scale) where the soft limiter starts bending (1 = hard clip)
+DITHER = False # TPDF dither when the mix is converted to 16 bits (silent blocks stay undithered)
+MIXER_BACKEND = "cython" # "cython" (samplerbox_audio.pyx) or "numpy" (numpy_mixer.py)
+INTERPOLATION = "linear" # Transposed notes: "linear", "cubic" or "sinc" (see interpolation.py; Instruments can override)
+USE_TRANSPOSE_CACHE = True # Pre-render transposed notes (see transposecache.py)
+TRANSPOSE_CACHE_BYTES = 32*1024*1024 # Memory budget for pre-rendered notes
+TRANSPOSE_CACHE_AT_LOAD = False # Render while loading instead of on first play
+MMAP_SAMPLES = True # Memory-map 16-bit wav data instead of reading it (see samplestore.py)
+PREFAULT_SAMPLES = True # Page in the active instrument's samples after loading
+LOCK_SAMPLES = False # mlock the active instrument's samples (needs ulimit -l)
+LAZY_LOADING = True # Load the notes the holes can play first, the rest afterwards
+USE_BANK_CACHE = True # Keep recently played instruments loaded (see bankcache.py)
+BANK_CACHE_BYTES = 64*1024*1024 # Memory budget for resident instruments
+USE_BANK_PACKS = True # Load compiled banks when up to date (python bankpack.py)
+USE_BURST_SPI = True # Read all channels of an ADC in one SPI ioctl (see adcscan.py)
+SCAN_RATE = 500 # Sensor scans per second
+SENSOR_FILTER = "median" # Sensor smoothing: "median" of SENSOR_WINDOW scans, "onepole" or "none" (see sensorfilter.py)
+SENSOR_WINDOW = 3 # Scans in the median (delays note-ons by SENSOR_WINDOW // 2 scans)
+SENSOR_HYSTERESIS = 0.3 # Holes are released this part of their tolerance closer to rest than they start
+SENSOR_HOLD = 0.01 # Seconds a hole keeps a new state before it may change again
+CALIBRATION_FILE = "calibration.json" # Last resting sensor values, so warm starts skip calibrating
+CALIBRATION_MAX_AGE = 7*24*3600 # Seconds a saved calibration may be used for
+CALIBRATION_CHECK = 8 # ADC counts a saved resting value may be off at startup before recalibrating
+AUTO_CALIBRATE = True # Follow the resting values' drift while playing (see calibration.py)
+CALIBRATION_SAVE_INTERVAL = 300 # Seconds between saves of the followed resting values
+SCAN_REPORT_INTERVAL = 10 # Seconds between scan rate, latency and callback reports (0 = never)
+MIDI_SCAN_INTERVAL = 1.0 # Seconds between MIDI port hot-plug checks
 NUM_INSTRUMENTS = 0 # Value will be altered when Instruments are parsed
 CHANNELS_FROM_ADC_ONE = 5
 CHANNELS_FROM_ADC_TWO = 5 # Unimplemented currently
@@ -57,249 +114,71 @@ restingSensorValues = []  # Will contain the sensor values while at rest
 blowTolerance = 30
 drawTolerance = 15 
 minIssuedVelocity = 50
-NOTES = ["c", "c#", "d", "d#", "e", "f", "f#", "g", "g#", "a", "a#", "b"]
+TUNING_LAYOUT = "dhp" # Holes: "dhp" (C E G blown, B D F drawn), "richter", "paddy richter", "country" or "natural minor" (see tuning.py)
+TUNING_KEY = "C" # Key of the harmonica (GPIO 23 / 24 transpose it, and MIDI input, by semitones)
+
+# Mixer backend (see MIXER_BACKEND)
+if MIXER_BACKEND == "cython":
+    try:
+        import samplerbox_audio
+    except ImportError: # .pyx not compiled (python setup.py build_ext --inplace)
+        print 'samplerbox_audio not compiled, using the numpy mixer'
+        import numpy_mixer as samplerbox_audio
+else:
+    import numpy_mixer as samplerbox_audio
 
 
 # Hardware SPI configuration:
 SPI_PORT   = 0
 SPI_DEVICE0 = 0; SPI_DEVICE1 = 1
-mcp0 = Adafruit_MCP3008.MCP3008(spi=SPI.SpiDev(SPI_PORT, SPI_DEVICE1))
-mcp1 = Adafruit_MCP3008.MCP3008(spi=SPI.SpiDev(SPI_PORT, SPI_DEVICE0))
-
-class Sample():
-    
-    def __init__(self, fileName, transpose, start=0):
-        self.fileName = fileName
-        self.transpose = transpose
-        self.start = start
-        
-    def __str__(self):
-		return "[file={0}, trans={1}, start={2}]".format \
-		(self.fileName, self.transpose, self.start)
-
-# Instrument is separate from HarmonicaTuning.
-# An <instrument, harmonica-tuning> pair is used
-class Instrument():
-    SAMPLES_PER_INSTRUMENT = 60 # midivalues 24 (C2) thru 84 (C7) 
-    
-    def __init__(self, instrumentDirName, globalstart=0):
-		# Holds array of Sample objects
-        self.sample_file_array = [None] * self.SAMPLES_PER_INSTRUMENT
-        self.instrumentDirName = instrumentDirName
-        self.globalstart = globalstart
-        # From the samplesDirectory place corresponding samples into 
-        # the file string array
-        exp = instrumentDirName + os.sep + "*.wav"
-        
-        for f in glob.glob(exp): # The sample file is f
-			#print(f)
-			# break the filename into its components
-			f = f.replace(instrumentDirName + os.sep, "")
-			items = f.split('.')
-			if(items[0].isdigit()):
-				midiNote = int(items[0])
-			else:
-				notename = items[0]
-				# Get numeric midinote value (0-127) for pitch
-				midiNote = NOTES.index(notename[:-1].lower()) + (int(notename[-1])+2) * 12
-			
-			# adjust midiNote to find proper index for sample array
-			index = midiNote - 24
-			if(index>=0 and index<self.SAMPLES_PER_INSTRUMENT):
-				self.sample_file_array[index] = Sample(f,0)
-				
-			#print self.sample_file_array
-		
-		# Done reading in array with samples that have specific sample files
-		
-		# Now figure out which samples need a transpose and by how much
-		
-		# Basic Design Decision: Take last available sample and upshift 
-		# by pitch difference. 
-		# One exception: For empty samples within the array where no sample 
-		# existed at a lower pitch (AKA nothing to be pitch shifted upwards)
-		# The pitch will be dropped from the first available sample pitch.
-        self._fillEmptySamplesByTranspose()
-        #for sample in self.sample_file_array:
-		#    print str(sample)
-        #print("-------------------"*2)
-		    
-		
-    
-    # Fills in non-existing samples for the specific instrument using
-    # transposed versions of existing samples
-    #
-    # Should only be called once (during the initialization of object)
-    # Private function
-    def _fillEmptySamplesByTranspose(self):
-		woTransMostRecent = -1
-		# forward iteration over items (handles tranpose upward)
-		indexRange = range(self.SAMPLES_PER_INSTRUMENT)
-		for s in indexRange:
-			
-			if ( self.sample_file_array[s]!=None): 	
-				# sample already exists (w/o transpose)
-				woTransMostRecent = s # keep reference
-			elif ( (self.sample_file_array[s]==None) \
-			and (woTransMostRecent != -1)):
-				# sample needs a transpose from a lower pitch sample
-				orig_samp_obj = self.sample_file_array[woTransMostRecent]
-				fn = orig_samp_obj.fileName
-				transposeBy = s-woTransMostRecent
-				self.sample_file_array[s] = Sample(fn, transposeBy, self.globalstart) 
-		
-		woTransMostRecent = -1
-		# Backward iteration over sample items (down tranposes)
-		indexRange.reverse()
-		for s in indexRange:
-			
-			if ( self.sample_file_array[s]!=None): 	
-				# sample already exists (w/o transpose)
-				woTransMostRecent = s # keep reference
-			elif ( (self.sample_file_array[s]==None) \
-			and (woTransMostRecent != -1)):
-				# sample needs a transpose from a lower pitch sample
-				orig_samp_obj = self.sample_file_array[woTransMostRecent]
-				fn = orig_samp_obj.fileName
-				transposeBy = s-woTransMostRecent # Switched
-				self.sample_file_array[s] = Sample(fn, transposeBy, self.globalstart) 
-		# Now all indices in the sample array contain valid Sample 
-		# objects (midi-mapping is complete)
-		
-    def getSample(midiNote):
-        sample = sample_file_array[midiNote]
-        transposeBy = sample.transpose
-        # TODO: prepare midinote or WAVE with transpose where needed
-        return 
-    
-
-# DHP-STUB: Our own tuning class, to represent tunings for the harmonica
-class HarmonicaTuning():
-    # Construct a harmonica tuning based on the blow and draw notes
-    def __init__(self, blowNotes, drawNotes):
-        self.blowNotes = blowNotes
-        self.drawNotes = drawNotes
-
-    def __str__(self):
-        return "Blow Notes: " + self.blowNotes + "\nDraw Notes: " + self.drawNotes
-    
-#########################################
-# SLIGHT MODIFICATION OF PYTHON'S WAVE MODULE
-# TO READ CUE MARKERS & LOOP MARKERS
-#########################################
-# DHP-STUB: Comment: Original source code for the wave was copied and pasted with very little modification. 
-# This code is well explained in the following resources
-# https://docs.python.org/2/library/wave.html
-# https://hg.python.org/cpython/file/2.7/Lib/wave.py
-
-# The class waveread extends the class wave.Wave_read"
-class waveread(wave.Wave_read):
-    
-    def initfp(self, file):
-        # DHP-STUB: Comment: Intialize a handful of waveread's member variables
-        self._convert = None
-        self._soundpos = 0
-        self._cue = []
-        self._loops = []
-        self._ieee = False
-        self._file = Chunk(file, bigendian=0)
-
-        # Check to ensure the waveread 
-        if self._file.getname() != 'RIFF':
-            raise Error, 'file does not start with RIFF id'
-        if self._file.read(4) != 'WAVE':
-            raise Error, 'not a WAVE file'
-
-        # More Initializations for waveread's member variables
-        self._fmt_chunk_read = 0
-        self._data_chunk = None
-
-        # Reads all chunks of data in the WAVE file
-        # Ref: docs.python.org/2/library/chunk.html
-        # This while-loop ends when the end of file is hit.
-        while 1:
-            self._data_seek_needed = 1
-            try:
-                chunk = Chunk(self._file, bigendian=0)
-            except EOFError:
-                break # The only exit point for this while loop EOF
-            chunkname = chunk.getname()
-            if chunkname == 'fmt ':
-                self._read_fmt_chunk(chunk)
-                self._fmt_chunk_read = 1
-            elif chunkname == 'data': 
-                # The data subchunk indicates size of sound info & raw sound data!
-
-                # format subchunk must have already been seen in order to process data subchunks
-                if not self._fmt_chunk_read:
-                    raise Error, 'data chunk before fmt chunk'
-
-                self._data_chunk = chunk
-                self._nframes = chunk.chunksize // self._framesize
-                self._data_seek_needed = 0
-            elif chunkname == 'cue ': # Not in original wave_read class
-                # Ref: https://docs.python.org/2/library/struct.html
-                # chunk.read(N) means read at most N bytes from the chunk
-                numcue = struct.unpack('<i', chunk.read(4))[0]
-                for i in range(numcue):
-                    id, position, datachunkid, chunkstart, blockstart, sampleoffset = struct.unpack('<iiiiii', chunk.read(24))
-                    self._cue.append(sampleoffset)
-            elif chunkname == 'smpl': # Not in original wave_read class
-                
-                # DHP-STUB: This confusing looking line of code 
-                # unpacks 9 (little-endian) 32bit integers and places 
-                # assigns each to the corresponding left-hand-side 
-                # variable. The chunk.read argument is 36 because 
-                # 4 bytes/int * 9 ints = 36 bytes
-                manuf, prod, sampleperiod, midiunitynote, midipitchfraction, smptefmt, smpteoffs, numsampleloops, samplerdata = struct.unpack(
-                    '<iiiiiiiii', chunk.read(36))
-                for i in range(numsampleloops):
-                    
-                    # DHP-STUB: Comment: This may be important. TODO
-                    cuepointid, type, start, end, fraction, playcount = struct.unpack('<iiiiii', chunk.read(24))
-                    self._loops.append([start, end])
-            # outside the large while loop. End of file was reached.
-            chunk.skip()
-        if not self._fmt_chunk_read or not self._data_chunk:
-            raise Error, 'fmt chunk and/or data chunk missing'
-
-    def getmarkers(self):
-        return self._cue
-
-    def getloops(self):
-        return self._loops
-
-
+adc = None # opened by OpenSensors
+
+# Opens both ADCs (we have 2 ADCs and use 5 channels from each to read
+# the 10 sensors)
+def OpenSensors():
+    global adc
+    if OFFLINE_RENDER: # sensor frames come from the script
+        mcp0 = adcscan.FakeSpiDev()
+        mcp1 = adcscan.FakeSpiDev()
+    elif USE_BURST_SPI:
+        mcp0 = adcscan.SpiDev(SPI_PORT, SPI_DEVICE1)
+        mcp1 = adcscan.SpiDev(SPI_PORT, SPI_DEVICE0)
+    else:
+        # Adafruit_MCP3008 is the 10-bit 8-channel DAC we are using to access 
+        # the air pressure sensors. These imports are needed to allow us to use 
+        # the DAC in a programmatic way
+        # Import SPI library (for hardware SPI) and MCP3008 library.
+        import Adafruit_GPIO.SPI as SPI
+        import Adafruit_MCP3008
+        mcp0 = Adafruit_MCP3008.MCP3008(spi=SPI.SpiDev(SPI_PORT, SPI_DEVICE1))
+        mcp1 = Adafruit_MCP3008.MCP3008(spi=SPI.SpiDev(SPI_PORT, SPI_DEVICE0))
+    adc = adcscan.ADCScanner([mcp0, mcp1], \
+        [range(CHANNELS_FROM_ADC_ONE), range(CHANNELS_FROM_ADC_TWO)])
+
+# Every layout in every key, as lookup tables; the holes play
+# tunings.active (see tuning.py and SwitchTuning)
+tunings = tuning.TuningTable()
+tunings.select(TUNING_LAYOUT, TUNING_KEY)
 #########################################
 # MIXER CLASSES
 #########################################
-class PlayingSound:
-	
-	# sound contained the wav, velocity, and midinote
-    def __init__(self, sound, note, velocity):
-        self.sound = sound
-        self.pos = 0
-        self.fadeoutpos = 0
-        self.isfadeout = False
-        self.note = note
-        self.velocity = velocity
-
-    def fadeout(self, i):
-        self.isfadeout = True
-
-    def stop(self):
-        try:
-            playingsounds.remove(self)
-        except:
-            pass
+# Voices play from a fixed pool (voicepool.VoicePool, see LOAD SAMPLES)
 
 # This object represents a sound based on a wav file
 class Sound:
 	
-    def __init__(self, filename, midinote):
-        wf = waveread(filename)
+    def __init__(self, filename, midinote, packed=None, tier=interpolation.LINEAR):
         self.fname = filename
         self.midinote = midinote
+        self.interpolation = tier # how the mixer transposes it
+        if packed != None: # sample entry of a compiled bank (see bankpack.py)
+            self.loop = packed['loop']
+            self.nframes = packed['nframes']
+            self.nchannels = packed['nchannels']
+            self.data = packed['data']
+            return
+
+        wf = waveread(filename)
         
         # getloops is a function not natively in Wave_read
         if wf.getloops():
@@ -309,19 +188,27 @@ class Sound:
             self.loop = -1
             self.nframes = wf.getnframes()
 
-		# readframes returns up to N string of bytes
 		# getsamplewidth returns sample width in bytes
 		# getnchannels() is 1 for MONO, or 2 for STEREO
-        self.data = self.frames2array(wf.readframes(self.nframes), wf.getsampwidth(), wf.getnchannels())
+		# Mono stays mono, the mixer plays it on both sides
+        self.nchannels = wf.getnchannels()
+        if MMAP_SAMPLES and wf.getsampwidth() == 2:
+            # Map the data chunk in place: no read, no copy
+            count = min(self.nframes, wf.getnframes()) * self.nchannels
+            self.data = samplestore.mapdata(filename, wf.getdataoffset(), count)
+        else:
+            # readframes returns up to N string of bytes
+            self.data = self.frames2array(wf.readframes(self.nframes), wf.getsampwidth(), wf.getnchannels())
         wf.close()
 
-	# Adds the a PlayingSound instance of the particular note
-	#   to the playingsounds list
-	# Then returns the PlayingSound instance
-    def play(self, note, velocity):
-        snd = PlayingSound(self, note, velocity)
-        playingsounds.append(snd)
-        return snd
+	# Starts a voice of the particular note in the voice pool
+	# Then returns its voicepool.Voice (to fade it out)
+	# origin: when the note's latency path started (None = untimed)
+	# speed: its playback rate, if compiled already (see tuning.py)
+    def play(self, note, velocity, origin=None, speed=None):
+        if speed is None:
+            speed = SPEED[note - self.midinote]
+        return voices.noteon(self, note, speed, velocity, origin)
         
 	# Converts byte string frames to 16-bit integers
     def frames2array(self, data, sampwidth, numchan):
@@ -329,34 +216,54 @@ class Sound:
             npdata = numpy.fromstring(data, dtype=numpy.int16)
         elif sampwidth == 3: # 24-bit audio frames
             npdata = samplerbox_audio.binary24_to_int16(data, len(data)/3)
-        if numchan == 1:
-            npdata = numpy.repeat(npdata, 2)
         return npdata
 
 
 def AudioCallback(outdata, frame_count, time_info, status):
-    global playingsounds
-    
-    rmlist = [] # DHP-STUB: Sounds to remove from those playing
-    playingsounds = playingsounds[-MAX_NUM_VOICES:] # Removes all sounds that cannot find a voice
+    callbackStart = latency.clock()
+    # Note-ons and releases queued since the last block (steals voices
+    # beyond MAX_NUM_VOICES), and the expression gain ramps of this block
+    voices.apply(frame_count)
+    if PROFILE_CALLBACK:
+        callbackProfiler.begin()
 
     # very important function call
-    # 1. This function tells us what sounds to stop playing via rmlist
-    # 2. Conveys Fadeout and playback speed
-    b = samplerbox_audio.mixaudiobuffers(playingsounds, rmlist, frame_count, FADEOUT, FADEOUTLENGTH, SPEED)
-    
-    # Remove all sounds that are no longer to be playing
-    for e in rmlist:
-        try:
-            playingsounds.remove(e)
-        except:
-            pass
-    b *= globalvolume
-    outdata[:] = b.reshape(outdata.shape)
-
-def MidiCallback(message, time_stamp):
+    # Mixes every active voice and frees the ones that ended
+    # (the Cython mixer releases the GIL while it mixes) into mixBuffer:
+    # in steady state the callback allocates nothing (python bench_alloc.py)
+    b = samplerbox_audio.mixvoices(voices, frame_count, FADEOUT, FADEOUTLENGTH, MIXER_THREADS, mixBuffer)
+    # Master volume, soft limiter, dither and int16 conversion in one pass
+    samplerbox_audio.outputstage(b, outdata, globalvolume, LIMITER_KNEE, ditherState)
+    if PROFILE_CALLBACK:
+        callbackProfiler.end(callbackStart, status)
+    if status and status.output_underflow:
+        blockTuner.underflows += 1
+    if voices.started:
+        RecordLatency(callbackStart, time_info)
+
+# Latency of the voices started in this block: queue wait, mixing, and the
+# device buffer (time until the block's first sample reaches the DAC)
+def RecordLatency(callbackStart, time_info):
+    now = latency.clock()
+    device = time_info.outputBufferDacTime - time_info.currentTime
+    if device <= 0: # not reported by this host API: use the stream's latency
+        device = sd.latency
+    for origin, queued in voices.started:
+        latencyMonitor.record('queue', callbackStart - queued)
+        latencyMonitor.record('mix', now - callbackStart)
+        latencyMonitor.record('device', device)
+        latencyMonitor.record('total', now + device - origin)
+    del voices.started[:]
+
+# origin: (scan start, scan end) of the sensor scan that triggered the
+# message, for latency measurement (None for MIDI input)
+# compiled: (source, rate) of a hole's note in the tuning tables
+def MidiCallback(message, time_stamp, origin=None, compiled=None):
     global playingnotes, sustain, sustainplayingnotes, instrum_sel
     
+    if LATENCY_MONITOR and origin == None:
+        origin = (latency.clock(),) * 2 # MIDI input: the path starts here
+    
     messagetype = message[0] >> 4
     messagechannel = (message[0] & 15) + 1
     # Either note is actually a note (midi, velocity) or it is a channel
@@ -377,8 +284,9 @@ def MidiCallback(message, time_stamp):
     if messagetype == 9 and velocity == 0:
         messagetype = 8
 
+    # (the holes' notes come in the harmonica's key and transposition, see
+    # ProcessScan; MIDI input is transposed by MidiInputCallback)
     if messagetype == 9:    # Message says "Note on"
-        midinote += globaltranspose
         try:
 			# WHAT THIS COMPLICATED LINE DOES
 			# -------------------------------
@@ -389,16 +297,26 @@ def MidiCallback(message, time_stamp):
 			# else playingnotes doesn't have the key, add it with an
 			#   empty list value
 			# The list aquired must be expanded to include
-			#   a new instance of PlayingSound for that specific note
+			#   a new voice for that specific note
 			
 			# TODO: Issue. We do not have a sample for distinct 
 			#              velocities. 
-            playingnotes.setdefault(midinote, []).append(samples[midinote].play(midinote, velocity))
+            sound = samples[midinote]
+            speed = None
+            if compiled and compiled[0] == sound.midinote: # the tables know this bank
+                speed = compiled[1]
+            if transposeCache: # pre-rendered buffer if there is one
+                rendered = transposeCache.lookup(sound, midinote)
+                if rendered is not sound:
+                    sound, speed = rendered, None
+            playingnotes.setdefault(midinote, []).append(sound.play(midinote, velocity, \
+                origin[0] if LATENCY_MONITOR else None, speed))
+            if LATENCY_MONITOR:
+                latencyMonitor.record('dispatch', latency.clock() - origin[1])
         except:
             pass
 
     elif messagetype == 8:  # Message says "Note off"
-        midinote += globaltranspose
         if midinote in playingnotes:
             for n in playingnotes[midinote]:
                 if sustain:
@@ -406,89 +324,209 @@ def MidiCallback(message, time_stamp):
                 else:
                     n.fadeout(1000) # Much smoother with higher value
             playingnotes[midinote] = []
+        voices.aftertouch(midinote, -1) # the next note-on starts at its velocity
             
+    elif messagetype == 10:  # Polyphonic aftertouch: expression
+        voices.aftertouch(midinote, velocity / 127.0)
+
     elif messagetype == 12:  # Instrument Change
         print 'Program change ' + str(note)
         instrum_sel = note
         LoadSamples()    # Load samples for the newly loaded instrument
         
+# External MIDI input (USB and serial): notes and aftertouch play in the
+# transposition of the GPIO buttons, like the holes
+def MidiInputCallback(message, time_stamp):
+    if message[0] >> 4 in (8, 9, 10) and len(message) > 1:
+        message = [message[0], message[1] + tunings.transpose] + list(message[2:])
+    MidiCallback(message, time_stamp)
+
 #########################################
 # LOAD SAMPLES
 #########################################
 
 LoadingThread = None
 LoadingInterrupt = False
+LoadingLock = threading.Lock() # buttons and MIDI input both switch instruments
+BankPlayable = threading.Event() # set once the instrument loading can play the holes' notes
 
 FADEOUTLENGTH = 40000
 FADEOUT = numpy.linspace(1., 0., FADEOUTLENGTH)    # by default, float64
 FADEOUT = numpy.power(FADEOUT, 6)
 FADEOUT = numpy.append(FADEOUT, \
     numpy.zeros(FADEOUTLENGTH, numpy.float32)).astype(numpy.float32)
-SPEED = numpy.power(2, numpy.arange(0.0, 84.0)/12).astype(numpy.float32)
+# SPEED[n] transposes up n semitones, SPEED[-n] transposes down n semitones
+SPEED = numpy.power(2, numpy.append(numpy.arange(0.0, 84.0), \
+    numpy.arange(-84.0, 0.0))/12).astype(numpy.float32)
 
 samples = {}
+# (rendered in the foreground offline, so renders are deterministic)
+transposeCache = transposecache.TransposeCache(TRANSPOSE_CACHE_BYTES, background=not OFFLINE_RENDER) \
+    if USE_TRANSPOSE_CACHE else None
 playingnotes = {}
 sustainplayingnotes = []
 sustain = False # By default, sustain is off
-playingsounds = []
+voices = voicepool.VoicePool(MAX_NUM_VOICES, FADEOUT, stealfade=VOICE_STEAL_FADE)
+# Mixer threads and their buffers are set up before the first callback
+if MIXER_THREADS > 1:
+    samplerbox_audio.startworkers(MIXER_THREADS)
+    samplerbox_audio.mixvoices(voices, max(AUDIO_BLOCKSIZE, MAX_AUDIO_BLOCKSIZE), FADEOUT, FADEOUTLENGTH, MIXER_THREADS)
+blockTuner = blocktuner.BlockTuner(AUDIO_BLOCKSIZE, max(AUDIO_BLOCKSIZE, MAX_AUDIO_BLOCKSIZE), UNDERRUNS_TO_GROW)
+latencyMonitor = latency.LatencyMonitor()
+callbackProfiler = callbackprofiler.CallbackProfiler(voices, AUDIO_BLOCKSIZE, SAMPLERATE)
+
+# Picks the smallest block size the mix fits in at full polyphony on this
+# Pi (offline renders keep AUDIO_BLOCKSIZE: same script, same samples).
+# It runs while the bank loads, so it errs towards larger blocks.
+def TuneBlockSize():
+    global AUDIO_BLOCKSIZE
+    blockCosts = blocktuner.measure(samplerbox_audio, MAX_NUM_VOICES, FADEOUT, FADEOUTLENGTH, SAMPLERATE, \
+        interpolation.tier(INTERPOLATION), MIXER_THREADS, MAX_AUDIO_BLOCKSIZE)
+    AUDIO_BLOCKSIZE = blocktuner.choose(blockCosts, SAMPLERATE, BLOCKSIZE_MARGIN, MAX_AUDIO_BLOCKSIZE)
+    blockTuner.blocksize = AUDIO_BLOCKSIZE
+    print blocktuner.report(blockCosts, AUDIO_BLOCKSIZE, SAMPLERATE, BLOCKSIZE_MARGIN)
+boot.mark("audio engine")
+
+# kill -USR1 <pid> prints the slowest callbacks with their voices
+signal.signal(signal.SIGUSR1, lambda signum, frame: sys.stdout.write(callbackProfiler.dumpworst() + '\n'))
 
 db = -12 
 globalvolume = 10 ** (db/20) # Global volume parameter
-globaltranspose = 0 # Altered through GPIO buttons
+ditherState = numpy.zeros(1, numpy.uint32) if DITHER else None # dither noise counter
+mixBuffer = numpy.zeros(2 * blockTuner.maxblocksize, numpy.float32) # mixed block, reused by every callback
+bankCache = bankcache.BankCache(BANK_CACHE_BYTES) if USE_BANK_CACHE else None
 
+# Switches to instrument instrum_sel, one switch at a time
 def LoadSamples():
-    global LoadingThread, LoadingInterrupt
+    with LoadingLock:
+        StartLoading()
+
+# Swaps in the cached bank, or starts ActuallyLoad in LoadingThread
+def StartLoading():
+    global LoadingThread, LoadingInterrupt, samples
 
     if LoadingThread:
         LoadingInterrupt = True
         LoadingThread.join()
         LoadingThread = None
-
+    BankPlayable.clear()
+
+    # Recently played instruments are still in memory: just swap them in
+    bank = bankCache.get(instrum_sel % NUM_INSTRUMENTS) if bankCache else None
+    if bank != None:
+        voices.clear()
+        samples = bank
+        tunings.resolve(samples, SPEED)
+        LockSamples()
+        BankPlayable.set()
+        print 'Instrument switched (cached): ' + instruments[instrum_sel % NUM_INSTRUMENTS].instrumentDirName
+        return
+
+    # ActuallyLoad fills a new bank: LoadingThread and samples change together
+    voices.clear()
+    samples = {}
+    tunings.resolve(samples, SPEED)
     LoadingInterrupt = False
     LoadingThread = threading.Thread(target=ActuallyLoad)
     LoadingThread.daemon = True
     LoadingThread.start()
 
-# This function defines 24 -> C2, 36 -> C3
-def properNote(midiNote):
-	global NOTES
-	propNoteStr = NOTES[midiNote % 12]
-	octaveNum = int(midiNote / 12)
-	propNoteStr+=str(octaveNum)
-	return propNoteStr
+# Returns the midinote whose wav file plays midiNote: its own file,
+# or the file Instrument transposes for it (None if there is neither)
+def sourceNote(instrument, files, midiNote):
+    if midiNote in files:
+        return midiNote
+    index = midiNote - 24
+    if index < 0 or index >= instrument.SAMPLES_PER_INSTRUMENT:
+        return None
+    sample = instrument.sample_file_array[index]
+    if sample == None or midiNote - sample.transpose not in files:
+        return None
+    return midiNote - sample.transpose
+
+# Notes without a wav file play a transposed neighbouring sample
+# (see Instrument._fillEmptySamplesByTranspose)
+def MapTransposedNotes(instrument):
+    for index, sample in enumerate(instrument.sample_file_array):
+        midinote = index + 24
+        if sample == None or midinote in samples:
+            continue
+        source = samples.get(midinote - sample.transpose)
+        if source == None:
+            continue
+        samples[midinote] = source
+        if transposeCache and TRANSPOSE_CACHE_AT_LOAD:
+            transposeCache.request(source, midinote)
+
+# Locks the active instrument's samples in RAM (see LOCK_SAMPLES)
+def LockSamples():
+    if LOCK_SAMPLES:
+        datas = [sound.data for sound in set(samples.values())]
+        print 'Locked %d bytes of samples' % samplestore.lockbank(datas)
 
 # DHP: WHERE INSTRUMENTS ARE LOADED AND CHANGED / SAMPLES PREPARED
 def ActuallyLoad():
-    global instrum_sel, samples, playingsounds, globalvolume, globaltranspose
-    playingsounds = []
-    samples = {}
+    global instrum_sel, samples, globalvolume
 
-	# use current folder (containing 0 Saw) if no user media containing samples has been found
-    samplesdir = SAMPLES_DIR if os.listdir(SAMPLES_DIR) else '.'
+	# the samples directory LoadInstruments indexed (see SamplesDir)
+    samplesdir = instrumentIndex.samplesdir
     # Get specific instrument directory as the target for grabbing samples
     print "instrum_sel = ", instruments[instrum_sel].instrumentDirName
     samplesdir += os.sep + instruments[instrum_sel % NUM_INSTRUMENTS].instrumentDirName
 
-	# TODO: Limit this to the midi notes that instruments actually have.
-	#MIDI_MIN = 24; MIDI_MAX = 84
-    #for midinote in range(MIDI_MIN, MIDI_MAX+1):
-    for midinote in range(0, 127):
-		if LoadingInterrupt:
-			return
-		
-		# Proper notes are like "c2", "c5", etc
-		# Improper notes are just the midinote values "24", "60", etc
-		properNote1 = properNote(midinote)
-		#print "properNote1 = ", properNote1
-		fn = os.path.join(samplesdir, "%s.wav" % properNote1) # proper
-		fn2 = os.path.join(samplesdir, "%d.wav" % midinote) # numeric
-		if os.path.isfile(fn):
-			samples[midinote] = Sound(fn, midinote)
-		elif os.path.isfile(fn2):
-			samples[midinote] = Sound(fn2, midinote)
-		
+    instrument = instruments[instrum_sel % NUM_INSTRUMENTS]
+    tier = interpolation.tier(instrument.interpolation or INTERPOLATION)
+
+    # A compiled bank (python bankpack.py) maps every sample in one go
+    pack = bankpack.openbank(samplesdir) if USE_BANK_PACKS else None
+    if pack != None:
+        start = time.time()
+        sounds = [Sound(os.path.join(samplesdir, entry['file']), entry['midinote'], packed=entry, tier=tier)
+                  for entry in pack['samples']]
+        for midinote, (index, transpose) in pack['notes'].items():
+            samples[midinote] = sounds[index]
+            if transpose and transposeCache and TRANSPOSE_CACHE_AT_LOAD:
+                transposeCache.request(sounds[index], midinote)
+        if PREFAULT_SAMPLES:
+            samplestore.prefault([sound.data for sound in sounds])
+        print 'Load pack: %d samples in %.1f ms' % (len(sounds), (time.time() - start) * 1000)
+        tunings.resolve(samples, SPEED)
+        BankPlayable.set()
+        initial_keys = set(sound.midinote for sound in sounds)
+    else:
+        # The instrument index's listing (one stat to check it is current)
+        files = instrumentIndex.notes(instrument.instrumentDirName)
+
+        if LAZY_LOADING:
+            # Samples behind the notes the holes can play right now first,
+            # then the rest, nearest transpose steps first
+            reachable = set(int(n) for n in tunings.active.flat)
+            playable = set(sourceNote(instrument, files, n) for n in reachable)
+            playable.discard(None)
+            distance = lambda n: min(abs(n - r) for r in reachable)
+            phases = [("playable", sorted(playable)),
+                      ("prefetch", sorted(set(files) - playable, key=distance))]
+        else:
+            phases = [("all", sorted(files))]
+
+        for phase, notes in phases:
+            start = time.time()
+            for midinote in notes:
+                if LoadingInterrupt:
+                    return
+                samples[midinote] = Sound(os.path.join(samplesdir, files[midinote]), midinote, tier=tier)
+            MapTransposedNotes(instrument)
+            # Keep the instrument resident so the audio callback
+            # never waits for the SD card
+            if PREFAULT_SAMPLES:
+                samplestore.prefault([samples[n].data for n in notes])
+            print 'Load %s: %d samples in %.1f ms' % (phase, len(notes), (time.time() - start) * 1000)
+            tunings.resolve(samples, SPEED) # the holes' rates for the samples loaded so far
+            BankPlayable.set() # after the first phase
+
+        initial_keys = set(files)
+
 	# This is where velocity for each sample are distinguished
-    initial_keys = set(samples.keys())
     #for midinote in xrange(128): 		# For every pitch
         #lastvelocity = None
         #for velocity in xrange(128): 	# For every velocity
@@ -508,30 +546,87 @@ def ActuallyLoad():
                 #except:
                     #pass
     
+    # Sinc tables of every transpose, so no note-on has to build one
+    if tier == interpolation.SINC:
+        for midinote, sound in samples.items():
+            interpolation.kernel(tier, SPEED[midinote - sound.midinote])
+
+    LockSamples()
+    if bankCache:
+        bankCache.put(instrum_sel % NUM_INSTRUMENTS, samples)
+        print 'Bank cache: %(hits)d hits, %(misses)d misses, %(evictions)d evictions, %(bytes)d bytes' % bankCache.stats()
+
     instrumentStr = instruments[instrum_sel].instrumentDirName
     if len(initial_keys) > 0:
         print 'Instrument loaded: ' + instrumentStr
     else:
         print 'Instrument empty: ' + instrumentStr
+
+# Gets every note of a tuning ready to play from memory: waits for its
+# samples if they are still loading, then has the transpose cache's
+# worker page them in and render its transposed notes
+def WarmUpTuning(layout, key, transpose):
+    notes = [int(n) for n in tunings.lookup(layout, key, transpose).flat]
+    with LoadingLock: # the loading thread and the bank it fills
+        loading, bank = LoadingThread, samples
+    if loading and loading.is_alive() and any(n not in bank for n in notes):
+        loading.join() # still loading some of them
+    notes = [n for n in notes if n in bank]
+    datas = [sound.data for sound in set(bank[n] for n in notes)]
+    if transposeCache:
+        if PREFAULT_SAMPLES:
+            transposeCache.defer(samplestore.prefault, datas)
+        for midinote in notes:
+            if bank[midinote].midinote != midinote:
+                transposeCache.request(bank[midinote], midinote)
+    elif PREFAULT_SAMPLES:
+        samplestore.prefault(datas)
+
+# Switches the holes to another layout, key and / or transposition (see
+# tuning.py) once its notes are loaded, their warm-up queued ahead of
+# the first notes in it
+def SwitchTuning(layout=None, key=None, transpose=None):
+    layout = tunings.layout if layout is None else tunings.layoutindex(layout)
+    key = tunings.key if key is None else tunings.keyindex(key)
+    transpose = tunings.transpose if transpose is None else transpose
+    start = time.time()
+    WarmUpTuning(layout, key, transpose)
+    tunings.select(layout, key, transpose)
+    print 'Tuning: %s (switched in %.1f ms)' % (tunings.describe(), (time.time() - start) * 1000)
     
 
 #########################################
 # OPEN AUDIO DEVICE
 #########################################
-try:
-    sd = sounddevice.OutputStream(device=AUDIO_DEVICE_ID, blocksize=256, samplerate=44100, channels=2, dtype='int16', callback=AudioCallback)
+# (offline, offlinerender.render calls AudioCallback instead)
+sd = None
+
+# Opens the output stream with blocksize frames per callback, closing the
+# one playing if any
+def OpenAudio(blocksize):
+    global sd
+    if sd:
+        sd.stop()
+        sd.close()
+    sd = sounddevice.OutputStream(device=AUDIO_DEVICE_ID, blocksize=blocksize, samplerate=SAMPLERATE, channels=2, dtype='int16', callback=AudioCallback)
     sd.start()
+    callbackProfiler.setblocksize(blocksize, SAMPLERATE)
+    print 'Audio: %d frames per block (%.1f ms), output latency %.1f ms' % ( \
+        blocksize, 1000.0 * blocksize / SAMPLERATE, 1000.0 * sd.latency)
+
+# Startup phase: the block size, then the stream
+def StartAudio():
+    global sounddevice
+    import sounddevice
+    if AUTO_BLOCKSIZE:
+        TuneBlockSize()
+    OpenAudio(AUDIO_BLOCKSIZE)
     print 'Opened audio device #%i' % AUDIO_DEVICE_ID
-except:
-    print 'Invalid audio device #%i' % AUDIO_DEVICE_ID
-    exit(1)
 
 #########################################
 # BUTTONS THREAD (RASPBERRY PI GPIO)
 #########################################
-if USE_BUTTONS:
-    import RPi.GPIO as GPIO
-	
+if USE_BUTTONS and not OFFLINE_RENDER:
     lastbuttontime = 0
 
     def Buttons():
@@ -541,7 +636,7 @@ if USE_BUTTONS:
         GPIO.setup(23, GPIO.IN, pull_up_down=GPIO.PUD_UP) # + transpose
         GPIO.setup(24, GPIO.IN, pull_up_down=GPIO.PUD_UP) # - transpose
         GPIO.setup(27, GPIO.IN, pull_up_down=GPIO.PUD_UP) # sustain
-        global instrum_sel, lastbuttontime, globaltranspose, sustain, \
+        global instrum_sel, lastbuttontime, sustain, \
         sustainplayingnotes
         while True:
             now = time.time()
@@ -560,14 +655,12 @@ if USE_BUTTONS:
             elif not GPIO.input(23) and (now - lastbuttontime) > 0.2:
 				lastbuttontime = now
 				# up by one semitone
-				globaltranspose = globaltranspose + 1
-				print "transposed={0}".format(globaltranspose)
+				SwitchTuning(transpose=tunings.transpose + 1)
             
             elif not GPIO.input(24) and (now - lastbuttontime) > 0.2:
 				lastbuttontime = now
 				# down by one semitone
-				globaltranspose = globaltranspose - 1 
-				print "transposed={0}".format(globaltranspose)
+				SwitchTuning(transpose=tunings.transpose - 1)
 				
             elif not GPIO.input(27) and (now - lastbuttontime) > 0.2:
 				lastbuttontime = now
@@ -586,15 +679,14 @@ if USE_BUTTONS:
 
             time.sleep(0.020)
 
-    ButtonsThread = threading.Thread(target=Buttons)
-    ButtonsThread.daemon = True
-    ButtonsThread.start()
-
-if USE_SERIALPORT_MIDI:
-    import serial
-
-    ser = serial.Serial('/dev/ttyAMA0', baudrate=38400)       # see hack in /boot/cmline.txt : 38400 is 31250 baud for MIDI!
+    def StartButtons():
+        global GPIO
+        import RPi.GPIO as GPIO
+        ButtonsThread = threading.Thread(target=Buttons)
+        ButtonsThread.daemon = True
+        ButtonsThread.start()
 
+if USE_SERIALPORT_MIDI and not OFFLINE_RENDER:
     def MidiSerialCallback():
         message = [0, 0, 0]
         while True:
@@ -608,41 +700,59 @@ if USE_SERIALPORT_MIDI:
                 if i == 2 and message[0] >> 4 == 12:  # program change: don't wait for a third byte: it has only 2 bytes
                     message[2] = 0
                     i = 3
-            MidiCallback(message, None)
+            MidiInputCallback(message, None)
 
-    MidiThread = threading.Thread(target=MidiSerialCallback)
-    MidiThread.daemon = True
-    MidiThread.start()
+    def StartSerialMidi():
+        global ser
+        import serial
+        ser = serial.Serial('/dev/ttyAMA0', baudrate=38400)       # see hack in /boot/cmline.txt : 38400 is 31250 baud for MIDI!
+        MidiThread = threading.Thread(target=MidiSerialCallback)
+        MidiThread.daemon = True
+        MidiThread.start()
 
 def turnOff(midiNote, velocity):
     # Turn blow off
     message = [128,midiNote,velocity]
     MidiCallback(message, None)
 
-# Parses instruments from the sample directory and its paths
+# The samples directory: SAMPLES_DIR, or the current folder (containing
+# 0 Saw) if no user media containing samples has been found
+def SamplesDir():
+	return SAMPLES_DIR if os.listdir(SAMPLES_DIR) else '.'
+
+# Parses instruments from the sample directory and its paths, through the
+# instrument index (see instrumentindex.py): a warm start stats each
+# directory once, a cold start scans them all in parallel
 def LoadInstruments():
-	global instruments, NUM_INSTRUMENTS
+	global instruments, NUM_INSTRUMENTS, instrumentIndex
 	
 	# The following instruments will be available for playing
-	instruments.append(Instrument("0 Saw"))
-	instruments.append(Instrument("1 organkorgopoly800"))
-	instruments.append(Instrument("2 mellotron"))
-	instruments.append(Instrument("3 Organ"))
-	instruments.append(Instrument("4 Rhodes"))
-	instruments.append(Instrument("5 Trumpet"))
-	instruments.append(Instrument("6 Strings"))
-	instruments.append(Instrument("7 HouseSynth"))
-	instruments.append(Instrument("8 TechnoString"))
-	instruments.append(Instrument("9 Bells"))
-	instruments.append(Instrument("10 Harmonica"))
-	instruments.append(Instrument("11 Voice"))
-	instruments.append(Instrument("12 Trombone"))
-	instruments.append(Instrument("13 BuzzSynth"))
-	instruments.append(Instrument("14 SynthOrchestra"))
-	#instruments.append(Instrument("15 RhodesChords"))
-	#instruments.append(Instrument("16 SynthOrchestra"))
+	# (instrumentIndex.instrument(name, interpolation="sinc") overrides INTERPOLATION)
+	names = ["0 Saw",
+		"1 organkorgopoly800",
+		"2 mellotron",
+		"3 Organ",
+		"4 Rhodes",
+		"5 Trumpet",
+		"6 Strings",
+		"7 HouseSynth",
+		"8 TechnoString",
+		"9 Bells",
+		"10 Harmonica",
+		"11 Voice",
+		"12 Trombone",
+		"13 BuzzSynth",
+		"14 SynthOrchestra",
+		#"15 RhodesChords",
+		#"16 SynthOrchestra",
+		]
+	instrumentIndex = instrumentindex.InstrumentIndex(SamplesDir())
+	instrumentIndex.refresh(names)
+	for name in names:
+		instruments.append(instrumentIndex.instrument(name))
 	NUM_INSTRUMENTS = len(instruments)
 	
+	print instrumentIndex.report()
 	print "FINISHED LOADING ALL",  NUM_INSTRUMENTS, "INSTRUMENTS"
 
 # Identifies the average pressure reading while
@@ -655,10 +765,9 @@ def CalibrateSensors(numTests=10, sleepValue=0.1):
 						  CHANNELS_FROM_ADC_TWO)
 	# Find value for each sensor 10 times
 	for i in range(numTests):
-		for ch in range(CHANNELS_FROM_ADC_ONE): # each channel of DAC0
-			sums[ch] += mcp0.read_adc(ch)
-		for ch in range(CHANNELS_FROM_ADC_TWO): # each channel of DAC1
-			sums[ch+CHANNELS_FROM_ADC_ONE] += mcp1.read_adc(ch)
+		values, scanTime = adc.scan() # every channel of both DACs
+		for ch in range(len(sums)):
+			sums[ch] += values[ch]
 		time.sleep(sleepValue)
 	
 	for ch in range(len(restingSensorValues)):
@@ -668,25 +777,74 @@ def CalibrateSensors(numTests=10, sleepValue=0.1):
 	
 	print restingSensorValues
 
+# A few quick scans spread over numTests * sleepValue seconds, each in its
+# own row (adc.scan() reuses one frame)
+def CheckScans(numTests=10, sleepValue=0.01):
+	scans = numpy.zeros((numTests, CHANNELS_FROM_ADC_ONE + CHANNELS_FROM_ADC_TWO), numpy.int32)
+	for row in scans:
+		adc.scan(row)
+		time.sleep(sleepValue)
+	return scans
+
+# Keeps the resting values for the next start (a read-only card only
+# costs the warm start)
+def SaveCalibration(resting):
+	try:
+		calibration.save(CALIBRATION_FILE, resting)
+	except (IOError, OSError) as e:
+		print 'Could not save the calibration:', e
+
 # Sets the raspi system volume.
 def SetSystemVolume(vol):
     call(["amixer", "-D", "pulse", "sset", "Master", str(vol)+"%"])
 
 
 #########################################
-# LOAD FIRST SOUNDBANK
+# STARTUP PHASES
 #########################################
 instrum_sel = 5
-SetSystemVolume(98)
-LoadInstruments()
-LoadSamples()
-CalibrateSensors(numTests=10, sleepValue=0.1)
 
-#########################################
-# MIDI DEVICES DETECTION (MAIN LOOP)
-#########################################
-midi_in = [rtmidi.MidiIn()]
-previous = []
+# The first instrument's playable notes (the rest keeps loading in the
+# background); offline, the whole instrument is loaded before the first
+# block
+def LoadFirstBank():
+    LoadSamples()
+    if OFFLINE_RENDER:
+        if LoadingThread:
+            LoadingThread.join()
+        return
+    while not BankPlayable.wait(0.05) and LoadingThread and LoadingThread.is_alive():
+        pass
+
+# The resting sensor values, then the sensors' conditioning around them.
+# Offline the sensors rest at the script's rest frame (512 if it has none)
+def StartSensors():
+    global restingSensorValues
+    OpenSensors()
+    if OFFLINE_RENDER:
+        restingSensorValues = offlinerender.restframe(performance) or \
+            [512] * (CHANNELS_FROM_ADC_ONE + CHANNELS_FROM_ADC_TWO)
+    else:
+        # Warm start: the saved resting values, if a few quick scans agree
+        restingSensorValues = calibration.load(CALIBRATION_FILE, \
+            CHANNELS_FROM_ADC_ONE + CHANNELS_FROM_ADC_TWO, CALIBRATION_MAX_AGE)
+        if restingSensorValues and calibration.agrees(restingSensorValues, \
+                CheckScans(), CALIBRATION_CHECK):
+            print 'Resting sensor values from', CALIBRATION_FILE, restingSensorValues
+        else:
+            CalibrateSensors(numTests=10, sleepValue=0.1)
+            SaveCalibration(restingSensorValues)
+    SetUpConditioner()
+
+# External MIDI: the serial port and, through their own low-rate thread,
+# new USB MIDI ports
+def StartMidi():
+    global rtmidi, midiWatcher
+    if USE_SERIALPORT_MIDI:
+        StartSerialMidi()
+    import rtmidi_python as rtmidi
+    midiWatcher = midiwatch.MidiPortWatcher(rtmidi, MidiInputCallback, MIDI_SCAN_INTERVAL)
+    midiWatcher.start()
 
 
 # We need to select proper blow and draw 
@@ -695,84 +853,184 @@ previous = []
 blowTolerance = 22
 drawTolerance = 20
 sensorCount = CHANNELS_FROM_ADC_ONE + CHANNELS_FROM_ADC_TWO
-blowThresh = map(add, restingSensorValues, [blowTolerance]*sensorCount)
-drawThresh = map(add, restingSensorValues, [-drawTolerance]*sensorCount)
+
+# Filtering, hysteresis and debounce of all the sensors (the thresholds
+# are its blowon / drawon arrays), and the tracking of their resting
+# values while idle, which moves the thresholds with them (a performance
+# script gives its own resting values)
+def SetUpConditioner():
+    global conditioner, restTracker, blowLevel, drawLevel
+    conditioner = sensorfilter.SensorConditioner(restingSensorValues, blowTolerance, drawTolerance, \
+        SENSOR_FILTER, SENSOR_WINDOW, hysteresis=SENSOR_HYSTERESIS, hold=int(round(SENSOR_HOLD * SCAN_RATE)))
+    restTracker = calibration.RestTracker(conditioner, every=SCAN_RATE // 10) \
+        if AUTO_CALIBRATE and not OFFLINE_RENDER else None
+    blowLevel = conditioner.blowon
+    drawLevel = conditioner.drawon
 
 # Which sensors are hooked up and should be read from. Others will be ignored
 activeChannels = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
 
-channelsFromADC1 = [0,1,2,3,4]
-channelsFromADC2 = [0,1,2,3,4]
-
-# 0 for off, -1 for draw, +1 for blow
-prevValues = [0] * (CHANNELS_FROM_ADC_ONE+CHANNELS_FROM_ADC_TWO)
 
 # draw & blow boost are essentially scaling up the detected velocity
 blowBoost = 4
 drawBoost = 4
-# C E G C E G C E G C
-blowNotes = [36,40,43,48,52,55,60,64,67,72] 
-# B D F
-drawNotes = [47,50,53,59,62,65,71,74,77,83] # Based on
 ON = 144
 OFF = 128
 
+# The note each hole last started, blown and drawn: the ones to stop and
+# to express even after the key or transposition changed under them
+heldNotes = tunings.active.copy()
+# Breath expression: gain of every blow and draw note, -1 when not sounding
+expressionGains = numpy.full(2 * sensorCount, -1, numpy.float32)
+
+# Turns one scan of the sensors into note on/off messages and expression.
+# scanStart and scanTime: when the scan started and ended (see latency.py)
+def ProcessScan(values, scanStart, scanTime):
+    # Which channels start blowing, start drawing or stop, after filtering,
+    # hysteresis and debounce (see sensorfilter.py); velocities come from
+    # the filtered values
+    changed = conditioner.update(values)
+    if restTracker:
+        restTracker.update(values)
+    state = conditioner.state
+    level = conditioner.level
+    active, sources, rates = tunings.current # one tuning for the whole scan
+    for ch in numpy.flatnonzero(changed):
+        if ch not in activeChannels:
+            continue
+        
+        if state[ch] == sensorfilter.BLOW: # BLOW NOTE TRIGGERED
+            blowNote = heldNotes[tuning.BLOW, ch] = int(active[tuning.BLOW, ch])
+            velocity = blowBoost * int(((level[ch]-blowLevel[ch])*127.0)/512.0)
+            if velocity > 127: velocity = 127 # max velocity
+            if velocity < minIssuedVelocity: velocity = minIssuedVelocity # More narrow velocity range
+            # Turn blow on
+            message = [ON,blowNote,velocity]
+            MidiCallback(message, None, (scanStart, scanTime), \
+                (sources[tuning.BLOW, ch], rates[tuning.BLOW, ch]))
+            latencyMonitor.record('scan', scanTime - scanStart)
+        elif state[ch] == sensorfilter.DRAW: # DRAW NOTE TRIGGERED
+            drawNote = heldNotes[tuning.DRAW, ch] = int(active[tuning.DRAW, ch])
+            velocity = drawBoost * int(((-level[ch]+drawLevel[ch])*127.0)/512.0)
+            if velocity > 127: velocity = 127 # Loudest
+            if velocity < minIssuedVelocity: velocity = minIssuedVelocity # Softest
+            # Turn draw on
+            message = [ON,drawNote,velocity]
+            MidiCallback(message, None, (scanStart, scanTime), \
+                (sources[tuning.DRAW, ch], rates[tuning.DRAW, ch]))
+            latencyMonitor.record('scan', scanTime - scanStart)
+        else:
+            # Send off signal to both blow note and draw note
+            # for the specific channel
+            message = [OFF,int(heldNotes[tuning.BLOW, ch]),127]
+            MidiCallback(message, None)
+            message = [OFF,int(heldNotes[tuning.DRAW, ch]),127]
+            MidiCallback(message, None)    
+
+    # Every scan, the sounding holes' gains follow their pressure (same
+    # scale as the note-on velocity), as one batch for all holes
+    if BREATH_EXPRESSION:
+        blow = numpy.clip(blowBoost * (level - blowLevel) * (127.0 / 512.0), minIssuedVelocity, 127)
+        draw = numpy.clip(drawBoost * (drawLevel - level) * (127.0 / 512.0), minIssuedVelocity, 127)
+        expressionGains[:sensorCount] = numpy.where(state == sensorfilter.BLOW, blow / 127.0, -1)
+        expressionGains[sensorCount:] = numpy.where(state == sensorfilter.DRAW, draw / 127.0, -1)
+        voices.express(heldNotes.ravel(), expressionGains)
+
+
+#########################################
+# BOOT
+#########################################
+# Independent phases run side by side; the harmonica plays as soon as
+# the audio, the first bank and the sensors are ready, while the rest
+# (MIDI, buttons, system volume) may still be starting
+if OFFLINE_RENDER:
+    performance = offlinerender.readscript(sys.argv[2])
+else:
+    boot.run("volume", lambda: SetSystemVolume(98))
+    boot.run("audio", StartAudio)
+boot.run("instruments", LoadInstruments)
+boot.run("first bank", LoadFirstBank, after=("instruments",))
+boot.run("sensors", StartSensors)
+if not OFFLINE_RENDER:
+    # (a button or a program change loads an instrument: not before the first)
+    if USE_BUTTONS:
+        boot.run("buttons", StartButtons, after=("first bank",))
+    boot.run("midi", StartMidi, after=("first bank",))
+failed = boot.wait("instruments", "first bank", "sensors", *(() if OFFLINE_RENDER else ("audio",)))
+for phase, error in failed:
+    if phase == "audio":
+        print 'Invalid audio device #%i' % AUDIO_DEVICE_ID
+    else:
+        print 'Startup failed in %s: %s' % (phase, error)
+if failed:
+    exit(1)
+boot.ready()
+print boot.timeline()
+
+#########################################
+# OFFLINE RENDER
+#########################################
+if OFFLINE_RENDER:
+    def RenderScan(values):
+        now = latency.clock()
+        ProcessScan(values, now, now)
+
+    def RenderMidi(message):
+        MidiCallback(message + [0] * (3 - len(message)), None)
+        if LoadingThread: # program change: load it all before going on
+            LoadingThread.join()
+
+    frames, wall = offlinerender.render(performance, AUDIO_BLOCKSIZE, SAMPLERATE, \
+        RenderScan, RenderMidi, AudioCallback)
+    offlinerender.writewav(sys.argv[3], frames, SAMPLERATE)
+    seconds = len(frames) / SAMPLERATE
+    print 'Rendered %.1f s of audio in %.2f s (%.1fx realtime) to %s' % ( \
+        seconds, wall, seconds / wall, sys.argv[3])
+    print conditioner.report()
+    sys.exit(0)
+
+#########################################
+# MAIN LOOP
+#########################################
+scheduler = scanloop.ScanScheduler(SCAN_RATE)
+lastReport = time.time()
+lastSave = time.time()
+bootPending = not boot.finished()
+
 # This is the infinite loop where all the magic happens!
 while True:
-    # Read all the ADC channel values in a list.
-    values = [0]*10
+    scheduler.wait() # fixed scan rate, no drift
+    if SCAN_REPORT_INTERVAL and time.time() - lastReport > SCAN_REPORT_INTERVAL:
+        lastReport = time.time()
+        print scheduler.report()
+        if LATENCY_MONITOR:
+            print latencyMonitor.report()
+        if PROFILE_CALLBACK:
+            print callbackProfiler.report()
+        print conditioner.report()
+        if restTracker:
+            print restTracker.report()
+        # Once the phases still starting at the first note are done too
+        if bootPending and boot.finished():
+            bootPending = False
+            print boot.timeline()
+
+    # The followed resting values become the next warm start's
+    if restTracker and time.time() - lastSave > CALIBRATION_SAVE_INTERVAL:
+        lastSave = time.time()
+        SaveCalibration(conditioner.resting)
+
+    # Underruns keep coming: a larger block size (up to MAX_AUDIO_BLOCKSIZE)
+    if AUTO_BLOCKSIZE and blockTuner.check():
+        print 'Audio underruns: reopening the stream'
+        OpenAudio(blockTuner.blocksize)
+
+    # Read all the ADC channel values in one frame.
+    scanStart = latency.clock()
+    values, scanTime = adc.scan()
     #print prevValues
-    for ch in channelsFromADC1: # each channel of ADC #1
-        # (we have 2 ADCs and use 5 channels from each to read the 10 sensors)
-        values[ch] = mcp0.read_adc(ch)
-    for ch in channelsFromADC2: # each channel of ADC #1
-        # (we have 2 ADCs and use 5 channels from each to read the 10 sensors)
-        values[ch+5] = mcp1.read_adc(ch)
 
     # Print the ADC values.    
     #print('| {0:>4} | {1:>4} | {2:>4} | {3:>4} | {4:>4} | {5:>4} | {6:>4} | {7:>4} | {8:>4} | {9:>4}'.format(*values))
 
-    # For every channel determine whether the channel is making sound
-    # and at what velocity
-    for ch in activeChannels:
-        drawNote = drawNotes[ch]
-        blowNote = blowNotes[ch]
-        
-        if (values[ch] > blowThresh[ch]): # BLOW NOTE TRIGGERED
-            if (prevValues[ch]!=1): # Need to start the note
-                prevValues[ch] = 1
-                
-                velocity = blowBoost * int(((values[ch]-blowThresh[ch])*127.0)/512.0)
-                if velocity > 127: velocity = 127 # max velocity
-                if velocity < minIssuedVelocity: velocity = minIssuedVelocity # More narrow velocity range
-                # Turn blow on
-                message = [ON,blowNote,velocity]
-                MidiCallback(message, None)
-        elif (values[ch] < drawThresh[ch]): # DRAW NOTE TRIGGERED
-            if (prevValues[ch]!=2): # Need to start the note
-                prevValues[ch] = 2
-                
-                velocity = drawBoost * int(((-values[ch]+drawThresh[ch])*127.0)/512.0)
-                if velocity > 127: velocity = 127 # Loudest
-                if velocity < minIssuedVelocity: velocity = minIssuedVelocity # Softest
-				# Turn draw on
-                message = [ON,drawNote,velocity]
-                MidiCallback(message, None)
-        elif (prevValues[ch]!=0):
-			# Send off signal to both blow note and draw note
-			# for the specific channel
-            prevValues[ch] = 0
-            message = [OFF,blowNote,127]
-            MidiCallback(message, None)
-            message = [OFF,drawNote,127]
-            MidiCallback(message, None)    
-    
-    
-    for port in midi_in[0].ports:
-        if port not in previous and 'Midi Through' not in port:
-            midi_in.append(rtmidi.MidiIn())
-            midi_in[-1].callback = MidiCallback
-            midi_in[-1].open_port(port)
-            print 'Opened MIDI: ' + port
-            previous = midi_in[0].ports
-        time.sleep(0.05)
+    ProcessScan(values, scanStart, scanTime)
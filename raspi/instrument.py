@@ -0,0 +1,150 @@
+from __future__ import division
+# Instruments: which wav file (and transpose) plays each midinote
+# Shared by dhp.py and bankpack.py
+
+import os
+import glob
+
+NOTES = ["c", "c#", "d", "d#", "e", "f", "f#", "g", "g#", "a", "a#", "b"]
+
+class Sample():
+    
+    def __init__(self, fileName, transpose, start=0):
+        self.fileName = fileName
+        self.transpose = transpose
+        self.start = start
+        
+    def __str__(self):
+		return "[file={0}, trans={1}, start={2}]".format \
+		(self.fileName, self.transpose, self.start)
+
+# Instrument is separate from the harmonica tuning (tuning.py).
+# An <instrument, harmonica-tuning> pair is used
+class Instrument():
+    SAMPLES_PER_INSTRUMENT = 60 # midivalues 24 (C2) thru 84 (C7) 
+    
+    # interpolation: 'linear', 'cubic' or 'sinc' for the transposed notes
+    # of this instrument (None = the global setting, see interpolation.py)
+    # files: the wav files of the directory, if already listed
+    # mapping: (fileName, transpose) of every note, from instrumentindex.py
+    def __init__(self, instrumentDirName, globalstart=0, interpolation=None, files=None, mapping=None):
+		# Holds array of Sample objects
+        self.sample_file_array = [None] * self.SAMPLES_PER_INSTRUMENT
+        self.instrumentDirName = instrumentDirName
+        self.globalstart = globalstart
+        self.interpolation = interpolation
+        # Worked out before: nothing to read or parse
+        if mapping != None:
+            for index, sample in enumerate(mapping):
+                if sample != None:
+                    fileName, transpose = sample
+                    self.sample_file_array[index] = Sample(fileName, transpose, globalstart if transpose else 0)
+            return
+        # From the samplesDirectory place corresponding samples into 
+        # the file string array
+        if files == None:
+            exp = instrumentDirName + os.sep + "*.wav"
+            files = [os.path.basename(f) for f in glob.glob(exp)]
+        
+        for f in files: # The sample file is f
+			#print(f)
+			# break the filename into its components
+			items = f.split('.')
+			if(items[0].isdigit()):
+				midiNote = int(items[0])
+			else:
+				notename = items[0]
+				# Get numeric midinote value (0-127) for pitch
+				midiNote = NOTES.index(notename[:-1].lower()) + (int(notename[-1])+2) * 12
+			
+			# adjust midiNote to find proper index for sample array
+			index = midiNote - 24
+			if(index>=0 and index<self.SAMPLES_PER_INSTRUMENT):
+				self.sample_file_array[index] = Sample(f,0)
+				
+			#print self.sample_file_array
+		
+		# Done reading in array with samples that have specific sample files
+		
+		# Now figure out which samples need a transpose and by how much
+		
+		# Basic Design Decision: Take last available sample and upshift 
+		# by pitch difference. 
+		# One exception: For empty samples within the array where no sample 
+		# existed at a lower pitch (AKA nothing to be pitch shifted upwards)
+		# The pitch will be dropped from the first available sample pitch.
+        self._fillEmptySamplesByTranspose()
+        #for sample in self.sample_file_array:
+		#    print str(sample)
+        #print("-------------------"*2)
+		    
+		
+    
+    # Fills in non-existing samples for the specific instrument using
+    # transposed versions of existing samples
+    #
+    # Should only be called once (during the initialization of object)
+    # Private function
+    def _fillEmptySamplesByTranspose(self):
+		woTransMostRecent = -1
+		# forward iteration over items (handles tranpose upward)
+		indexRange = range(self.SAMPLES_PER_INSTRUMENT)
+		for s in indexRange:
+			
+			if ( self.sample_file_array[s]!=None): 	
+				# sample already exists (w/o transpose)
+				woTransMostRecent = s # keep reference
+			elif ( (self.sample_file_array[s]==None) \
+			and (woTransMostRecent != -1)):
+				# sample needs a transpose from a lower pitch sample
+				orig_samp_obj = self.sample_file_array[woTransMostRecent]
+				fn = orig_samp_obj.fileName
+				transposeBy = s-woTransMostRecent
+				self.sample_file_array[s] = Sample(fn, transposeBy, self.globalstart) 
+		
+		woTransMostRecent = -1
+		# Backward iteration over sample items (down tranposes)
+		indexRange.reverse()
+		for s in indexRange:
+			
+			if ( self.sample_file_array[s]!=None): 	
+				# sample already exists (w/o transpose)
+				woTransMostRecent = s # keep reference
+			elif ( (self.sample_file_array[s]==None) \
+			and (woTransMostRecent != -1)):
+				# sample needs a transpose from a lower pitch sample
+				orig_samp_obj = self.sample_file_array[woTransMostRecent]
+				fn = orig_samp_obj.fileName
+				transposeBy = s-woTransMostRecent # Switched
+				self.sample_file_array[s] = Sample(fn, transposeBy, self.globalstart) 
+		# Now all indices in the sample array contain valid Sample 
+		# objects (midi-mapping is complete)
+		
+    def getSample(midiNote):
+        sample = sample_file_array[midiNote]
+        transposeBy = sample.transpose
+        # TODO: prepare midinote or WAVE with transpose where needed
+        return
+
+# This function defines 24 -> C2, 36 -> C3
+def properNote(midiNote):
+	global NOTES
+	propNoteStr = NOTES[midiNote % 12]
+	octaveNum = int(midiNote / 12)
+	propNoteStr+=str(octaveNum)
+	return propNoteStr
+
+# Lists an instrument directory once and returns {midinote: filename}
+# (names: the directory's listing, if already read)
+# Proper notes are like "c2", "c5", etc
+# Improper notes are just the midinote values "24", "60", etc
+def noteFiles(dirname, names=None):
+    properNotes = dict((properNote(n) + ".wav", n) for n in range(0, 127))
+    files = {}
+    for fname in (os.listdir(dirname) if names == None else names):
+        base = fname.split('.')[0]
+        if fname in properNotes:
+            files[properNotes[fname]] = fname # proper wins over numeric
+        elif fname == base + ".wav" and base.isdigit() and int(base) < 127:
+            files.setdefault(int(base), fname)
+    return files
@@ -0,0 +1,148 @@
+#
+#  instrumentindex.py: Cached scans of the instrument directories
+#
+#  At startup every Instrument globbed its directory and worked out which
+#  sample plays each midinote, and ActuallyLoad listed the directory again
+#  when the instrument was loaded. InstrumentIndex does the scan once per
+#  directory and keeps the result in a small JSON file in the samples
+#  directory:
+#
+#    files    the wav files of the directory
+#    notes    {midinote: file} as noteFiles() finds them (ActuallyLoad)
+#    mapping  (file, transpose) of every note of the Instrument
+#
+#  Each entry records its directory's mtime, which changes whenever a file
+#  is added, removed or renamed. A warm start stats every directory once
+#  and reuses the entries that still match; the stale and missing ones are
+#  rescanned in parallel (listing an SD card or a USB stick is mostly
+#  waiting), and the file is rewritten only if something changed.
+#  Directories modified within the last RACY seconds are not cached:
+#  FAT file systems keep mtimes to 2 seconds, so a change in the same
+#  tick as the scan would go unnoticed.
+#
+#  Rewriting a wav file in place leaves the directory's mtime alone; the
+#  bank packs (bankpack.py) still check the files themselves.
+#
+
+from __future__ import division
+import os
+import json
+import time
+from multiprocessing.pool import ThreadPool
+from instrument import Instrument, noteFiles
+
+INDEXNAME = "instruments.dhpindex"
+VERSION = 1
+RACY = 2.0
+
+
+# The index entry of one instrument directory (None if it does not exist)
+def scan(dirname):
+    try:
+        mtime = os.stat(dirname).st_mtime
+        names = sorted(os.listdir(dirname))
+    except OSError:
+        return None
+    files = [f for f in names if f.endswith(".wav") and not f.startswith(".")] # what glob("*.wav") finds
+    instrument = Instrument(dirname, files=files)
+    return {'mtime': mtime,
+            'files': files,
+            'notes': dict((str(n), f) for n, f in noteFiles(dirname, names).items()),
+            'mapping': [sample and [sample.fileName, sample.transpose] for sample in instrument.sample_file_array]}
+
+
+class InstrumentIndex:
+
+    def __init__(self, samplesdir, workers=4):
+        self.samplesdir = samplesdir
+        self.path = os.path.join(samplesdir, INDEXNAME)
+        self.workers = workers
+        self.entries = {} # {instrument directory name: entry}
+        self.reused = 0
+        self.scanned = 0
+        self.missing = 0
+
+    def _dirname(self, name):
+        return os.path.join(self.samplesdir, name)
+
+    # Reads the saved index, keeps the entries of names whose directories
+    # did not change and rescans the others (in parallel); saves the index
+    # if any entry was rescanned
+    def refresh(self, names):
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+            if saved.get('version') != VERSION:
+                saved = {}
+        except (IOError, OSError, ValueError):
+            saved = {}
+        stale = []
+        for name in names:
+            entry = saved.get('dirs', {}).get(name)
+            if entry is not None and self._current(name, entry):
+                self.entries[name] = entry
+                self.reused += 1
+            else:
+                stale.append(name)
+        if stale:
+            dirnames = [self._dirname(name) for name in stale]
+            if len(stale) > 1 and self.workers > 1:
+                pool = ThreadPool(min(self.workers, len(stale)))
+                try:
+                    scanned = pool.map(scan, dirnames)
+                finally:
+                    pool.close()
+            else:
+                scanned = [scan(dirname) for dirname in dirnames]
+            for name, entry in zip(stale, scanned):
+                self.entries[name] = entry
+                if entry is None:
+                    self.missing += 1
+                else:
+                    self.scanned += 1
+            self.save()
+        return self.reused, self.scanned
+
+    # True when entry still describes the directory of name (one stat;
+    # a None entry describes a directory that does not exist)
+    def _current(self, name, entry):
+        try:
+            mtime = os.stat(self._dirname(name)).st_mtime
+        except OSError:
+            return entry is None
+        return entry is not None and mtime == entry['mtime']
+
+    # Writes the entries of the directories that exist and are old enough
+    # to be trusted; a read-only samples directory just stays uncached
+    def save(self):
+        now = time.time()
+        dirs = dict((name, entry) for name, entry in self.entries.items()
+                    if entry is not None and now - entry['mtime'] > RACY)
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'version': VERSION, 'dirs': dirs}, f)
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            pass
+
+    # The entry of name, rescanned first if its directory changed since
+    def _entry(self, name):
+        if name not in self.entries or not self._current(name, self.entries[name]):
+            self.entries[name] = scan(self._dirname(name))
+            self.scanned += 1
+        return self.entries[name]
+
+    # The Instrument of directory name, from the index
+    def instrument(self, name, globalstart=0, interpolation=None):
+        entry = self._entry(name)
+        return Instrument(name, globalstart, interpolation, mapping=entry and entry['mapping'])
+
+    # {midinote: wav file} of directory name, like noteFiles()
+    def notes(self, name):
+        entry = self._entry(name)
+        return dict((int(n), f) for n, f in entry['notes'].items()) if entry else {}
+
+    def report(self):
+        return 'Instrument index: %d directories reused, %d scanned, %d missing' % (
+            self.reused, self.scanned, self.missing)
@@ -0,0 +1,109 @@
+#
+#  interpolation.py: Interpolation quality tiers
+#
+#  A transposed voice reads its sample at fractional positions. How the
+#  value between two frames is computed is the interpolation tier:
+#
+#    linear  2 frames, straight line between them (the original mixer).
+#            Cheapest, but its images and the aliasing of up-transposes
+#            are audible on the large transposes Instrument creates by
+#            stretching one sample across many notes.
+#    cubic   4 frames, Catmull-Rom (cubic Hermite) spline. Much weaker
+#            images than linear, still no anti-aliasing.
+#    sinc    SINC_TAPS frames, Kaiser-windowed sinc read from a polyphase
+#            table of SINC_PHASES + 1 precomputed phases. Up-transposes
+#            (speed > 1) get a table with its cutoff lowered to 1 / speed
+#            and proportionally more taps (at most SINC_MAX_TAPS), so they
+#            are band-limited instead of aliasing.
+#
+#  Cost per voice and output frame, both channels (see bench_mixer.py for
+#  the measured microseconds, and bench_suite.py for regressions):
+#
+#    linear    4 reads,  ~8 flops
+#    cubic     8 reads, ~30 flops, 2 index clamps
+#    sinc     2 * taps reads and multiply-adds: 16 at unity and below,
+#             up to 64 for transposes of two octaves up or more
+#
+#  Untransposed voices (and notes pre-rendered by transposecache.py) are
+#  copied straight whatever the tier, so the tier only costs CPU on voices
+#  that are actually pitch-shifted in the callback. The tier is chosen
+#  globally (INTERPOLATION in dhp.py) or per Instrument, and is carried by
+#  each Sound; transposecache.py renders with the same tier.
+#
+#  The arithmetic here is done in float32 in the same order as the Cython
+#  mixer, so numpy_mixer.py stays sample-for-sample identical to it.
+
+from __future__ import division
+import numpy
+
+LINEAR, CUBIC, SINC = 0, 1, 2
+TIERS = {'linear': LINEAR, 'cubic': CUBIC, 'sinc': SINC}
+
+SINC_TAPS = 8        # frames read at unity speed and below
+SINC_MAX_TAPS = 32   # frames read for large up-transposes
+SINC_PHASES = 512    # fractional positions in the table
+KAISER_BETA = 7.0
+
+# No kernel (linear and cubic voices)
+NOKERNEL = numpy.zeros((1, 1), numpy.float32)
+
+_kernels = {} # speed -> sinc table
+
+
+# Returns the tier number of a name ('linear', 'cubic' or 'sinc')
+def tier(name):
+    if name not in TIERS:
+        raise ValueError('unknown interpolation %r (expected one of %s)' % (name, ', '.join(sorted(TIERS))))
+    return TIERS[name]
+
+
+# Polyphase windowed sinc table for a voice read at speed: row p holds the
+# weights of frames k - taps/2 + 1 .. k + taps/2 for position k + p / phases.
+# Every row sums to 1.
+def sinctable(speed, taps=SINC_TAPS, maxtaps=SINC_MAX_TAPS, phases=SINC_PHASES, beta=KAISER_BETA):
+    cutoff = min(1.0, 1.0 / speed)
+    taps = min(maxtaps, 2 * int(numpy.ceil(taps / cutoff / 2)))
+    half = taps // 2
+    offsets = numpy.arange(taps) - (half - 1)
+    x = offsets[None, :] - (numpy.arange(phases + 1) / phases)[:, None]
+    window = numpy.i0(beta * numpy.sqrt(numpy.clip(1 - (x / half) ** 2, 0, 1))) / numpy.i0(beta)
+    h = cutoff * numpy.sinc(cutoff * x) * window
+    h /= h.sum(axis=1)[:, None]
+    return h.astype(numpy.float32)
+
+
+# The kernel a voice of this tier needs at speed (tables are built once
+# per speed and shared)
+def kernel(tier, speed):
+    if tier != SINC:
+        return NOKERNEL
+    speed = float(speed)
+    table = _kernels.get(speed)
+    if table is None:
+        table = _kernels[speed] = sinctable(speed)
+    return table
+
+
+# Interpolates frames (an (n, nchannels) array, any dtype) at the float32
+# positions j with a cubic or sinc tier. Indices are clamped to the sample.
+# Returns a float32 (len(j), nchannels) array.
+def interpolate(frames, j, tier, table=NOKERNEL):
+    n = len(frames)
+    k = j.astype(numpy.int32)
+    f = (j - k.astype(numpy.float32))[:, None]
+    if tier == CUBIC:
+        y0 = frames[numpy.clip(k - 1, 0, n - 1)].astype(numpy.float32)
+        y1 = frames[numpy.clip(k, 0, n - 1)].astype(numpy.float32)
+        y2 = frames[numpy.clip(k + 1, 0, n - 1)].astype(numpy.float32)
+        y3 = frames[numpy.clip(k + 2, 0, n - 1)].astype(numpy.float32)
+        c = numpy.float32
+        return y1 + c(0.5) * f * (y2 - y0 + f * (c(2) * y0 - c(5) * y1 + c(4) * y2 - y3 +
+                                                f * (c(3) * (y1 - y2) + y3 - y0)))
+    phases = len(table) - 1
+    taps = table.shape[1]
+    h = table[((f[:, 0] * numpy.float32(phases)).astype(numpy.float64) + 0.5).astype(numpy.int64)]
+    m = k - (taps // 2 - 1)
+    out = numpy.zeros((len(j), frames.shape[1]), numpy.float32)
+    for t in range(taps):
+        out += h[:, t, None] * frames[numpy.clip(m + t, 0, n - 1)].astype(numpy.float32)
+    return out
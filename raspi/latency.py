@@ -0,0 +1,118 @@
+#
+#  latency.py: Breath-to-sound latency histograms
+#
+#  Every note started by a breath goes through these stages:
+#
+#    scan      the ADC scan whose values crossed blowThresh/drawThresh
+#    dispatch  end of that scan -> MidiCallback -> Sound.play queued the voice
+#    queue     voice queued -> picked up by the next AudioCallback
+#    mix       AudioCallback start -> mixed block handed to sounddevice
+#    device    block handed over -> first sample at the DAC (from time_info)
+#    total     sum of the above
+#
+#  Each stage keeps a histogram with logarithmic bins (BINS_PER_DECADE per
+#  decade, 1 us to 10 s), so recording is a couple of arithmetic operations
+#  and memory stays constant however long it runs: cheap enough to leave on.
+#  Percentiles are read from the histograms, accurate to one bin (~12%).
+#
+#  Timestamps come from clock(): time.monotonic, or on Python 2 (which
+#  dhp.py runs on) clock_gettime(CLOCK_MONOTONIC) called through ctypes.
+
+from __future__ import division
+import os
+import math
+import time
+import ctypes
+import ctypes.util
+import numpy
+
+CLOCK_MONOTONIC = 1 # linux/time.h
+
+
+class timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+# Python 2 has no time.monotonic: clock_gettime(CLOCK_MONOTONIC) through
+# ctypes, which NTP and date changes don't move either
+def _monotonic():
+    librt = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+    clock_gettime = librt.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    def monotonic():
+        now = timespec() # one per call: the threads share the clock
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(now)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return now.tv_sec + now.tv_nsec * 1e-9
+    return monotonic
+
+# Seconds from a fixed point: every timestamp in the project comes from here
+clock = getattr(time, 'monotonic', None) or _monotonic()
+
+STAGES = ('scan', 'dispatch', 'queue', 'mix', 'device', 'total')
+BINS_PER_DECADE = 20
+MIN_US = 1.0
+DECADES = 7
+
+
+class LatencyMonitor:
+
+    def __init__(self, stages=STAGES):
+        self.stages = stages
+        self.nbins = BINS_PER_DECADE * DECADES
+        # Upper edge of every bin, in seconds
+        self.edges = MIN_US * 1e-6 * numpy.power(10.0, (numpy.arange(self.nbins) + 1.0) / BINS_PER_DECADE)
+        self.reset()
+
+    def reset(self):
+        self.counts = dict((stage, [0] * self.nbins) for stage in self.stages)
+        self.max = dict((stage, 0.0) for stage in self.stages)
+        self.started = clock()
+
+    # Adds count observations of seconds to stage
+    def record(self, stage, seconds, count=1):
+        us = seconds * 1e6
+        if us > MIN_US:
+            i = min(int(math.log10(us / MIN_US) * BINS_PER_DECADE), self.nbins - 1)
+        else:
+            i = 0
+        self.counts[stage][i] += count
+        if seconds > self.max[stage]:
+            self.max[stage] = seconds
+
+    def _percentile(self, counts, total, q):
+        cumulative = numpy.cumsum(counts)
+        return self.edges[numpy.searchsorted(cumulative, q * total)]
+
+    # {stage: {count, p50, p95, p99, max}} in seconds since the last reset
+    def stats(self):
+        result = {}
+        for stage in self.stages:
+            counts = self.counts[stage]
+            total = sum(counts)
+            if total == 0:
+                result[stage] = {'count': 0, 'p50': 0.0, 'p95': 0.0, 'p99': 0.0, 'max': 0.0}
+                continue
+            result[stage] = {
+                'count': total,
+                'p50': self._percentile(counts, total, 0.50),
+                'p95': self._percentile(counts, total, 0.95),
+                'p99': self._percentile(counts, total, 0.99),
+                'max': self.max[stage],
+            }
+        return result
+
+    # stats() plus the raw histograms (bin upper edges and counts)
+    def dump(self):
+        return {'since': self.started, 'edges': list(self.edges), 'stats': self.stats(),
+                'counts': dict((stage, list(c)) for stage, c in self.counts.items())}
+
+    def report(self):
+        lines = ['%-9s %7s %9s %9s %9s %9s' % ("stage", "notes", "p50 ms", "p95 ms", "p99 ms", "max ms")]
+        stats = self.stats()
+        for stage in self.stages:
+            s = stats[stage]
+            lines.append('%-9s %7d %9.2f %9.2f %9.2f %9.2f' % (
+                stage, s['count'], s['p50'] * 1000, s['p95'] * 1000, s['p99'] * 1000, s['max'] * 1000))
+        return '\n'.join(lines)
@@ -0,0 +1,42 @@
+#
+#  midiwatch.py: MIDI port hot-plug detection
+#
+#  Polls the rtmidi port list from its own thread at a low rate and opens
+#  every new port (except "Midi Through") with the given callback, so the
+#  sensor scan loop never has to enumerate ports itself.
+
+import time
+import threading
+
+
+class MidiPortWatcher:
+
+    def __init__(self, rtmidi, callback, interval=1.0, ignore=('Midi Through',)):
+        self.rtmidi = rtmidi
+        self.callback = callback
+        self.interval = interval
+        self.ignore = ignore
+        self.midi_in = [rtmidi.MidiIn()] # [0] only lists ports
+        self.opened = set()
+        self.thread = None
+
+    # Opens ports that appeared since the last poll
+    def poll(self):
+        for port in self.midi_in[0].ports:
+            if port in self.opened or any(name in port for name in self.ignore):
+                continue
+            self.midi_in.append(self.rtmidi.MidiIn())
+            self.midi_in[-1].callback = self.callback
+            self.midi_in[-1].open_port(port)
+            self.opened.add(port)
+            print('Opened MIDI: ' + port)
+
+    def _watch(self):
+        while True:
+            self.poll()
+            time.sleep(self.interval)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._watch)
+        self.thread.daemon = True
+        self.thread.start()
@@ -0,0 +1,265 @@
+#
+#  numpy_mixer.py: Audio engine (pure NumPy)
+#
+#  Drop-in replacement for samplerbox_audio.pyx. It exposes the same
+#  mixaudiobuffers(), mixvoices() and binary24_to_int16() functions so dhp.py and
+#  samplerbox.py can still start when the Cython module is not compiled.
+#
+#  Instead of looping over every sample of every voice, the interpolation
+#  indices, fractional weights, fadeout gains and velocity scaling of a
+#  whole block are computed for all voices at once with array operations
+#  (cubic and sinc voices are interpolated by interpolation.interpolate).
+#  All arithmetic is done in float32 in the same order as the Cython loop
+#  (including its loop-wrap behaviour) so both backends produce the same
+#  output, sample for sample.
+
+import numpy
+import interpolation
+
+
+# Positions read by one voice in one block, following the loop wrap rule
+# of samplerbox_audio.mixaudiobuffers: when the read head passes the end of
+# the sound it restarts at loop + 1, and that restart position is used for
+# two consecutive output samples.
+#
+# Returns (j, ii, wrappos): j are the float32 read positions, ii is the
+# number of steps taken since the last restart (the Cython "ii" counter),
+# and wrappos is the last restart position (None if it never wrapped).
+def _wrappedpositions(pos, speed, N, length, looppos, ramp):
+    j = numpy.empty(N, numpy.float32)
+    ii = 0
+    wrappos = None
+    start = 0
+    while start < N:
+        seg = pos + ramp[:N - start] * speed
+        over = numpy.flatnonzero(seg.astype(numpy.int32) > length - 2)
+        if len(over) == 0:
+            j[start:] = seg
+            ii = N - start
+            break
+        m = over[0]
+        j[start:start + m] = seg[:m]
+        pos = numpy.float32(looppos + 1)
+        wrappos = pos
+        j[start + m] = pos
+        start += m + 1
+        ii = 0
+    return j, ii, wrappos
+
+
+# Mixes one block of the given voices (arrays with one entry per voice,
+# in mixing order) into b. pos, fadeoutpos and volume are updated in place;
+# returns a bool array of the voices that ended (reached the end of a
+# non-looping sound, finished their fadeout, or were stolen and ramped to 0).
+# tiers and kernels are the voices' interpolation (None: all linear).
+def _mix(b, frame_count, FADEOUT, FADEOUTLENGTH, pos, speed, volume, ramp, stolen, fading, fadeoutpos,
+         lengths, loops, nchannels, datas, tiers=None, kernels=None):
+    nvoices = len(datas)
+    ended = numpy.zeros(nvoices, bool)
+    if nvoices == 0:
+        return ended
+    count = numpy.empty(nvoices, numpy.int64)
+    start = numpy.empty(nvoices, numpy.float32)
+    fadestart = numpy.array(fadeoutpos, numpy.int64)
+
+    # Per voice state, read once per block
+    for v in range(nvoices):
+        p = numpy.float32(pos[v])
+        s = speed[v]
+        length = lengths[v]
+        N = frame_count
+        # Identify sounds to remove
+        if (p + numpy.float32(frame_count) * s > numpy.float32(length - 4)) and (loops[v] == -1):
+            ended[v] = True
+            N = int((numpy.float32(length - 4) - p) / s)
+        if fading[v] and fadeoutpos[v] > FADEOUTLENGTH:
+            ended[v] = True   # fadeout is over. Remove
+        start[v] = p
+        count[v] = max(N, 0)
+
+    # Read positions of every voice, computed as one batch
+    frames = numpy.arange(frame_count, dtype=numpy.float32)
+    J = start[:, None] + frames[None, :] * speed[:, None]
+    K = J.astype(numpy.int32)
+    active = numpy.arange(frame_count)[None, :] < count[:, None]
+
+    left = numpy.zeros((nvoices, frame_count), numpy.float32)
+    right = numpy.zeros((nvoices, frame_count), numpy.float32)
+    for v in range(nvoices):
+        N = count[v]
+        length = lengths[v]
+        ii = N
+        wrappos = None
+        if (K[v, :N] > length - 2).any():
+            J[v, :N], ii, wrappos = _wrappedpositions(start[v], speed[v], N, length, loops[v], frames)
+            K[v, :N] = J[v, :N].astype(numpy.int32)
+        lasti = max(N - 1, 0) # the Cython loop index, which starts at 0 for every slot
+
+        # Interleaved stereo (nch = 2) or mono (nch = 1, panned to both sides)
+        z = datas[v]
+        nch = nchannels[v]
+        k = K[v, :N]
+        l0 = z.take(nch * k, mode='clip')
+        r0 = z.take(nch * k + nch - 1, mode='clip')
+        if speed[v] == 1.0 and start[v] == int(start[v]):
+            # Untransposed (or pre-rendered) sound: straight copy
+            left[v, :N] = l0
+            right[v, :N] = r0
+        elif tiers is not None and tiers[v] != interpolation.LINEAR:
+            # Cubic or windowed sinc, same arithmetic as the Cython mixer
+            zframes = z[:len(z) // nch * nch].reshape(-1, nch)
+            out = interpolation.interpolate(zframes, J[v, :N], tiers[v], kernels[v])
+            left[v, :N] = out[:, 0]
+            right[v, :N] = out[:, nch - 1]
+        else:
+            # Linear interpolation between frame k and frame k + 1
+            frac = J[v, :N] - k.astype(numpy.float32)
+            l1 = z.take(nch * k + nch, mode='clip')
+            r1 = z.take(nch * k + 2 * nch - 1, mode='clip')
+            left[v, :N] = l0 + frac * (l1.astype(numpy.int32) - l0).astype(numpy.float32)
+            right[v, :N] = r0 + frac * (r1.astype(numpy.int32) - r0).astype(numpy.float32)
+
+        if wrappos is not None:
+            pos[v] = float(wrappos)
+        pos[v] += float(numpy.float32(ii) * speed[v])
+        if fading[v]:
+            fadeoutpos[v] += lasti
+
+    # Fadeout gains (1.0 for sustained voices) and velocity scaling
+    gain = numpy.ones((nvoices, frame_count), numpy.float32)
+    if fading.any():
+        idx = fadestart[fading][:, None] + numpy.arange(frame_count)[None, :]
+        gain[fading] = FADEOUT.take(idx, mode='clip')
+    left *= gain
+    right *= gain
+    if ramp.any():
+        # Expression and stolen voices: volume - i * ramp, clamped at 0
+        scale = numpy.maximum(volume[:, None] - ramp[:, None] * frames[None, :], 0)
+        volume[:] = numpy.maximum(volume - ramp * numpy.float32(frame_count), 0)
+        ended |= stolen & (volume <= 0)
+    else:
+        scale = volume[:, None]
+    left *= scale
+    right *= scale
+    left[~active] = 0
+    right[~active] = 0
+
+    # Sum voices in playing order, like the Cython loop does
+    bl = b[0:2 * frame_count:2]
+    br = b[1:2 * frame_count:2]
+    for v in range(nvoices):
+        bl += left[v]
+        br += right[v]
+    return ended
+
+
+# Returns a numpy.ndarray b, that contains the audio data
+# (same contract as samplerbox_audio.mixaudiobuffers)
+def mixaudiobuffers(playingsounds, rmlist, frame_count, FADEOUT, FADEOUTLENGTH, SPEED):
+    b = numpy.zeros(2 * frame_count, numpy.float32)
+    nvoices = len(playingsounds)
+    if nvoices == 0:
+        return b
+    pos = [snd.pos for snd in playingsounds]
+    fadeoutpos = [snd.fadeoutpos for snd in playingsounds]
+    speed = numpy.array([SPEED[snd.note - snd.sound.midinote] for snd in playingsounds], numpy.float32)
+    volume = numpy.array([snd.velocity / 127.0 for snd in playingsounds], numpy.float32)
+    fading = numpy.array([snd.isfadeout for snd in playingsounds], bool)
+    ended = _mix(b, frame_count, FADEOUT, FADEOUTLENGTH, pos, speed, volume,
+                 numpy.zeros(nvoices, numpy.float32), numpy.zeros(nvoices, bool), fading, fadeoutpos,
+                 [snd.sound.nframes for snd in playingsounds], [snd.sound.loop for snd in playingsounds],
+                 [getattr(snd.sound, 'nchannels', 2) for snd in playingsounds],
+                 [snd.sound.data for snd in playingsounds])
+    for v, snd in enumerate(playingsounds):
+        snd.pos = pos[v]
+        snd.fadeoutpos = fadeoutpos[v]
+        if ended[v]:
+            rmlist.append(snd)
+    return b
+
+
+# Same mix for the voices of a voicepool.VoicePool
+# (same contract as samplerbox_audio.mixvoices; workers is ignored, NumPy
+# already mixes all voices at once, and the temporaries it needs to do so
+# are allocated even when out is given)
+def mixvoices(pool, frame_count, FADEOUT, FADEOUTLENGTH, workers=1, out=None):
+    if out is not None and len(out) >= 2 * frame_count:
+        b = out
+        b[:2 * frame_count] = 0
+    else:
+        b = numpy.zeros(2 * frame_count, numpy.float32)
+    v = numpy.flatnonzero(pool.active)
+    if len(v) == 0:
+        return b
+    pos = pool.pos[v]
+    fadeoutpos = pool.fadepos[v]
+    volume = pool.gain[v]
+    ended = _mix(b, frame_count, FADEOUT, FADEOUTLENGTH, pos, pool.speed[v], volume, pool.ramp[v],
+                 pool.stolen[v] != 0, pool.fading[v] != 0, fadeoutpos, pool.length[v], pool.loop[v], pool.nch[v],
+                 [pool.data[i] for i in v], pool.interp[v], [pool.kernels[i] for i in v])
+    pool.pos[v] = pos
+    pool.fadepos[v] = fadeoutpos
+    pool.gain[v] = volume
+    pool.active[v[ended]] = 0
+    return b
+
+
+# lowbias32 integer hash of uint32 counters (see samplerbox_audio.noisehash)
+def _noisehash(x):
+    x = x ^ (x >> numpy.uint32(16))
+    x = x * numpy.uint32(0x7feb352d)
+    x = x ^ (x >> numpy.uint32(15))
+    x = x * numpy.uint32(0x846ca68b)
+    x = x ^ (x >> numpy.uint32(16))
+    return x
+
+
+# Master gain, soft limiter, optional TPDF dither and int16 conversion
+# (same contract as samplerbox_audio.outputstage). Works in place on b and
+# only runs the limiter when a sample is past the knee. Without dither it
+# keeps the two passes AudioCallback used to make (b *= gain, then a
+# casting copy): every extra NumPy pass costs more than the whole stage
+# does in Cython. The cast truncates where Cython rounds, so that output
+# can be 1 LSB off; with dither the arithmetic is Cython's, bit for bit.
+def outputstage(b, outdata, gain, knee, dither=None):
+    f = numpy.float32
+    s = b[:outdata.size]
+    s *= f(gain)
+    peak = knee * 32767 - 1 # a little under the float32 threshold below
+    if s.max() > peak or s.min() < -peak:
+        full = f(32767)
+        threshold = f(knee) * full
+        room = full - threshold
+        a = numpy.abs(s)
+        over = a > threshold
+        if room > 0:
+            u = (a[over] - threshold) / room
+            a[over] = threshold + room * (u / (f(1) + u))
+        else:
+            a[over] = full
+        s[over] = numpy.where(s[over] > 0, a[over], -a[over])
+    if dither is None:
+        outdata[:] = s.reshape(outdata.shape)
+        return
+    if s.any(): # digital silence stays silent
+        with numpy.errstate(over='ignore'):
+            counter = dither[0] + numpy.arange(0, 2 * len(s), 2, dtype=numpy.uint32)
+            scale = f(1.0 / 16777216)
+            noise = (_noisehash(counter) >> numpy.uint32(8)).astype(f) * scale + \
+                (_noisehash(counter + numpy.uint32(1)) >> numpy.uint32(8)).astype(f) * scale - f(1)
+            dither[0] = dither[0] + numpy.uint32(2 * len(s))
+        s += noise
+    s += f(0.5)
+    numpy.floor(s, out=s)
+    numpy.clip(s, -32768, 32767, out=s)
+    outdata[:] = s.reshape(outdata.shape)
+
+
+# No worker threads to start (see samplerbox_audio.startworkers)
+def startworkers(workers):
+    return workers
+
+
+def binary24_to_int16(data, length):
+    raw = numpy.frombuffer(data, numpy.uint8)[:3 * int(length)].reshape(-1, 3)
+    return numpy.ascontiguousarray(raw[:, 1:3]).view(numpy.int16).ravel()
@@ -0,0 +1,90 @@
+#
+#  offlinerender.py: Offline rendering of scripted performances
+#
+#  A performance script is a text file with one event per line:
+#
+#    <seconds> rest <v0> ... <v9>     resting sensor values (calibration)
+#    <seconds> adc <v0> ... <v9>      one sensor scan (raw ADC values)
+#    <seconds> midi <b0> <b1> [<b2>]  one MIDI message (e.g. 144 60 100)
+#
+#  Blank lines and lines starting with # are ignored.
+#
+#  render() steps through a performance one audio block at a time: the
+#  events due by the start of a block are handed to onscan / onmidi, then
+#  callback mixes the block the way sounddevice would call it. Time is the
+#  block count, never the wall clock, so a script always renders to the
+#  same samples.
+#
+#  usage: python dhp.py --render <script> <out.wav>
+#
+
+from __future__ import division
+import time
+import wave
+import numpy
+
+
+# Stands in for sounddevice's time_info
+class BlockTime:
+
+    def __init__(self, currentTime, latency):
+        self.currentTime = currentTime
+        self.outputBufferDacTime = currentTime + latency
+        self.inputBufferAdcTime = 0.0
+
+
+# Returns the events of a script as (seconds, kind, [values]), in time
+# order (events with the same time keep their order)
+def readscript(filename):
+    events = []
+    with open(filename) as f:
+        for number, line in enumerate(f):
+            line = line.split('#')[0].split()
+            if not line:
+                continue
+            if line[1] not in ('rest', 'adc', 'midi'):
+                raise ValueError('%s:%d: unknown event %r' % (filename, number + 1, line[1]))
+            events.append((float(line[0]), line[1], [int(v) for v in line[2:]]))
+    events.sort(key=lambda e: e[0])
+    return events
+
+
+# The first rest frame of a script (None if it has none)
+def restframe(events):
+    for seconds, kind, values in events:
+        if kind == 'rest':
+            return values
+    return None
+
+
+# Renders events until tail seconds after the last one. onscan(values) and
+# onmidi(message) get the events, callback(outdata, frame_count, time_info,
+# status) mixes each block into an int16 (frame_count, 2) array.
+# Returns (int16 frames, wall clock seconds).
+def render(events, blocksize, samplerate, onscan, onmidi, callback, tail=2.0):
+    period = blocksize / samplerate
+    end = (events[-1][0] if events else 0.0) + tail
+    nblocks = int(numpy.ceil(end / period))
+    out = numpy.zeros((nblocks * blocksize, 2), numpy.int16)
+    e = 0
+    start = time.time()
+    for block in range(nblocks):
+        now = block * period
+        while e < len(events) and events[e][0] <= now:
+            seconds, kind, values = events[e]
+            if kind == 'adc':
+                onscan(numpy.array(values, numpy.int32))
+            elif kind == 'midi':
+                onmidi(values)
+            e += 1
+        callback(out[block * blocksize:(block + 1) * blocksize], blocksize, BlockTime(now, period), None)
+    return out, time.time() - start
+
+
+def writewav(filename, frames, samplerate):
+    wf = wave.open(filename, 'wb')
+    wf.setnchannels(frames.shape[1])
+    wf.setsampwidth(2)
+    wf.setframerate(samplerate)
+    wf.writeframes(frames.astype('<i2').tobytes())
+    wf.close()
@@ -12,6 +12,9 @@ USE_BUTTONS = True    # Set to True to use momentary buttons (connected to Raspb
 # DHP-STUB: Comment: Keeping max number of voices low, will prevent chaotic sounds to a degree (especially if velocity isn't being handled correctly).
 MAX_NUM_VOICES = 25
 NUM_INSTRUMENTS = 3
+MIXER_BACKEND = "cython" # "cython" (samplerbox_audio.pyx) or "numpy" (numpy_mixer.py)
+SCAN_RATE = 500 # Sensor scans per second
+MIDI_SCAN_INTERVAL = 1.0 # Seconds between MIDI port hot-plug checks
 
 NOTES = ["c", "c#", "d", "d#", "e", "f", "f#", "g", "g#", "a", "a#", "b"]
 
@@ -31,7 +34,16 @@ import threading
 from chunk import Chunk
 import struct
 import rtmidi_python as rtmidi
-import samplerbox_audio
+import scanloop
+import midiwatch
+if MIXER_BACKEND == "cython":
+    try:
+        import samplerbox_audio
+    except ImportError: # .pyx not compiled (python setup.py build_ext --inplace)
+        print 'samplerbox_audio not compiled, using the numpy mixer'
+        import numpy_mixer as samplerbox_audio
+else:
+    import numpy_mixer as samplerbox_audio
 
 # DHP-STUB: Comment: Adafruit_MCP3008 is the 10-bit 8-channel ADC we are using to access the air pressure sensors
 # These imports are needed to allow us to use the ADC in a programmatic way
@@ -442,10 +454,12 @@ LoadSamples()
 #########################################
 # MIDI DEVICES DETECTION (MAIN LOOP)
 #########################################
-midi_in = [rtmidi.MidiIn()]
-previous = []
+midiWatcher = midiwatch.MidiPortWatcher(rtmidi, MidiCallback, MIDI_SCAN_INTERVAL)
+midiWatcher.start()
+scheduler = scanloop.ScanScheduler(SCAN_RATE)
 # DHP-STUB: Comment: This is the infinite loop where all the magic happens!
 while True:
+    scheduler.wait()
     # Read all the ADC channel values in a list.
     values = [0]*10
 
@@ -491,13 +505,3 @@ while True:
             MidiCallback(message, None)
             message = [128,drawNote,127]
             MidiCallback(message, None)    
-    
-    
-    for port in midi_in[0].ports:
-        if port not in previous and 'Midi Through' not in port:
-            midi_in.append(rtmidi.MidiIn())
-            midi_in[-1].callback = MidiCallback
-            midi_in[-1].open_port(port)
-            print 'Opened MIDI: ' + port
-            previous = midi_in[0].ports
-        time.sleep(.05)
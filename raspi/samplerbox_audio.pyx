@@ -15,15 +15,180 @@
 import cython
 import numpy
 cimport numpy
+from cython.parallel cimport prange
+from libc.string cimport memset
+
+cdef extern from "math.h" nogil:
+    float floorf(float x)
+
+# Interpolation tiers (see interpolation.py)
+DEF LINEAR = 0
+DEF CUBIC = 1
+DEF SINC = 2
+
+# Catmull-Rom spline through frames k - 1 .. k + 2 of channel c, at k + f
+cdef inline float cubic(short* zz, int nch, int c, int k, float f, int frames) noexcept nogil:
+    cdef int k0 = k - 1 if k > 0 else 0
+    cdef int k3 = k + 2 if k + 2 < frames else frames - 1
+    cdef float y0 = zz[nch * k0 + c], y1 = zz[nch * k + c], y2 = zz[nch * k + nch + c], y3 = zz[nch * k3 + c]
+    cdef float half = 0.5, two = 2, three = 3, four = 4, five = 5 # float, not double, arithmetic
+    return y1 + half * f * (y2 - y0 + f * (two * y0 - five * y1 + four * y2 - y3 + f * (three * (y1 - y2) + y3 - y0)))
+
+# Windowed sinc of channel c around frame k with the taps weights h
+# (one phase of a polyphase table), indices clamped to the sample
+cdef inline float windowedsinc(short* zz, int nch, int c, int k, float* h, int taps, int frames) noexcept nogil:
+    cdef int t, m = k - (taps // 2 - 1), n
+    cdef float acc = 0
+    if m >= 0 and m + taps <= frames:
+        for t in range(taps):
+            acc += h[t] * zz[nch * (m + t) + c]
+    else:
+        for t in range(taps):
+            n = m + t
+            if n < 0:
+                n = 0
+            elif n > frames - 1:
+                n = frames - 1
+            acc += h[t] * zz[nch * n + c]
+    return acc
+
+# mixvoice() for the cubic and sinc tiers. kernel is the voice's sinc
+# table (phases + 1 rows of taps weights), frames the frames in zz
+cdef int mixinterpolated(float* bb, short* zz, int nch, int N, float* pos, float speed, int length, int looppos,
+                         float volumeScale, float ramp, float* fadeout, int* last, bint* wrapped,
+                         int tier, float* kernel, int taps, int phases, int frames) noexcept nogil:
+    cdef int i, ii = 0, k, r = nch - 1
+    cdef float j, f, vol, left, right
+    cdef float* h
+    for i in range(N):
+        j = pos[0] + ii * speed
+        ii += 1
+        k = <int> j
+        if k > length - 2:
+            pos[0] = looppos + 1
+            wrapped[0] = True
+            ii = 0
+            j = pos[0] + ii * speed
+            k = <int> j
+        vol = volumeScale - i * ramp
+        if vol < 0:
+            vol = 0
+        f = j - k
+        if tier == CUBIC:
+            left = cubic(zz, nch, 0, k, f, frames)
+            right = cubic(zz, nch, r, k, f, frames)
+        else:
+            h = kernel + (<int> (f * phases + 0.5)) * taps
+            left = windowedsinc(zz, nch, 0, k, h, taps, frames)
+            right = windowedsinc(zz, nch, r, k, h, taps, frames)
+        if fadeout != NULL:
+            left = left * fadeout[i]
+            right = right * fadeout[i]
+        bb[2 * i] += (vol)*(left)
+        bb[2 * i + 1] += (vol)*(right)
+        last[0] = i
+    return ii
+
+# Mixes N frames of one voice into bb (interleaved stereo output).
+# zz is the voice's sample data, nch its channel count (1 = mono, played on
+# both sides). Each frame is scaled by volumeScale - i * ramp (clamped at 0;
+# ramp is 0 except for expression and stolen voices) and, when fadeout is not NULL, by
+# fadeout[i]. Returns the frames stepped since the last loop restart;
+# pos is moved to the restart position if the voice wrapped (wrapped is
+# then set) and last gets the index of the last frame mixed.
+# tier, kernel, taps, phases and frames select cubic or sinc interpolation
+# instead of linear (see mixinterpolated).
+cdef int mixvoice(float* bb, short* zz, int nch, int N, float* pos, float speed, int length, int looppos,
+                  float volumeScale, float ramp, float* fadeout, int* last, bint* wrapped,
+                  int tier=LINEAR, float* kernel=NULL, int taps=0, int phases=0, int frames=0) noexcept nogil:
+    cdef int i, ii = 0, k, r = nch - 1
+    cdef float j, vol
+    # Speed 1.0 from a whole frame (untransposed or pre-rendered sounds):
+    # every read lands on a frame, so interpolation can be skipped
+    cdef bint straight = (speed == 1.0) and (pos[0] == <int> pos[0])
+
+    if tier != LINEAR and not straight:
+        return mixinterpolated(bb, zz, nch, N, pos, speed, length, looppos, volumeScale, ramp, fadeout, last, wrapped,
+                               tier, kernel, taps, phases, frames)
+
+    if fadeout != NULL: # Fadeouts
+        if straight:
+            for i in range(N):
+                k = <int> pos[0] + ii
+                ii += 1
+                if k > length - 2:
+                    pos[0] = looppos + 1
+                    wrapped[0] = True
+                    ii = 0
+                    k = <int> pos[0]
+                vol = volumeScale - i * ramp
+                if vol < 0:
+                    vol = 0
+                bb[2 * i] += (vol)*(zz[nch * k] * fadeout[i])
+                bb[2 * i + 1] += (vol)*(zz[nch * k + r] * fadeout[i])
+                last[0] = i
+        else:
+            for i in range(N):
+                j = pos[0] + ii * speed
+                ii += 1
+                k = <int> j
+                if k > length - 2:
+                    pos[0] = looppos + 1
+                    wrapped[0] = True
+                    ii = 0
+                    j = pos[0] + ii * speed
+                    k = <int> j
+                vol = volumeScale - i * ramp
+                if vol < 0:
+                    vol = 0
+                bb[2 * i] += (vol)*((zz[nch * k] + (j - k) * (zz[nch * k + nch] - zz[nch * k])) * fadeout[i]) # linear interpolation
+                bb[2 * i + 1] += (vol)*((zz[nch * k + r] + (j - k) * (zz[nch * k + nch + r] - zz[nch * k + r])) * fadeout[i])
+                last[0] = i
+
+    elif straight: # Non-fadeouts, untransposed: straight copy
+        for i in range(N):
+            k = <int> pos[0] + ii
+            ii += 1
+            if k > length - 2:
+                pos[0] = looppos + 1
+                wrapped[0] = True
+                ii = 0
+                k = <int> pos[0]
+            vol = volumeScale - i * ramp
+            if vol < 0:
+                vol = 0
+            bb[2 * i] += (vol)*(zz[nch * k])
+            bb[2 * i + 1] += (vol)*(zz[nch * k + r])
+            last[0] = i
+
+    else: # Non-fadeouts
+        for i in range(N):
+            j = pos[0] + ii * speed
+            ii += 1
+            k = <int> j
+            if k > length - 2:
+                pos[0] = looppos + 1
+                wrapped[0] = True
+                ii = 0
+                j = pos[0] + ii * speed
+                k = <int> j
+            vol = volumeScale - i * ramp
+            if vol < 0:
+                vol = 0
+            bb[2 * i] += (vol)*(zz[nch * k] + (j - k) * (zz[nch * k + nch] - zz[nch * k])) # linear interpolation
+            bb[2 * i + 1] += (vol)*(zz[nch * k + r] + (j - k) * (zz[nch * k + nch + r] - zz[nch * k + r]))
+            last[0] = i
+
+    return ii
 
 # Returns a numpy.ndarray z, that contains the audio data
 def mixaudiobuffers(list playingsounds, list rmlist, int frame_count, numpy.ndarray FADEOUT, int FADEOUTLENGTH, numpy.ndarray SPEED):
-    cdef int i, ii, k, l, N, length, looppos, fadeoutpos
-    cdef float speed, newsz, pos, j, volumeScale
+    cdef int i = 0, ii, N, length, looppos, fadeoutpos
+    cdef bint wrapped
+    cdef float speed, pos, volumeScale
     cdef numpy.ndarray b = numpy.zeros(2 * frame_count, numpy.float32)      # output buffer
     cdef float* bb = <float *> (b.data)              # and its pointer
     cdef numpy.ndarray z
-    cdef short* zz
     cdef float* fadeout = <float *> (FADEOUT.data)
  
 	# For every sound being played currently
@@ -35,10 +200,7 @@ def mixaudiobuffers(list playingsounds, list rmlist, int frame_count, numpy.ndar
         volumeScale = (snd.velocity)/127.0
         # Accurate speed related to soundfile note, and the actual pitch
         speed = SPEED[snd.note - snd.sound.midinote]
-        newsz = frame_count * speed
-        
         z = snd.sound.data
-        zz = <short *> (z.data)
 
         N = frame_count
 		
@@ -47,48 +209,258 @@ def mixaudiobuffers(list playingsounds, list rmlist, int frame_count, numpy.ndar
             rmlist.append(snd)
             N = <int> ((length - 4 - pos) / speed)
 
+        wrapped = False
         if snd.isfadeout: # Fadeouts
             if fadeoutpos > FADEOUTLENGTH: 
                 rmlist.append(snd)   # fadeout is over. Remove
-            ii = 0   
-            for i in range(N):
-                j = pos + ii * speed
-                ii += 1                  
-                k = <int> j
-                if k > length - 2:
-                    pos = looppos + 1
-                    snd.pos = pos
-                    ii = 0
-                    j = pos + ii * speed   
-                    k = <int> j       
-                bb[2 * i] += (volumeScale)*((zz[2 * k] + (j - k) * (zz[2 * k + 2] - zz[2 * k])) * fadeout[fadeoutpos + i]) # linear interpolation
-                bb[2 * i + 1] += (volumeScale)*((zz[2 * k + 1] + (j - k) * (zz[2 * k + 3] - zz[2 * k + 1])) * fadeout[fadeoutpos + i])        
+            ii = mixvoice(bb, <short *> (z.data), getattr(snd.sound, 'nchannels', 2), N, &pos, speed, length, looppos,
+                          volumeScale, 0, fadeout + fadeoutpos, &i, &wrapped)
             snd.fadeoutpos += i
+        else:
+            ii = mixvoice(bb, <short *> (z.data), getattr(snd.sound, 'nchannels', 2), N, &pos, speed, length, looppos,
+                          volumeScale, 0, NULL, &i, &wrapped)
 
-        else: # Non-fadeouts
-            ii = 0            
-            for i in range(N):
-                j = pos + ii * speed
-                ii += 1                  
-                k = <int> j
-                if k > length - 2:
-                    pos = looppos + 1
-                    snd.pos = pos
-                    ii = 0
-                    j = pos + ii * speed   
-                    k = <int> j  
-                bb[2 * i] += (volumeScale)*(zz[2 * k] + (j - k) * (zz[2 * k + 2] - zz[2 * k])) # linear interpolation
-                bb[2 * i + 1] += (volumeScale)*(zz[2 * k + 1] + (j - k) * (zz[2 * k + 3] - zz[2 * k + 1]))
-
+        if wrapped:
+            snd.pos = pos
         snd.pos += ii * speed
 
     return b
 
+# The voice pool's arrays, for mixing without the GIL
+cdef struct Slots:
+    unsigned char* active
+    unsigned char* fading
+    double* positions
+    float* speed
+    float* gain
+    float* ramp
+    unsigned char* stolen
+    int* fadepos
+    int* length
+    int* looppos
+    int* nch
+    unsigned char* interp
+    size_t* data     # address of each slot's sample data
+    size_t* kernels  # address of each slot's sinc table
+    int* taps
+    int* phases
+    int* frames
+
+# Mixes slot v of the pool into bb and updates its state
+cdef void mixslot(Slots* s, int v, float* bb, int frame_count, float* fadeout, int FADEOUTLENGTH) noexcept nogil:
+    cdef int i = 0, ii, N = frame_count
+    cdef bint wrapped = False, ended = False
+    cdef float pos = s.positions[v]
+
+    # Identify sounds to remove
+    if (pos + frame_count * s.speed[v] > s.length[v] - 4) and (s.looppos[v] == -1):
+        ended = True
+        N = <int> ((s.length[v] - 4 - pos) / s.speed[v])
+
+    if s.fading[v]:
+        if s.fadepos[v] > FADEOUTLENGTH:
+            ended = True   # fadeout is over
+        ii = mixvoice(bb, <short *> s.data[v], s.nch[v], N, &pos, s.speed[v], s.length[v], s.looppos[v],
+                      s.gain[v], s.ramp[v], fadeout + s.fadepos[v], &i, &wrapped,
+                      s.interp[v], <float *> s.kernels[v], s.taps[v], s.phases[v], s.frames[v])
+        s.fadepos[v] += i
+    else:
+        ii = mixvoice(bb, <short *> s.data[v], s.nch[v], N, &pos, s.speed[v], s.length[v], s.looppos[v],
+                      s.gain[v], s.ramp[v], NULL, &i, &wrapped,
+                      s.interp[v], <float *> s.kernels[v], s.taps[v], s.phases[v], s.frames[v])
+
+    if wrapped:
+        s.positions[v] = pos
+    s.positions[v] += ii * s.speed[v]
+
+    if s.ramp[v] != 0: # expression, or stolen voice fading out to be freed
+        s.gain[v] = s.gain[v] - frame_count * s.ramp[v]
+        if s.gain[v] <= 0:
+            s.gain[v] = 0
+            ended = ended or s.stolen[v]
+    if ended:
+        s.active[v] = 0
+
+# Same mix for the voices of a voicepool.VoicePool: reads and updates the
+# pool's arrays in place and frees (active = 0) the voices that ended.
+#
+# Only the entry (fetching the pool's arrays, and the address of each
+# active voice's sample, one pass over the slots) and the exit hold the
+# GIL; every sample is mixed in a nogil section over the C-level slots.
+#
+# With workers > 1 the active voices are dealt round-robin to that many
+# OpenMP threads (setup.py builds with -fopenmp), each mixing into its own
+# row of pool.partial; the rows are then summed in worker order, so the
+# output only depends on the voices, not on thread timing. It differs
+# from the workers = 1 mix in the last bits (float sums in another order).
+# OpenMP keeps its threads between calls (start them with startworkers)
+# and pool.partial only grows when the block does: nothing is allocated
+# per block once warmed up.
+#
+# out: optional float32 buffer of at least 2 * frame_count floats, mixed
+# into (its first 2 * frame_count) and returned instead of a new array.
+# A buffer allocated once for the largest block keeps the callback from
+# allocating anything at all.
+def mixvoices(pool, int frame_count, numpy.ndarray FADEOUT, int FADEOUTLENGTH, int workers=1, numpy.ndarray out=None):
+    cdef int v, w, o, n, i, nactive = 0, size = pool.size, stride
+    cdef numpy.ndarray b       # output buffer
+    cdef float* bb
+    cdef float* fadeout = <float *> (FADEOUT.data)
+    cdef float* pp
+    cdef numpy.ndarray z, h, partial
+    cdef list data = pool.data, kernels = pool.kernels
+    cdef numpy.ndarray a_active = pool.active, a_fading = pool.fading, a_pos = pool.pos, a_speed = pool.speed
+    cdef numpy.ndarray a_gain = pool.gain, a_ramp = pool.ramp, a_stolen = pool.stolen, a_fadepos = pool.fadepos
+    cdef numpy.ndarray a_length = pool.length, a_loop = pool.loop, a_nch = pool.nch, a_interp = pool.interp
+    cdef numpy.ndarray a_addresses = pool.addresses, a_geometry = pool.geometry
+    cdef Slots s
+    cdef int* order
+    if out is not None and out.shape[0] >= 2 * frame_count:
+        b = out
+        memset(b.data, 0, 2 * frame_count * sizeof(float))
+    else:
+        b = numpy.zeros(2 * frame_count, numpy.float32)
+    bb = <float *> (b.data)
+    s.active = <unsigned char *> (a_active.data)
+    s.fading = <unsigned char *> (a_fading.data)
+    s.positions = <double *> (a_pos.data)
+    s.speed = <float *> (a_speed.data)
+    s.gain = <float *> (a_gain.data)
+    s.ramp = <float *> (a_ramp.data)
+    s.stolen = <unsigned char *> (a_stolen.data)
+    s.fadepos = <int *> (a_fadepos.data)
+    s.length = <int *> (a_length.data)
+    s.looppos = <int *> (a_loop.data)
+    s.nch = <int *> (a_nch.data)
+    s.interp = <unsigned char *> (a_interp.data)
+    s.data = <size_t *> (a_addresses.data)
+    s.kernels = s.data + size
+    s.taps = <int *> (a_geometry.data)
+    s.phases = s.taps + size
+    s.frames = s.phases + size
+    order = s.frames + size
+
+    if workers > 1:
+        partial = pool.partial
+        if partial.shape[0] < workers or partial.shape[1] < 2 * frame_count:
+            partial = pool.partial = numpy.zeros((max(workers, partial.shape[0]), max(2 * frame_count, partial.shape[1])),
+                                                 numpy.float32)
+
+    # Addresses and geometry of the active voices, in slot order
+    for v in range(size):
+        if not s.active[v]:
+            continue
+        z = data[v]
+        h = kernels[v]
+        s.data[v] = <size_t> z.data
+        s.kernels[v] = <size_t> h.data
+        s.taps[v] = h.shape[1]
+        s.phases[v] = h.shape[0] - 1
+        s.frames[v] = z.shape[0] // s.nch[v]
+        order[nactive] = v
+        nactive += 1
+
+    # The mix itself runs without the GIL: sensor, MIDI, button and
+    # loading threads keep running meanwhile
+    if workers <= 1 or nactive <= 1:
+        with nogil:
+            for o in range(nactive):
+                mixslot(&s, order[o], bb, frame_count, fadeout, FADEOUTLENGTH)
+        return b
+
+    if workers > nactive:
+        workers = nactive
+    pp = <float *> (partial.data)
+    stride = partial.shape[1]
+    with nogil:
+        for w in prange(workers, num_threads=workers, schedule='static', chunksize=1):
+            memset(pp + w * stride, 0, 2 * frame_count * sizeof(float))
+            o = w
+            while o < nactive:
+                mixslot(&s, order[o], pp + w * stride, frame_count, fadeout, FADEOUTLENGTH)
+                o = o + workers
+        for w in range(workers):
+            for i in range(2 * frame_count):
+                bb[i] += pp[w * stride + i]
+    return b
+
+# lowbias32 integer hash: the dither noise is a function of a sample
+# counter, so it is the same on both backends and in every offline render
+cdef inline unsigned int noisehash(unsigned int x) noexcept nogil:
+    x ^= x >> 16
+    x *= <unsigned int> 0x7feb352dU
+    x ^= x >> 15
+    x *= <unsigned int> 0x846ca68bU
+    x ^= x >> 16
+    return x
+
+# Output stage: writes the mixed block b to the int16 outdata in one pass,
+# applying the master gain, a soft limiter and, if dither (a one-element
+# uint32 array, the noise counter) is given, TPDF dither. An all-zero
+# block gets no dither, so silence stays digitally silent.
+#
+# Below knee * full scale samples pass untouched; above it the level
+# follows threshold + room * u / (1 + u), which leaves the knee with a
+# slope of 1 and only approaches full scale, so loud chords saturate
+# smoothly instead of wrapping around (knee 1 = hard clip only). Nothing
+# is looked ahead: each sample is limited on its own.
+#
+# outdata sets the length: b may be a longer buffer (see mixvoices' out).
+def outputstage(numpy.ndarray b, numpy.ndarray outdata, float gain, float knee, numpy.ndarray dither=None):
+    cdef int i, n = outdata.size
+    cdef float* bb = <float *> (b.data)
+    cdef short* out = <short *> (outdata.data)
+    cdef float full = 32767, threshold = knee * full, room = full - threshold
+    cdef float half = 0.5, scale = 1.0 / 16777216, s, a, u
+    cdef unsigned int counter = 0
+    cdef unsigned int* state = NULL
+    cdef bint dithering = dither is not None
+    if dithering:
+        state = <unsigned int *> (dither.data)
+        counter = state[0]
+    with nogil:
+        if dithering:
+            dithering = False
+            for i in range(n):
+                if bb[i] != 0:
+                    dithering = True
+                    break
+        for i in range(n):
+            s = bb[i] * gain
+            a = s if s >= 0 else -s
+            if a > threshold:
+                if room > 0:
+                    u = (a - threshold) / room
+                    a = threshold + room * (u / (1 + u))
+                else:
+                    a = full
+                s = a if s > 0 else -a
+            if dithering: # triangular noise of +-1 LSB
+                s = s + ((noisehash(counter) >> 8) * scale + (noisehash(counter + 1) >> 8) * scale - 1)
+                counter += 2
+            s = floorf(s + half)
+            if s > 32767:
+                s = 32767
+            elif s < -32768:
+                s = -32768
+            out[i] = <short> s
+    if dither is not None:
+        state[0] = counter
+
+# Starts the OpenMP threads mixvoices(..., workers) will use, so that the
+# first parallel callback does not have to
+def startworkers(int workers):
+    cdef int w, started = 0
+    for w in prange(workers, nogil=True, num_threads=workers, schedule='static', chunksize=1):
+        started += 1
+    return started
+
 def binary24_to_int16(char *data, int length):
     cdef int i
     res = numpy.zeros(length, numpy.int16)
     b = <char *>((<numpy.ndarray>res).data)
-    for i in range(length):
-        b[2*i] = data[3*i+1]
-        b[2*i+1] = data[3*i+2]
+    with nogil: # long files: let the audio callback run meanwhile
+        for i in range(length):
+            b[2*i] = data[3*i+1]
+            b[2*i+1] = data[3*i+2]
     return res
@@ -0,0 +1,59 @@
+#
+#  samplestore.py: Memory-mapped sample store
+#
+#  Maps the data chunk of a 16-bit WAV file straight into memory as an
+#  int16 numpy array. Nothing is read or copied up front: the kernel pages
+#  the samples in from the SD card when they are first touched, and clean
+#  pages can be dropped again under memory pressure.
+#
+#  Pages of the active bank can be pre-faulted (touched once after loading)
+#  and optionally locked with mlock() so the audio callback never waits on
+#  a page fault. Locking needs a large enough RLIMIT_MEMLOCK (ulimit -l)
+#  or root.
+
+import ctypes
+import ctypes.util
+import mmap
+import numpy
+
+PAGESIZE = mmap.PAGESIZE
+
+_libc = None
+_locked = [] # arrays of the bank currently locked in memory
+
+
+# Returns an int16 view of `count` samples starting at byte `offset`
+def mapdata(filename, offset, count):
+    if count <= 0:
+        return numpy.zeros(0, numpy.int16)
+    return numpy.memmap(filename, dtype=numpy.int16, mode='r', offset=offset, shape=(count,))
+
+
+# Touches one sample per page so every page is resident
+def prefault(arrays):
+    step = max(PAGESIZE // 2, 1)
+    for data in arrays:
+        if len(data):
+            int(data[::step].sum())
+
+
+def _mlock(data, lock):
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    call = _libc.mlock if lock else _libc.munlock
+    return call(ctypes.c_void_p(data.ctypes.data), ctypes.c_size_t(data.nbytes)) == 0
+
+
+# Unlocks the previously locked bank and locks `arrays` into RAM.
+# Returns the number of bytes locked (0 if mlock is not permitted).
+def lockbank(arrays):
+    for data in _locked:
+        _mlock(data, False)
+    del _locked[:]
+    nbytes = 0
+    for data in arrays:
+        if len(data) and _mlock(data, True):
+            _locked.append(data)
+            nbytes += data.nbytes
+    return nbytes
@@ -0,0 +1,68 @@
+#
+#  scanloop.py: Fixed-rate, drift-free scheduling for the sensor scan loop
+#
+#  ScanScheduler.wait() sleeps until the next tick of a fixed grid
+#  (start + n * period), so time spent scanning and handling notes doesn't
+#  accumulate as drift. If the loop falls more than a period behind, the
+#  missed ticks are skipped instead of being run back to back.
+#
+#  Every tick records how late it woke up, in a ring buffer, so the loop
+#  can report its effective scan rate and jitter.
+
+from __future__ import division
+import time
+import numpy
+from latency import clock
+
+
+class ScanScheduler:
+
+    def __init__(self, rate, window=2048):
+        self.rate = rate
+        self.period = 1.0 / rate
+        self.next = None
+        self.ticks = numpy.zeros(window) # wake-up times
+        self.late = numpy.zeros(window)  # wake-up time - scheduled time
+        self.count = 0
+        self.missed = 0
+
+    # Sleeps until the next tick and returns the time it woke up
+    def wait(self):
+        now = clock()
+        if self.next is None:
+            self.next = now
+        elif self.next > now:
+            time.sleep(self.next - now)
+            now = clock()
+        i = self.count % len(self.ticks)
+        self.ticks[i] = now
+        self.late[i] = now - self.next
+        self.count += 1
+        self.next += self.period
+        if now - self.next > self.period: # fell behind: skip, don't burst
+            skip = int((now - self.next) / self.period)
+            self.next += skip * self.period
+            self.missed += skip
+        return now
+
+    # Effective rate (Hz) and lateness percentiles (seconds) over the
+    # last `window` ticks
+    def stats(self):
+        n = min(self.count, len(self.ticks))
+        if n < 2:
+            return {'rate': 0.0, 'target': self.rate, 'p50': 0.0, 'p99': 0.0, 'max': 0.0, 'missed': self.missed}
+        ticks = self.ticks[:n]
+        late = self.late[:n]
+        return {
+            'rate': (n - 1) / (ticks.max() - ticks.min()),
+            'target': self.rate,
+            'p50': numpy.percentile(late, 50),
+            'p99': numpy.percentile(late, 99),
+            'max': late.max(),
+            'missed': self.missed,
+        }
+
+    def report(self):
+        s = self.stats()
+        return 'Scan rate %.0f Hz (target %.0f), jitter p50 %.2f ms, p99 %.2f ms, max %.2f ms, %d missed' % (
+            s['rate'], s['target'], s['p50'] * 1000, s['p99'] * 1000, s['max'] * 1000, s['missed'])
@@ -0,0 +1,117 @@
+#
+#  sensorfilter.py: Breath sensor conditioning
+#
+#  A hole is blown when its pressure reading goes tolerance above the
+#  resting value and drawn when it goes tolerance below. Compared raw,
+#  ADC noise around a threshold flips the hole on and off from one scan to
+#  the next, and every flip is a note-on or note-off (and a voice out of
+#  MAX_NUM_VOICES). SensorConditioner decides the state of all channels
+#  at once, per scan:
+#
+#    filter      the last `window` scans are kept in a ring buffer and
+#                each channel follows their median (spikes of less than
+#                half the window are ignored, onsets are delayed by
+#                window // 2 scans), or a one-pole low-pass of the raw
+#                values ('onepole', alpha), or the raw values ('none')
+#    hysteresis  a sounding hole is only released once it is back within
+#                (1 - hysteresis) * tolerance of rest, not as soon as it
+#                dips under the note-on threshold
+#    hold        a channel keeps a new state for at least `hold` scans
+#                before it may change again (debounce)
+#
+#  With filter 'none', hysteresis 0 and hold 0 it decides exactly what
+#  comparing the raw values did. Either way it also keeps the state raw
+#  thresholding would be in, and counts the changes the conditioning
+#  suppressed (bench_conditioning.py measures it on noisy input).
+#
+#  The thresholds are arrays updated in place by setresting(), so callers
+#  can hold on to them while the resting values are recalibrated.
+
+from __future__ import division
+import numpy
+
+OFF, BLOW, DRAW = 0, 1, 2
+FILTERS = ('median', 'onepole', 'none')
+
+
+class SensorConditioner:
+
+    def __init__(self, resting, blowtolerance, drawtolerance, filter='median', window=3, alpha=0.5,
+                 hysteresis=0.0, hold=0):
+        if filter not in FILTERS:
+            raise ValueError('unknown sensor filter %r (expected one of %s)' % (filter, ', '.join(FILTERS)))
+        resting = numpy.array(resting, float)
+        n = len(resting)
+        self.filter = filter
+        self.alpha = alpha
+        self.hold = hold
+        self.blowtolerance = blowtolerance
+        self.drawtolerance = drawtolerance
+        self.hysteresis = hysteresis
+        self.frames = numpy.tile(resting, (max(1, window), 1)) # ring buffer of the last scans
+        self.position = 0
+        self.level = resting.copy()                # filtered values
+        self.state = numpy.zeros(n, numpy.int8)    # OFF, BLOW or DRAW
+        self.age = numpy.zeros(n, numpy.int64)     # scans since the state changed
+        self.rawstate = numpy.zeros(n, numpy.int8) # state of raw thresholding
+        self.resting = numpy.zeros(n)
+        self.blowon = numpy.zeros(n)
+        self.blowoff = numpy.zeros(n)
+        self.drawon = numpy.zeros(n)
+        self.drawoff = numpy.zeros(n)
+        self.setresting(resting)
+        self.scans = 0
+        self.events = 0    # state changes
+        self.rawevents = 0 # state changes raw thresholding would have made
+
+    # Sets the resting values and the thresholds around them, in place
+    def setresting(self, resting):
+        self.resting[:] = resting
+        self.blowon[:] = self.resting + self.blowtolerance
+        self.blowoff[:] = self.resting + (1 - self.hysteresis) * self.blowtolerance
+        self.drawon[:] = self.resting - self.drawtolerance
+        self.drawoff[:] = self.resting - (1 - self.hysteresis) * self.drawtolerance
+
+    # Takes one scan (a value per channel) and returns the mask of the
+    # channels whose state changed; the new states are in state, the
+    # filtered values in level
+    def update(self, values):
+        values = numpy.asarray(values)
+        self.frames[self.position] = values
+        self.position = (self.position + 1) % len(self.frames)
+        if self.filter == 'median':
+            numpy.median(self.frames, axis=0, out=self.level)
+        elif self.filter == 'onepole':
+            self.level += self.alpha * (values - self.level)
+        else:
+            self.level[:] = values
+        level = self.level
+        state = self.state
+
+        # Sounding holes are released past their off threshold, then idle
+        # ones start past their on threshold (blow first, like before)
+        want = state.copy()
+        want[(state == BLOW) & (level <= self.blowoff)] = OFF
+        want[(state == DRAW) & (level >= self.drawoff)] = OFF
+        idle = want == OFF
+        want[idle & (level < self.drawon)] = DRAW
+        want[idle & (level > self.blowon)] = BLOW
+        self.age += 1
+        changed = (want != state) & (self.age >= self.hold)
+        state[changed] = want[changed]
+        self.age[changed] = 0
+
+        raw = numpy.where(values > self.blowon, BLOW, numpy.where(values < self.drawon, DRAW, OFF))
+        self.rawevents += int(numpy.count_nonzero(raw != self.rawstate))
+        self.rawstate[:] = raw
+        self.events += int(numpy.count_nonzero(changed))
+        self.scans += 1
+        return changed
+
+    # State changes raw thresholding would have made on top of ours
+    def suppressed(self):
+        return max(0, self.rawevents - self.events)
+
+    def report(self):
+        return 'Sensors: %d scans, %d note changes, %d spurious ones suppressed (%.0f%% of raw crossings)' % (
+            self.scans, self.events, self.suppressed(), 100.0 * self.suppressed() / max(1, self.rawevents))
@@ -1,5 +1,11 @@
 from distutils.core import setup
+from distutils.extension import Extension
 from Cython.Build import cythonize
 import numpy
 
-setup(ext_modules = cythonize("samplerbox_audio.pyx"), include_dirs=[numpy.get_include()])
\ No newline at end of file
+# OpenMP lets mixvoices spread the voices over several cores (MIXER_THREADS in dhp.py);
+# -ffp-contract=off stops GCC fusing multiply-adds so the output stays bit-identical to numpy_mixer
+extensions = [Extension("samplerbox_audio", ["samplerbox_audio.pyx"],
+                        extra_compile_args=['-fopenmp', '-ffp-contract=off'], extra_link_args=['-fopenmp'])]
+
+setup(ext_modules = cythonize(extensions), include_dirs=[numpy.get_include()])
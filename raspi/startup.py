@@ -0,0 +1,127 @@
+#
+#  startup.py: Startup phases and the boot timeline
+#
+#  Most of what dhp.py does before the first note waits on something
+#  else: PortAudio opening the sound card, the SD card for the samples,
+#  the sensors settling for the calibration, amixer, the MIDI ports. None
+#  of these depend on each other, so Startup runs each phase in its own
+#  thread as soon as the phases it needs are done, and the caller waits
+#  only for the phases the harmonica needs to play.
+#
+#    mark(name)              a phase that just ran in the caller's thread
+#    run(name, target, after) target() in a thread, once the phases in
+#                            after are done (in order, in the caller's
+#                            thread, when not concurrent: offline renders
+#                            stay deterministic)
+#    wait(*names)            blocks until those phases are done, returns
+#                            the ones that failed as [(name, exception)]
+#    timeline()              when each phase ran, relative to the start
+#
+#  A phase that raises is recorded as failed (with its traceback printed)
+#  and the phases after it are skipped; the caller decides whether to go
+#  on without them.
+#
+
+from __future__ import division
+import sys
+import time
+import threading
+import traceback
+from latency import clock
+
+WIDTH = 40 # characters of the timeline's bars
+
+
+class Phase:
+
+    def __init__(self, name, after=()):
+        self.name = name
+        self.after = after
+        self.began = None
+        self.ended = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class Startup:
+
+    def __init__(self, start=None, concurrent=True):
+        self.start = clock() if start is None else start
+        self.concurrent = concurrent
+        self.phases = []
+        self.byname = {}
+        self.playable = None # when the harmonica could first be played
+        self._last = self.start
+
+    def _add(self, phase):
+        self.phases.append(phase)
+        self.byname[phase.name] = phase
+        return phase
+
+    # Records a phase that ran in the caller's thread since the last mark
+    def mark(self, name):
+        phase = self._add(Phase(name))
+        phase.began = self._last
+        phase.ended = self._last = clock()
+        phase.done.set()
+
+    def run(self, name, target, after=()):
+        phase = self._add(Phase(name, after))
+        if self.concurrent:
+            thread = threading.Thread(target=self._run, args=(phase, target))
+            thread.daemon = True
+            thread.start()
+        else:
+            self._run(phase, target)
+
+    def _run(self, phase, target):
+        try:
+            for name in phase.after:
+                dependency = self.byname[name]
+                dependency.done.wait()
+                if dependency.error is not None:
+                    raise RuntimeError('needs %s, which failed' % name)
+            phase.began = clock()
+            target()
+        except Exception as e:
+            phase.error = e
+            if phase.began is not None:
+                sys.stderr.write('Startup phase %s failed:\n%s' % (phase.name, traceback.format_exc()))
+        finally:
+            if phase.began is None:
+                phase.began = clock()
+            phase.ended = clock()
+            phase.done.set()
+
+    def wait(self, *names):
+        failed = []
+        for name in names:
+            phase = self.byname[name]
+            phase.done.wait()
+            if phase.error is not None:
+                failed.append((name, phase.error))
+        return failed
+
+    # Notes that the harmonica is playable from now on
+    def ready(self):
+        self.playable = clock()
+
+    def finished(self):
+        return all(phase.done.is_set() for phase in self.phases)
+
+    def timeline(self):
+        now = clock()
+        ends = [phase.ended if phase.ended is not None else now for phase in self.phases]
+        total = max(ends + [now if self.playable is None else self.playable]) - self.start
+        scale = WIDTH / total if total > 0 else 0
+        lines = ['Boot timeline (ms):']
+        for phase, ended in zip(self.phases, ends):
+            began = phase.began if phase.began is not None else ended
+            first = int((began - self.start) * scale)
+            bar = ' ' * first + '#' * max(1, int((ended - self.start) * scale) - first)
+            status = 'failed' if phase.error is not None else ('' if phase.done.is_set() else 'running')
+            lines.append('  %-12s %8.1f %8.1f  |%-*s| %s' % (
+                phase.name, 1000 * (began - self.start), 1000 * (ended - self.start), WIDTH, bar, status))
+        if self.playable is not None:
+            lines.append('  playable at %.1f ms' % (1000 * (self.playable - self.start)))
+        return '\n'.join(line.rstrip() for line in lines)
@@ -0,0 +1,181 @@
+#
+#  transposecache.py: Pre-rendered transposition cache
+#
+#  Instrument._fillEmptySamplesByTranspose fills notes that have no WAV
+#  file with a transposed copy of a neighbouring sample. Without this
+#  cache the mixer pitch-shifts those notes on every audio callback
+#  (SPEED[note - sound.midinote] + linear interpolation). The cache
+#  renders each shifted buffer once, either at load time or lazily in a
+#  background thread the first time the note is played, so transposed
+#  notes are mixed at speed 1.0 with a straight copy. Notes are rendered
+#  with the interpolation tier of their sound (see interpolation.py).
+#
+#  Rendered buffers are kept within a memory budget (bytes) and the least
+#  recently used ones are evicted first. A note whose buffer alone would
+#  exceed the budget is never rendered: it is remembered as oversize and
+#  keeps playing through the mixer's transposition.
+
+from __future__ import division
+import copy
+import threading
+import numpy
+import interpolation
+from latency import clock
+from collections import OrderedDict
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+# Resamples an interleaved int16 buffer by `ratio` (2 ** (semitones/12))
+# using the same interpolation as the mixer (linear, or the given tier).
+# Returns (data, loop, nframes) for the rendered sound.
+def render(data, nchannels, nframes, loop, ratio, tier=interpolation.LINEAR):
+    frames = data[:nframes * nchannels].reshape(-1, nchannels).astype(numpy.float32)
+    outframes = int((len(frames) - 2) / ratio)
+    j = numpy.arange(outframes) * ratio
+    if tier == interpolation.LINEAR:
+        k = j.astype(numpy.int64)
+        frac = (j - k).astype(numpy.float32)[:, None]
+        out = frames[k] + frac * (frames[k + 1] - frames[k])
+    else:
+        out = interpolation.interpolate(frames, j.astype(numpy.float32), tier, interpolation.kernel(tier, ratio))
+    out = numpy.clip(numpy.round(out), -32768, 32767).astype(numpy.int16)
+    if loop != -1:
+        loop = min(int(round(loop / ratio)), outframes - 3)
+    return out.ravel(), loop, outframes
+
+
+# Bytes of the buffer render() makes of sound at ratio
+def renderedsize(sound, nchannels, ratio):
+    frames = min(sound.nframes, len(sound.data) // nchannels)
+    return max(int((frames - 2) / ratio), 0) * nchannels * numpy.dtype(numpy.int16).itemsize
+
+
+class TransposeCache:
+
+    def __init__(self, maxbytes=32*1024*1024, background=True):
+        self.maxbytes = maxbytes
+        self.background = background
+        self.rendered = OrderedDict() # (fname, midinote) -> sound, in LRU order
+        self.pending = set()
+        self.oversize = set() # keys whose buffer would not fit in maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.renders = 0
+        self.evictions = 0
+        self.rendertime = 0.0
+        self.lock = threading.Lock()
+        self.requests = queue.Queue()
+        self.worker = None
+
+    # Returns the sound to play for midinote: the pre-rendered buffer if it
+    # is cached, otherwise the original sound (which the mixer transposes)
+    # while a render is scheduled.
+    def lookup(self, sound, midinote):
+        if sound.midinote == midinote:
+            return sound
+        key = (sound.fname, midinote)
+        with self.lock:
+            rendered = self.rendered.get(key)
+            if rendered is not None:
+                self.rendered.pop(key)
+                self.rendered[key] = rendered # most recently used
+                self.hits += 1
+                return rendered
+            self.misses += 1
+        self.request(sound, midinote)
+        return sound
+
+    # Schedules the transposed buffer for midinote to be rendered
+    def request(self, sound, midinote):
+        key = (sound.fname, midinote)
+        with self.lock:
+            if key in self.rendered or key in self.pending or key in self.oversize:
+                return
+            self.pending.add(key)
+        if not self.background:
+            self._render(sound, midinote)
+            return
+        self._queue(self._render, (sound, midinote))
+
+    # Runs function(*args) on the render thread, after the renders
+    # requested before it (in the caller's thread if not background)
+    def defer(self, function, *args):
+        if not self.background:
+            function(*args)
+            return
+        self._queue(function, args)
+
+    def _queue(self, function, args):
+        if self.worker is None:
+            self.worker = threading.Thread(target=self._work)
+            self.worker.daemon = True
+            self.worker.start()
+        self.requests.put((function, args))
+
+    # Renders the transposed buffer for midinote in the caller's thread
+    # unless it is cached already, so the next lookup hits
+    def prepare(self, sound, midinote):
+        if sound.midinote == midinote:
+            return
+        with self.lock:
+            if (sound.fname, midinote) in self.rendered or (sound.fname, midinote) in self.oversize:
+                return
+        self._render(sound, midinote)
+
+    def _work(self):
+        while True:
+            function, args = self.requests.get()
+            function(*args)
+
+    def _render(self, sound, midinote):
+        start = clock()
+        nchannels = getattr(sound, 'nchannels', 2)
+        ratio = 2 ** ((midinote - sound.midinote) / 12)
+        key = (sound.fname, midinote)
+        if renderedsize(sound, nchannels, ratio) > self.maxbytes:
+            with self.lock:
+                self.pending.discard(key)
+                self.oversize.add(key)
+            return
+        rendered = copy.copy(sound)
+        rendered.data, rendered.loop, rendered.nframes = render(
+            sound.data, nchannels, sound.nframes, sound.loop, ratio,
+            getattr(sound, 'interpolation', interpolation.LINEAR))
+        rendered.midinote = midinote
+        size = rendered.data.nbytes
+        with self.lock:
+            self.pending.discard(key)
+            self.rendertime += clock() - start
+            self.renders += 1
+            if key in self.rendered: # rendered twice
+                return
+            while self.nbytes + size > self.maxbytes:
+                oldkey, old = self.rendered.popitem(last=False)
+                self.nbytes -= old.data.nbytes
+                self.evictions += 1
+            self.rendered[key] = rendered
+            self.nbytes += size
+
+    def clear(self):
+        with self.lock:
+            self.rendered.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitrate': self.hits / lookups if lookups else 0.0,
+                'renders': self.renders,
+                'evictions': self.evictions,
+                'entries': len(self.rendered),
+                'oversize': len(self.oversize),
+                'bytes': self.nbytes,
+                'rendertime': self.rendertime,
+            }
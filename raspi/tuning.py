@@ -0,0 +1,123 @@
+#
+#  tuning.py: Harmonica tunings
+#
+#  A tuning is a layout (which interval each hole plays, blown and drawn)
+#  in a key, transposed by any number of semitones (the GPIO transpose
+#  buttons). TuningTable compiles every layout in every key into arrays
+#  indexed [layout, key, direction, hole]:
+#
+#    notes    the midinote the hole plays (before the transposition)
+#    sources  the midinote of the sample that plays it, transposed, in the
+#             loaded bank (-1 if none, e.g. still loading), see resolve()
+#    rates    the playback rate of that sample (SPEED[note - source])
+#
+#  The scan loop reads `current`, (notes, sources, rates) of the active
+#  layout and key with the transposition applied, once per scan, and a
+#  hole's note-on plays its sample at the compiled rate (unless the
+#  transpose cache has the note pre-rendered, which plays at rate 1).
+#  select() and resolve() rebuild the tables into new arrays and switch
+#  by swapping one reference: no per-event arithmetic, and a scan never
+#  sees half of a switch.
+#
+#  Keys are named after the harmonica: hole 1 blow is the tonic, C at
+#  TONIC, with G to B pitched below C and Db to F# above it, like real
+#  harps.
+#
+
+from __future__ import division
+import threading
+import numpy
+
+BLOW, DRAW = 0, 1
+HOLES = 10
+TONIC = 36 # hole 1 blow of the C harmonica
+KEYS = ('C', 'Db', 'D', 'Eb', 'E', 'F', 'F#', 'G', 'Ab', 'A', 'Bb', 'B')
+OFFSETS = (0, 1, 2, 3, 4, 5, 6, -5, -4, -3, -2, -1) # semitones from C
+
+# (name, blow, draw): semitones of each hole above the key's tonic
+LAYOUTS = [
+    # This project's own: C major triads blown, B diminished triads drawn
+    ('dhp', [0, 4, 7, 12, 16, 19, 24, 28, 31, 36], [11, 14, 17, 23, 26, 29, 35, 38, 41, 47]),
+    ('richter', [0, 4, 7, 12, 16, 19, 24, 28, 31, 36], [2, 7, 11, 14, 17, 21, 23, 26, 29, 33]),
+    # Richter with hole 3 blow a whole step up: no missing 6th in the low octave
+    ('paddy richter', [0, 4, 9, 12, 16, 19, 24, 28, 31, 36], [2, 7, 11, 14, 17, 21, 23, 26, 29, 33]),
+    # Richter with hole 5 draw a half step up, for the major 7th in 2nd position
+    ('country', [0, 4, 7, 12, 16, 19, 24, 28, 31, 36], [2, 7, 11, 14, 18, 21, 23, 26, 29, 33]),
+    # Minor triads blown, the rest of the natural minor scale drawn
+    ('natural minor', [0, 3, 7, 12, 15, 19, 24, 27, 31, 36], [2, 7, 10, 14, 17, 20, 22, 26, 29, 32]),
+]
+
+
+class TuningTable:
+
+    def __init__(self, layouts=LAYOUTS, tonic=TONIC):
+        self.names = [name for name, blow, draw in layouts]
+        intervals = numpy.array([[blow, draw] for name, blow, draw in layouts], numpy.intp)
+        offsets = numpy.array(OFFSETS, numpy.intp)
+        self.notes = tonic + intervals[:, None, :, :] + offsets[None, :, None, None]
+        self.layout = 0
+        self.key = 0
+        self.transpose = 0 # semitones, unbounded
+        self.source = numpy.full(128, -1, numpy.intp) # sample midinote per midinote
+        self.speed = numpy.ones(1, numpy.float32)
+        self.lock = threading.Lock() # select() and resolve() come from different threads
+        self._compile()
+
+    # Index of a layout given by name or index
+    def layoutindex(self, layout):
+        return self.names.index(layout) if layout in self.names else int(layout)
+
+    # Index of a key given by name, or by index (any integer: keys wrap)
+    def keyindex(self, key):
+        return KEYS.index(key) if key in KEYS else int(key) % len(KEYS)
+
+    # Notes of holes [direction, hole] in layout and key, transposed by
+    # transpose semitones (None: the current ones)
+    def lookup(self, layout=None, key=None, transpose=None):
+        layout = self.layout if layout is None else self.layoutindex(layout)
+        key = self.key if key is None else self.keyindex(key)
+        transpose = self.transpose if transpose is None else int(transpose)
+        return self.notes[layout, key] + transpose if transpose else self.notes[layout, key]
+
+    # Makes layout, key and transposition the active tuning
+    def select(self, layout=None, key=None, transpose=None):
+        layout = self.layout if layout is None else self.layoutindex(layout)
+        key = self.key if key is None else self.keyindex(key)
+        transpose = self.transpose if transpose is None else int(transpose)
+        with self.lock:
+            retranspose = transpose != self.transpose
+            self.layout, self.key, self.transpose = layout, key, transpose
+            self._compile(retranspose)
+        return self.active
+
+    # Compiles sources and rates for a bank {midinote: sound}; speed is
+    # dhp.py's SPEED (negative indexes transpose down)
+    def resolve(self, samples, speed):
+        source = numpy.full(128, -1, numpy.intp)
+        for midinote, sound in list(samples.items()):
+            if 0 <= midinote < 128:
+                source[midinote] = sound.midinote
+        with self.lock:
+            self.source, self.speed = source, speed
+            self._compile()
+
+    # New sources and rates at the transposition (if tables, the notes
+    # and bank changed), then the active tuning of them
+    def _compile(self, tables=True):
+        if tables:
+            notes = self.notes + self.transpose
+            inside = (notes >= 0) & (notes < 128)
+            sources = numpy.where(inside, self.source[numpy.clip(notes, 0, 127)], -1)
+            found = sources >= 0
+            rates = numpy.where(found, self.speed[numpy.where(found, notes - sources, 0) % len(self.speed)], 0)
+            self.sources, self.rates = sources, rates.astype(numpy.float32)
+        active = self.lookup()
+        self.current = (active, self.sources[self.layout, self.key], self.rates[self.layout, self.key])
+        self.active = active
+
+    def describe(self, layout=None, key=None, transpose=None):
+        layout = self.layout if layout is None else self.layoutindex(layout)
+        key = self.key if key is None else self.keyindex(key)
+        transpose = self.transpose if transpose is None else int(transpose)
+        text = '%s in %s' % (self.names[layout], KEYS[key])
+        return text + (' transposed %+d' % transpose if transpose else '')
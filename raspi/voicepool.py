@@ -0,0 +1,249 @@
+#
+#  voicepool.py: Fixed-size voice pool
+#
+#  Every voice is a slot in a set of preallocated arrays (position, speed,
+#  gain, fade state, sample geometry) that mixvoices() in
+#  samplerbox_audio.pyx / numpy_mixer.py reads and updates in place; the
+#  sample data of each slot is kept in a list alongside.
+#
+#  Only the audio callback touches the arrays. Note-ons and releases from
+#  the MIDI, sensor and button threads are appended to a deque (append and
+#  popleft are atomic) and applied by the callback at the start of the next
+#  block, so neither side ever takes a lock.
+#
+#  Breath pressure is written with express(), one batch per sensor scan,
+#  into a per-note table: no queueing, the latest batch wins, and a note
+#  given twice in a batch (two holes playing it) takes the larger gain. Polyphonic
+#  aftertouch from MIDI input goes into a table of its own with
+#  aftertouch(), so the scans never overwrite it; the caller clears a
+#  note's aftertouch at its note-off. At the start of each block every
+#  voice whose note has a pressure (the larger of the two) takes it as its
+#  target gain, and the mixer ramps linearly from the current gain to the
+#  target across the block, so swells and decays are smooth (no zipper
+#  noise). Notes without pressure (-1) keep the gain of their note-on
+#  velocity.
+#
+#  A note-on can carry an origin time (see latency.py): apply() then lists
+#  (origin, time queued) of the voices it started in `started`, for the
+#  callback to measure and clear.
+#
+#  Each voice also carries the interpolation tier of its sound (see
+#  interpolation.py); the sinc table it needs is looked up (built the first
+#  time a speed is played) by noteon(), in the calling thread.
+#
+#  At most maxvoices voices play at once. A note-on beyond that steals the
+#  quietest releasing voice (the oldest one on ties), or the oldest voice if
+#  none is releasing, and fades it out over stealfade frames in one of the
+#  reserve slots instead of cutting it off with a click. When every reserve
+#  slot is still busy fading, the new voice takes the quietest of them,
+#  but only among the ones a mixed block has already faded (the release
+#  fade started, or the gain below where the steal began). Otherwise, as
+#  when many note-ons land in one block, the note-on is held back to the
+#  next block; a pool with nothing fading out first fades its quietest
+#  voice.
+
+import itertools
+import numpy
+import interpolation
+from latency import clock
+from collections import deque
+
+NOTEON, RELEASE, CLEAR = 0, 1, 2
+
+EMPTY = numpy.zeros(4, numpy.int16)
+
+
+# Returned by noteon(): identifies the voice for release()
+class Voice:
+
+    def __init__(self, pool, serial, note, velocity):
+        self.pool = pool
+        self.serial = serial
+        self.note = note
+        self.velocity = velocity
+
+    def fadeout(self, i=None):
+        self.pool.release(self.serial)
+
+
+class VoicePool:
+
+    def __init__(self, maxvoices, FADEOUT, reserve=4, stealfade=256):
+        self.maxvoices = maxvoices
+        self.size = maxvoices + reserve
+        self.FADEOUT = FADEOUT
+        self.stealfade = stealfade
+        self.active = numpy.zeros(self.size, numpy.uint8)
+        self.fading = numpy.zeros(self.size, numpy.uint8)   # released: following FADEOUT
+        self.serial = numpy.zeros(self.size, numpy.int64)   # note-on order
+        self.note = numpy.zeros(self.size, numpy.intp)      # intp: indexes pressure as is
+        self.pos = numpy.zeros(self.size, numpy.float64)
+        self.speed = numpy.ones(self.size, numpy.float32)
+        self.gain = numpy.zeros(self.size, numpy.float32)
+        self.target = numpy.zeros(self.size, numpy.float32) # gain to reach by the end of the block
+        self.ramp = numpy.zeros(self.size, numpy.float32)   # gain lost per frame in this block
+        self.stolen = numpy.zeros(self.size, numpy.uint8)   # fading out to be freed
+        self.stealgain = numpy.zeros(self.size, numpy.float32) # gain when stolen
+        self.fadepos = numpy.zeros(self.size, numpy.int32)
+        self.length = numpy.zeros(self.size, numpy.int32)
+        self.loop = numpy.zeros(self.size, numpy.int32)
+        self.nch = numpy.zeros(self.size, numpy.int32)
+        self.interp = numpy.zeros(self.size, numpy.uint8)   # interpolation tier
+        self.data = [EMPTY] * self.size
+        self.kernels = [interpolation.NOKERNEL] * self.size # sinc tables
+        # Mixer scratch (samplerbox_audio.mixvoices): sample and sinc table
+        # addresses, table and sample geometry, and per-thread partial mixes
+        self.addresses = numpy.zeros(2 * self.size, numpy.uintp)
+        self.geometry = numpy.zeros(4 * self.size, numpy.int32)
+        self.partial = numpy.zeros((0, 0), numpy.float32)
+        # apply() scratch: the gain ramps are computed without temporaries
+        self._pressure = numpy.zeros(self.size, numpy.float32)
+        self._delta = numpy.zeros(self.size, numpy.float32)
+        self._zero = numpy.zeros(self.size, numpy.float32)
+        self._blocklen = numpy.zeros(self.size, numpy.float32)
+        self._expressive = numpy.zeros(self.size, bool)
+        self._held = numpy.zeros(self.size, bool)
+        self._playing = numpy.zeros(self.size, bool)
+        self.commands = deque()
+        self.pressure = numpy.full(128, -1, numpy.float32) # breath, per midinote, -1 = none
+        self.touch = numpy.full(128, -1, numpy.float32)    # MIDI aftertouch, per midinote
+        self._notepressure = numpy.zeros(128, numpy.float32)
+        self._breath = numpy.zeros(128, numpy.float32) # express() scratch
+        self.serials = itertools.count(1)
+        self.steals = 0
+        self.started = [] # (origin, queued) of timed note-ons since cleared
+
+    # Any thread: queues a voice playing sound at speed (see SPEED)
+    def noteon(self, sound, note, speed, velocity, origin=None):
+        serial = next(self.serials)
+        stamp = None if origin is None else (origin, clock())
+        kernel = interpolation.kernel(getattr(sound, 'interpolation', interpolation.LINEAR), speed)
+        self.commands.append((NOTEON, serial, sound, note, speed, velocity, kernel, stamp))
+        return Voice(self, serial, note, velocity)
+
+    # Any thread: queues the release (FADEOUT) of a voice
+    def release(self, serial):
+        self.commands.append((RELEASE, serial))
+
+    # One thread (the sensor scan): sets the expression gain (0-1, -1 =
+    # none) of the voices of each note, in one batch (arrays or single
+    # values) that replaces the previous one
+    def express(self, notes, gains):
+        breath = self._breath
+        breath.fill(-1)
+        numpy.maximum.at(breath, numpy.clip(notes, 0, 127), gains)
+        numpy.copyto(self.pressure, breath)
+
+    # Any thread: sets the aftertouch gain (0-1, -1 = none) of the voices
+    # of note
+    def aftertouch(self, note, gain):
+        self.touch[min(max(note, 0), 127)] = gain
+
+    # Any thread: queues silencing every voice
+    def clear(self):
+        self.commands.append((CLEAR,))
+
+    # Audio thread: applies the queued commands and sets the gain ramps
+    # of the next frame_count frames
+    def apply(self, frame_count):
+        # Only this thread pops: a non-empty deque stays non-empty
+        while self.commands:
+            command = self.commands.popleft()
+            if command[0] == NOTEON:
+                if not self._start(*command[1:7]):
+                    self.commands.appendleft(command) # next block, once a slot faded out
+                    break
+                if command[7] is not None:
+                    self.started.append(command[7])
+            elif command[0] == RELEASE:
+                v = numpy.flatnonzero((self.serial == command[1]) & (self.active != 0))
+                self.fading[v] = 1
+            else:
+                self.active[:] = 0
+                self.data = [EMPTY] * self.size
+                self.kernels = [interpolation.NOKERNEL] * self.size
+
+        # Released voices keep their gain, stolen ones keep fading at
+        # their own rate. Every step writes into the scratch arrays, so a
+        # block without commands allocates nothing (see bench_alloc.py).
+        pressure = self._pressure
+        expressive = self._expressive
+        playing = self._playing
+        numpy.maximum(self.pressure, self.touch, self._notepressure)
+        self._notepressure.take(self.note, None, pressure, 'clip')
+        numpy.greater_equal(pressure, self._zero, expressive)
+        numpy.logical_not(self.stolen, playing)
+        numpy.logical_not(self.fading, self._held)
+        numpy.logical_and(expressive, playing, expressive)
+        numpy.logical_and(expressive, self._held, expressive)
+        numpy.putmask(self.target, expressive, pressure)
+        self._blocklen.fill(frame_count)
+        numpy.subtract(self.gain, self.target, self._delta)
+        numpy.divide(self._delta, self._blocklen, self._delta)
+        numpy.putmask(self.ramp, playing, self._delta)
+
+    def playing(self):
+        return int(numpy.count_nonzero(self.active))
+
+    # Starts a voice in a free slot, or in the quietest slot whose fade out
+    # a mixed block has already advanced; False when there is neither (a
+    # voice is then fading out to free one)
+    def _start(self, serial, sound, note, speed, velocity, kernel):
+        live = (self.active != 0) & (self.stolen == 0)
+        if numpy.count_nonzero(live) >= self.maxvoices:
+            self._steal(live)
+        free = numpy.flatnonzero(self.active == 0)
+        ending = numpy.flatnonzero((self.active != 0) & (
+            ((self.stolen != 0) & (self.gain < self.stealgain)) |
+            ((self.stolen == 0) & (self.fading != 0) & (self.fadepos > 0))))
+        if len(free):
+            v = free[0]
+        elif len(ending): # every reserve slot is still fading: cut the quietest
+            v = ending[numpy.argmin(self._level(ending))]
+        else: # never cut a voice at full level
+            if not (self.stolen.any() or self.fading.any()):
+                live = numpy.flatnonzero(self.active != 0)
+                self._fade(live[numpy.argmin(self._level(live))])
+            return False
+        self.active[v] = 1
+        self.fading[v] = 0
+        self.serial[v] = serial
+        self.note[v] = note
+        self.pos[v] = 0
+        self.speed[v] = speed
+        self.gain[v] = velocity / 127.0
+        self.target[v] = self.gain[v]
+        self.ramp[v] = 0
+        self.stolen[v] = 0
+        self.fadepos[v] = 0
+        self.length[v] = sound.nframes
+        self.loop[v] = sound.loop
+        self.nch[v] = getattr(sound, 'nchannels', 2)
+        self.interp[v] = getattr(sound, 'interpolation', interpolation.LINEAR)
+        self.data[v] = sound.data
+        self.kernels[v] = kernel
+        return True
+
+    # Gain of voices v right now, their release fade included
+    def _level(self, v):
+        return self.gain[v] * numpy.where(self.fading[v] != 0, self.FADEOUT.take(self.fadepos[v], mode='clip'), 1)
+
+    # Fades out the quietest releasing voice, or the oldest voice
+    def _steal(self, live):
+        releasing = numpy.flatnonzero(live & (self.fading != 0))
+        if len(releasing):
+            v = releasing[numpy.lexsort((self.serial[releasing], self._level(releasing)))[0]]
+        else:
+            live = numpy.flatnonzero(live)
+            v = live[numpy.argmin(self.serial[live])]
+        self._fade(v)
+
+    # Fades voice v out over stealfade frames, then frees it
+    def _fade(self, v):
+        self.steals += 1
+        self.stolen[v] = 1
+        self.stealgain[v] = self.gain[v]
+        if self.gain[v] > 0:
+            self.ramp[v] = self.gain[v] / self.stealfade
+        else:
+            self.active[v] = 0
@@ -0,0 +1,95 @@
+import wave
+import struct
+from chunk import Chunk
+from wave import Error
+
+#########################################
+# SLIGHT MODIFICATION OF PYTHON'S WAVE MODULE
+# TO READ CUE MARKERS & LOOP MARKERS
+#########################################
+# DHP-STUB: Comment: Original source code for the wave was copied and pasted with very little modification. 
+# This code is well explained in the following resources
+# https://docs.python.org/2/library/wave.html
+# https://hg.python.org/cpython/file/2.7/Lib/wave.py
+
+# The class waveread extends the class wave.Wave_read"
+class waveread(wave.Wave_read):
+    
+    def initfp(self, file):
+        # DHP-STUB: Comment: Intialize a handful of waveread's member variables
+        self._convert = None
+        self._soundpos = 0
+        self._cue = []
+        self._loops = []
+        self._ieee = False
+        self._file = Chunk(file, bigendian=0)
+
+        # Check to ensure the waveread 
+        if self._file.getname() != 'RIFF':
+            raise Error, 'file does not start with RIFF id'
+        if self._file.read(4) != 'WAVE':
+            raise Error, 'not a WAVE file'
+
+        # More Initializations for waveread's member variables
+        self._fmt_chunk_read = 0
+        self._data_chunk = None
+
+        # Reads all chunks of data in the WAVE file
+        # Ref: docs.python.org/2/library/chunk.html
+        # This while-loop ends when the end of file is hit.
+        while 1:
+            self._data_seek_needed = 1
+            try:
+                chunk = Chunk(self._file, bigendian=0)
+            except EOFError:
+                break # The only exit point for this while loop EOF
+            chunkname = chunk.getname()
+            if chunkname == 'fmt ':
+                self._read_fmt_chunk(chunk)
+                self._fmt_chunk_read = 1
+            elif chunkname == 'data': 
+                # The data subchunk indicates size of sound info & raw sound data!
+
+                # format subchunk must have already been seen in order to process data subchunks
+                if not self._fmt_chunk_read:
+                    raise Error, 'data chunk before fmt chunk'
+
+                self._data_chunk = chunk
+                self._nframes = chunk.chunksize // self._framesize
+                self._data_seek_needed = 0
+            elif chunkname == 'cue ': # Not in original wave_read class
+                # Ref: https://docs.python.org/2/library/struct.html
+                # chunk.read(N) means read at most N bytes from the chunk
+                numcue = struct.unpack('<i', chunk.read(4))[0]
+                for i in range(numcue):
+                    id, position, datachunkid, chunkstart, blockstart, sampleoffset = struct.unpack('<iiiiii', chunk.read(24))
+                    self._cue.append(sampleoffset)
+            elif chunkname == 'smpl': # Not in original wave_read class
+                
+                # DHP-STUB: This confusing looking line of code 
+                # unpacks 9 (little-endian) 32bit integers and places 
+                # assigns each to the corresponding left-hand-side 
+                # variable. The chunk.read argument is 36 because 
+                # 4 bytes/int * 9 ints = 36 bytes
+                manuf, prod, sampleperiod, midiunitynote, midipitchfraction, smptefmt, smpteoffs, numsampleloops, samplerdata = struct.unpack(
+                    '<iiiiiiiii', chunk.read(36))
+                for i in range(numsampleloops):
+                    
+                    # DHP-STUB: Comment: This may be important. TODO
+                    cuepointid, type, start, end, fraction, playcount = struct.unpack('<iiiiii', chunk.read(24))
+                    self._loops.append([start, end])
+            # outside the large while loop. End of file was reached.
+            chunk.skip()
+        if not self._fmt_chunk_read or not self._data_chunk:
+            raise Error, 'fmt chunk and/or data chunk missing'
+
+    def getmarkers(self):
+        return self._cue
+
+    def getloops(self):
+        return self._loops
+
+    # Byte offset of the sound data in the file. The RIFF chunk's own
+    # data starts 8 bytes in; the data chunk's offset is relative to it.
+    def getdataoffset(self):
+        return 8 + self._data_chunk.offset